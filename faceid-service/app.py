@@ -2,8 +2,11 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import logging
 import base64
+import os
+import tempfile
 import numpy as np
 from face_service import FaceService
+from utils.face_index import FaceIndex
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +17,7 @@ CORS(app)
 
 # Initialize service
 face_service = FaceService()
+face_index = FaceIndex()
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -52,10 +56,12 @@ def encode_face():
             min_liveness = request.form.get('min_liveness') or request.args.get('min_liveness')
             allow_mask = request.form.get('allow_mask') or request.args.get('allow_mask')
             min_live_val = float(min_liveness) if min_liveness is not None else None
-            embedding, face_image, scores = face_service.extract_embedding_from_sequence(frame_bytes, min_live_val, bool(allow_mask) and str(allow_mask).lower() not in ['0','false','no'])
+            embedding, face_image, scores, enrollment = face_service.extract_embedding_from_sequence(frame_bytes, min_live_val, bool(allow_mask) and str(allow_mask).lower() not in ['0','false','no'])
             return jsonify({
                 "success": True,
                 "embedding": embedding,
+                "templates": enrollment["templates"],
+                "centroid": enrollment["centroid"],
                 "face_image": face_image,
                 "temporal_scores": scores,
                 "message": "Face encoded successfully (sequence)"
@@ -91,12 +97,13 @@ def encode_face():
         min_liveness = request.form.get('min_liveness') or request.args.get('min_liveness')
         allow_mask = request.form.get('allow_mask') or request.args.get('allow_mask')
         min_live_val = float(min_liveness) if min_liveness is not None else None
-        embedding, face_image = face_service.extract_face_embedding(image_bytes, min_live_val, bool(allow_mask) and str(allow_mask).lower() not in ['0','false','no'])
+        embedding, face_image, bbox = face_service.extract_face_embedding(image_bytes, min_live_val, bool(allow_mask) and str(allow_mask).lower() not in ['0','false','no'], with_bbox=True)
         
         return jsonify({
             "success": True,
             "embedding": embedding,
             "face_image": face_image,
+            "bbox": bbox,
             "message": "Face encoded successfully"
         })
         
@@ -122,6 +129,100 @@ def encode_face():
             "message": error_message
         }), 400
 
+@app.route('/encode-faces', methods=['POST'])
+def encode_faces():
+    # Group photo: embed every detected face (no single-face liveness/pose gates)
+    try:
+        if 'image' not in request.files:
+            return jsonify({
+                "success": False,
+                "error": "NO_IMAGE_PROVIDED",
+                "message": "No image provided"
+            }), 400
+        image_bytes = request.files['image'].read()
+        if len(image_bytes) == 0:
+            return jsonify({
+                "success": False,
+                "error": "EMPTY_IMAGE",
+                "message": "Empty image file"
+            }), 400
+        if len(image_bytes) > 20 * 1024 * 1024:
+            return jsonify({
+                "success": False,
+                "error": "FILE_TOO_LARGE",
+                "message": "Image file too large (max 20MB)"
+            }), 400
+        allow_mask = request.form.get('allow_mask') or request.args.get('allow_mask')
+        # tiled: "1" forces tiled detection, "0" disables it, absent = by image size
+        tiled = request.form.get('tiled') or request.args.get('tiled')
+        if tiled is not None:
+            tiled = str(tiled).lower() not in ['0','false','no']
+        faces = face_service.extract_all_face_embeddings(image_bytes, bool(allow_mask) and str(allow_mask).lower() not in ['0','false','no'], tiled)
+        
+        return jsonify({
+            "success": True,
+            "faces": faces,
+            "count": len(faces),
+            "message": f"Detected {len(faces)} faces"
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in encode_faces: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "EXTRACTION_ERROR",
+            "message": str(e)
+        }), 400
+
+@app.route('/encode-video', methods=['POST'])
+def encode_video():
+    # Recorded video: one averaged embedding per face track (see FaceService.extract_video_tracks)
+    try:
+        if 'video' not in request.files:
+            return jsonify({
+                "success": False,
+                "error": "NO_VIDEO_PROVIDED",
+                "message": "No video provided"
+            }), 400
+        video = request.files['video']
+        sample_fps = request.form.get('sample_fps') or request.args.get('sample_fps')
+        tiled = request.form.get('tiled') or request.args.get('tiled')
+
+        # OpenCV reads from a path; spool the upload to a temp file
+        suffix = os.path.splitext(video.filename or '')[1] or '.mp4'
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                video.save(f)
+            if os.path.getsize(path) == 0:
+                return jsonify({
+                    "success": False,
+                    "error": "EMPTY_VIDEO",
+                    "message": "Empty video file"
+                }), 400
+            result = face_service.extract_video_tracks(
+                path,
+                float(sample_fps) if sample_fps else None,
+                bool(tiled) and str(tiled).lower() not in ['0','false','no']
+            )
+        finally:
+            os.remove(path)
+
+        return jsonify({
+            "success": True,
+            **result,
+            "count": len(result["tracks"]),
+            "message": f"Found {len(result['tracks'])} face tracks"
+        })
+
+    except Exception as e:
+        logger.error(f"Error in encode_video: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "EXTRACTION_ERROR",
+            "message": str(e)
+        }), 400
+
 @app.route('/compare-faces', methods=['POST'])
 def compare_faces():
     try:
@@ -190,6 +291,136 @@ def compare_faces():
             "message": f"Face comparison failed: {str(e)}"
         }), 400
 
+def _decode_embedding(value):
+    return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+
+@app.route('/gallery/sync', methods=['POST'])
+def sync_gallery():
+    # Replace the whole gallery: {"entries": [{"id", "embedding", "meta"}]}
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get('entries'), list):
+            return jsonify({
+                "success": False,
+                "error": "MISSING_ENTRIES",
+                "message": "Missing entries in request data"
+            }), 400
+        
+        entries = [
+            (str(e['id']), _decode_embedding(e['embedding']), e.get('meta') or {},
+             [_decode_embedding(t) for t in e.get('templates') or []])
+            for e in data['entries'] if e.get('id') and e.get('embedding')
+        ]
+        face_index.rebuild(entries)
+        return jsonify({"success": True, **face_index.stats()})
+        
+    except Exception as e:
+        logger.error(f"Error in sync_gallery: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "GALLERY_SYNC_ERROR",
+            "message": f"Gallery sync failed: {str(e)}"
+        }), 400
+
+@app.route('/gallery/<entry_id>', methods=['PUT'])
+def upsert_gallery_entry(entry_id):
+    try:
+        data = request.get_json()
+        if not data or 'embedding' not in data:
+            return jsonify({
+                "success": False,
+                "error": "MISSING_EMBEDDING",
+                "message": "Missing embedding in request data"
+            }), 400
+        
+        templates = [_decode_embedding(t) for t in data.get('templates') or []]
+        face_index.upsert(entry_id, _decode_embedding(data['embedding']), data.get('meta') or {}, templates)
+        return jsonify({"success": True, **face_index.stats()})
+        
+    except Exception as e:
+        logger.error(f"Error in upsert_gallery_entry: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "GALLERY_UPDATE_ERROR",
+            "message": f"Gallery update failed: {str(e)}"
+        }), 400
+
+@app.route('/gallery/<entry_id>', methods=['DELETE'])
+def delete_gallery_entry(entry_id):
+    removed = face_index.remove(entry_id)
+    return jsonify({"success": True, "removed": bool(removed), **face_index.stats()})
+
+@app.route('/gallery/check', methods=['POST'])
+def check_gallery():
+    # Diff the index against {"entries": [{"id", "embedding"}]} from the source of truth
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get('entries'), list):
+            return jsonify({
+                "success": False,
+                "error": "MISSING_ENTRIES",
+                "message": "Missing entries in request data"
+            }), 400
+        
+        entries = [(str(e['id']), _decode_embedding(e['embedding'])) for e in data['entries'] if e.get('id') and e.get('embedding')]
+        return jsonify({"success": True, **face_index.check(entries)})
+        
+    except Exception as e:
+        logger.error(f"Error in check_gallery: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "GALLERY_CHECK_ERROR",
+            "message": f"Gallery check failed: {str(e)}"
+        }), 400
+
+@app.route('/gallery/stats', methods=['GET'])
+def gallery_stats():
+    return jsonify({"success": True, **face_index.stats()})
+
+@app.route('/identify', methods=['POST'])
+def identify():
+    # Top-k gallery matches for one embedding ("embedding") or several ("embeddings", answered as
+    # "results", one match list per embedding), without sending the gallery over the wire
+    try:
+        data = request.get_json()
+        if not data or ('embedding' not in data and not isinstance(data.get('embeddings'), list)):
+            return jsonify({
+                "success": False,
+                "error": "MISSING_EMBEDDING",
+                "message": "Missing embedding in request data"
+            }), 400
+        
+        from thresholds_config import FACE_SIMILARITY_THRESHOLD
+        threshold = float(data.get('threshold', FACE_SIMILARITY_THRESHOLD))
+        top_k = max(1, min(int(data.get('top_k', 1)), 100))
+        
+        if 'embeddings' in data:
+            results = [face_index.identify(_decode_embedding(e), top_k=top_k, threshold=threshold)
+                       for e in data['embeddings']]
+            return jsonify({
+                "success": True,
+                "results": results,
+                "threshold": float(threshold),
+                "size": len(face_index)
+            })
+        
+        matches = face_index.identify(_decode_embedding(data['embedding']), top_k=top_k, threshold=threshold)
+        return jsonify({
+            "success": True,
+            "match": bool(matches),
+            "matches": matches,
+            "threshold": float(threshold),
+            "size": len(face_index)
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in identify: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": "IDENTIFY_ERROR",
+            "message": f"Identification failed: {str(e)}"
+        }), 400
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({
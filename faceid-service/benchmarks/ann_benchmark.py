@@ -0,0 +1,91 @@
+"""
+Benchmark the face index backends on a synthetic gallery.
+
+Each identity is a random unit vector; probes are noisy copies of enrolled identities so their
+true similarity sits around the match threshold. Recall is measured against exact search:
+the fraction of probes whose exact top-1 (above FACE_SIMILARITY_THRESHOLD) is also returned
+by the approximate backend.
+
+    python benchmarks/ann_benchmark.py --size 100000 --queries 500
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thresholds_config import FACE_SIMILARITY_THRESHOLD  # noqa: E402
+from utils.face_index import ExactIndex, IVFFlatIndex, HNSWIndex, hnswlib, normalize  # noqa: E402
+
+
+def build(index, gallery):
+    start = time.perf_counter()
+    for i, vector in enumerate(gallery):
+        index.add(str(i), vector)
+    return time.perf_counter() - start
+
+
+def run(index, probes, truth, threshold):
+    latencies, hits = [], 0
+    for probe, expected in zip(probes, truth):
+        start = time.perf_counter()
+        result = index.search(probe, 1)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found = result[0][0] if result and result[0][1] > threshold else None
+        hits += found == expected
+    latencies = np.array(latencies)
+    return hits / len(truth), np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency of the face index backends")
+    parser.add_argument("--size", type=int, default=50000, help="Gallery size")
+    parser.add_argument("--dim", type=int, default=512, help="Embedding dimension (ArcFace = 512)")
+    parser.add_argument("--queries", type=int, default=300, help="Number of probes")
+    parser.add_argument("--noise", type=float, default=0.5, help="Probe noise relative to the identity vector")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    gallery = normalize(rng.standard_normal((args.size, args.dim)))
+    picked = rng.choice(args.size, size=args.queries, replace=False)
+    probes = normalize(gallery[picked] + args.noise * normalize(rng.standard_normal((args.queries, args.dim))))
+
+    threshold = FACE_SIMILARITY_THRESHOLD
+    exact = ExactIndex(args.dim)
+    print(f"gallery={args.size} dim={args.dim} queries={args.queries} threshold={threshold}")
+    print(f"{'backend':<24}{'build s':>10}{'recall':>10}{'p50 ms':>10}{'p95 ms':>10}")
+
+    build_s = build(exact, gallery)
+    truth = []
+    for probe in probes:
+        top = exact.search(probe, 1)
+        truth.append(top[0][0] if top and top[0][1] > threshold else None)
+    recall, p50, p95 = run(exact, probes, truth, threshold)
+    print(f"{'exact':<24}{build_s:>10.2f}{recall:>10.3f}{p50:>10.3f}{p95:>10.3f}")
+
+    ivf = IVFFlatIndex(args.dim)
+    build_s = build(ivf, gallery)
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        recall, p50, p95 = run(ivf, probes, truth, threshold)
+        print(f"{f'ivf nprobe={nprobe}':<24}{build_s:>10.2f}{recall:>10.3f}{p50:>10.3f}{p95:>10.3f}")
+
+    if hnswlib is None:
+        print("hnsw skipped (pip install hnswlib)")
+        return
+    hnsw = HNSWIndex(args.dim)
+    build_s = build(hnsw, gallery)
+    for ef in args.ef:
+        hnsw.ef_search = ef
+        recall, p50, p95 = run(hnsw, probes, truth, threshold)
+        print(f"{f'hnsw ef={ef}':<24}{build_s:>10.2f}{recall:>10.3f}{p50:>10.3f}{p95:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
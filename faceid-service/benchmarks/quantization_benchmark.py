@@ -0,0 +1,103 @@
+"""
+Benchmark quantized gallery storage against the unquantized compare_embeddings results.
+
+The reference is FaceRecognizer.compare_embeddings called on every (probe, enrolled) pair,
+i.e. what identification costs when each person is compared one by one. Every storage
+variant is scored on agreement of its top-1 decision (same id, or same "no match") with that
+reference, the similarity error of the returned top-1, memory and per-query latency.
+
+    python benchmarks/quantization_benchmark.py --size 20000 --queries 100
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thresholds_config import FACE_SIMILARITY_THRESHOLD  # noqa: E402
+from utils.face_index import ExactIndex, QuantizedIndex, normalize  # noqa: E402
+from utils.recognition import FaceRecognizer  # noqa: E402
+
+
+def reference(gallery, probes, threshold):
+    # One compare_embeddings call per enrolled face, as the per-person HTTP loop did
+    decisions, latencies = [], []
+    for probe in probes:
+        start = time.perf_counter()
+        best_id, best_score = None, -1.0
+        for i, enrolled in enumerate(gallery):
+            is_match, similarity = FaceRecognizer.compare_embeddings(probe, enrolled, threshold)
+            if is_match and similarity > best_score:
+                best_id, best_score = str(i), float(similarity)
+        latencies.append((time.perf_counter() - start) * 1000)
+        decisions.append((best_id, best_score))
+    return decisions, np.array(latencies)
+
+
+def evaluate(index, probes, decisions, threshold):
+    agree, errors, latencies = 0, [], []
+    for probe, (ref_id, ref_score) in zip(probes, decisions):
+        start = time.perf_counter()
+        result = index.search(probe, 1)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found = result[0] if result and result[0][1] > threshold else (None, None)
+        agree += found[0] == ref_id
+        if ref_id is not None and found[0] == ref_id:
+            errors.append(abs(found[1] - ref_score))
+    latencies = np.array(latencies)
+    max_error = max(errors) if errors else 0.0
+    return agree / len(decisions), max_error, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy and speed of quantized gallery storage")
+    parser.add_argument("--size", type=int, default=10000, help="Gallery size")
+    parser.add_argument("--dim", type=int, default=512, help="Embedding dimension (ArcFace = 512)")
+    parser.add_argument("--queries", type=int, default=100, help="Number of probes")
+    parser.add_argument("--noise", type=float, default=0.6, help="Probe noise relative to the identity vector")
+    parser.add_argument("--rerank", type=int, default=32, help="Candidates re-scored in float32")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    gallery = normalize(rng.standard_normal((args.size, args.dim)))
+    picked = rng.choice(args.size, size=args.queries, replace=False)
+    probes = normalize(gallery[picked] + args.noise * normalize(rng.standard_normal((args.queries, args.dim))))
+    threshold = FACE_SIMILARITY_THRESHOLD
+
+    print(f"gallery={args.size} dim={args.dim} queries={args.queries} threshold={threshold}")
+    decisions, ref_latency = reference(gallery, probes, threshold)
+    print(f"{'variant':<26}{'MB':>8}{'agree':>8}{'max err':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    print(f"{'compare_embeddings loop':<26}{gallery.nbytes / 2**20:>8.1f}{1.0:>8.3f}{0.0:>10.5f}"
+          f"{np.percentile(ref_latency, 50):>10.2f}{np.percentile(ref_latency, 95):>10.2f}")
+
+    # Re-ranking reads float32 rows from a memory-mapped snapshot, as FaceIndex does with SNAPSHOT_DIR;
+    # MB is resident memory (the mapped rows live in the page cache)
+    mapped_path = os.path.join(tempfile.mkdtemp(), "vectors.npy")
+    np.save(mapped_path, gallery.astype(np.float32))
+    mapped = np.load(mapped_path, mmap_mode="r")
+    ids = [str(i) for i in range(args.size)]
+
+    variants = [
+        ("float32", ExactIndex(args.dim)),
+        (f"float16 rerank={args.rerank}", QuantizedIndex(args.dim, "float16", args.rerank)),
+        ("float16", QuantizedIndex(args.dim, "float16", 0)),
+        (f"int8 rerank={args.rerank}", QuantizedIndex(args.dim, "int8", args.rerank)),
+        ("int8", QuantizedIndex(args.dim, "int8", 0)),
+    ]
+    for name, index in variants:
+        for i, vector in enumerate(gallery):
+            index.add(str(i), vector)
+        if isinstance(index, QuantizedIndex) and index.rerank:
+            index.attach(ids, mapped)
+        nbytes = index.nbytes() if isinstance(index, QuantizedIndex) else index.table.nbytes()
+        agree, max_error, p50, p95 = evaluate(index, probes, decisions, threshold)
+        print(f"{name:<26}{nbytes / 2**20:>8.1f}{agree:>8.3f}{max_error:>10.5f}{p50:>10.2f}{p95:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
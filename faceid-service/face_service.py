@@ -7,6 +7,9 @@ import base64
 from typing import Dict, Tuple, Optional, List
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.face_tiling import nms, tile_grid, touches_inner_edge
+from utils.face_tracking import IoUTracker
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +62,35 @@ class FaceService:
             self.mask_conf_threshold = _f("FACE_MASK_CONF_THRESHOLD", 0.5)
             self.mask_skin_ratio_threshold = _f("FACE_MASK_SKIN_RATIO_THRESHOLD", 0.25)
             self.mask_consecutive_frames = _f("FACE_MASK_CONSECUTIVE_FRAMES", 3)
+        # Tiled detection for high-resolution group photos
+        try:
+            from thresholds_config import (
+                TILE_SIZE, TILE_OVERLAP, TILE_MIN_SIDE, TILE_WORKERS, TILE_NMS_IOU, TILE_EMBED_BATCH
+            )
+        except ImportError:
+            TILE_SIZE, TILE_OVERLAP, TILE_MIN_SIDE, TILE_WORKERS, TILE_NMS_IOU, TILE_EMBED_BATCH = 640, 0.25, 1280, 4, 0.4, 32
+        self.tile_size = int(_f("FACE_TILE_SIZE", TILE_SIZE))
+        self.tile_overlap = _f("FACE_TILE_OVERLAP", TILE_OVERLAP)
+        self.tile_min_side = int(_f("FACE_TILE_MIN_SIDE", TILE_MIN_SIDE))
+        self.tile_nms_iou = _f("FACE_TILE_NMS_IOU", TILE_NMS_IOU)
+        self.tile_embed_batch = max(1, int(_f("FACE_TILE_EMBED_BATCH", TILE_EMBED_BATCH)))
+        # Offline video ingestion (recorded lectures)
+        try:
+            from thresholds_config import (
+                VIDEO_SAMPLE_FPS, VIDEO_TRACK_IOU, VIDEO_TRACK_MAX_AGE, VIDEO_EMBEDS_PER_TRACK,
+                VIDEO_EMBED_GAP, VIDEO_MIN_TRACK_HITS
+            )
+        except ImportError:
+            VIDEO_SAMPLE_FPS, VIDEO_TRACK_IOU, VIDEO_TRACK_MAX_AGE = 2.0, 0.3, 4
+            VIDEO_EMBEDS_PER_TRACK, VIDEO_EMBED_GAP, VIDEO_MIN_TRACK_HITS = 3, 2.0, 2
+        self.video_sample_fps = _f("FACE_VIDEO_SAMPLE_FPS", VIDEO_SAMPLE_FPS)
+        self.video_track_iou = _f("FACE_VIDEO_TRACK_IOU", VIDEO_TRACK_IOU)
+        self.video_track_max_age = int(_f("FACE_VIDEO_TRACK_MAX_AGE", VIDEO_TRACK_MAX_AGE))
+        self.video_embeds_per_track = max(1, int(_f("FACE_VIDEO_EMBEDS_PER_TRACK", VIDEO_EMBEDS_PER_TRACK)))
+        self.video_embed_gap = _f("FACE_VIDEO_EMBED_GAP", VIDEO_EMBED_GAP)
+        self.video_min_track_hits = int(_f("FACE_VIDEO_MIN_TRACK_HITS", VIDEO_MIN_TRACK_HITS))
+        self._tile_pool = ThreadPoolExecutor(max_workers=max(1, int(_f("FACE_TILE_WORKERS", TILE_WORKERS))),
+                                             thread_name_prefix="face-tile")
     
     def _initialize_recognizer(self):
         """Initialize Insightface model"""
@@ -231,8 +263,10 @@ class FaceService:
             logger.warning(f"Mask detection check failed: {str(e)}")
             return False, 0.0
     
-    def extract_face_embedding(self, image_bytes, min_liveness_override: Optional[float] = None, allow_mask_override: Optional[bool] = None):
-        """Extract face embedding using Insightface with IMPROVED mask detection"""
+    def extract_face_embedding(self, image_bytes, min_liveness_override: Optional[float] = None, allow_mask_override: Optional[bool] = None,
+                               with_bbox: bool = False):
+        """Extract face embedding using Insightface with IMPROVED mask detection.
+        with_bbox also returns the face box [x1, y1, x2, y2] (kiosk face tracking)"""
         try:
             # Process image
             image = self.process_image(image_bytes)
@@ -345,15 +379,192 @@ class FaceService:
             # Convert embedding to base64
             embedding_base64 = base64.b64encode(face.embedding.tobytes()).decode('utf-8')
             
+            if with_bbox:
+                return embedding_base64, face_image_base64, [int(v) for v in bbox]
             return embedding_base64, face_image_base64
             
         except Exception as e:
             logger.error(f"Face embedding extraction failed: {str(e)}")
             raise Exception(f"Face embedding extraction failed: {str(e)}")
 
-    def extract_embedding_from_sequence(self, frames: List[bytes], min_liveness_override: Optional[float] = None, allow_mask_override: Optional[bool] = None) -> Tuple[str, str, Dict[str, float]]:
+    def _detect_tiled(self, rgb_image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Detect faces on overlapping detector-sized tiles, in parallel, plus one downscaled pass
+        over the whole image for faces larger than the tile overlap, merged with NMS.
+        Returns (boxes N x 5 [x1, y1, x2, y2, score], keypoints N x 5 x 2) in image coordinates."""
+        height, width = rgb_image.shape[:2]
+        detector = self.recognizer.det_model
+
+        def detect(tile):
+            x0, y0, x1, y1 = tile
+            boxes, kpss = detector.detect(rgb_image[y0:y1, x0:x1], max_num=0, metric='default')
+            if boxes is None or len(boxes) == 0:
+                return np.zeros((0, 5), dtype=np.float32), np.zeros((0, 5, 2), dtype=np.float32)
+            # Faces cut by an inner tile edge are whole in the neighbouring tile
+            keep = [i for i, box in enumerate(boxes) if not touches_inner_edge(box, tile, width, height)]
+            boxes, kpss = boxes[keep].copy(), kpss[keep].copy()
+            boxes[:, [0, 2]] += x0
+            boxes[:, [1, 3]] += y0
+            kpss += np.array([x0, y0], dtype=kpss.dtype)
+            return boxes, kpss
+
+        tiles = tile_grid(width, height, self.tile_size, self.tile_overlap)
+        jobs = [self._tile_pool.submit(detect, tile) for tile in tiles]
+        parts = [detect((0, 0, width, height))] + [job.result() for job in jobs]
+        boxes = np.concatenate([p[0] for p in parts])
+        kpss = np.concatenate([p[1] for p in parts])
+        keep = nms(boxes[:, :4], boxes[:, 4], self.tile_nms_iou)
+        logger.info(f"Tiled detection: {len(tiles)} tiles, {len(boxes)} boxes, {len(keep)} faces after NMS")
+        return boxes[keep], kpss[keep]
+
+    def _embed_aligned(self, rgb_image: np.ndarray, kpss: List[np.ndarray]) -> np.ndarray:
+        """Align each face on its 5 landmarks and embed them in batches of tile_embed_batch"""
+        from insightface.utils import face_align
+        recognition = self.recognizer.models['recognition']
+        crops = [face_align.norm_crop(rgb_image, landmark=kps, image_size=recognition.input_size[0]) for kps in kpss]
+        feats = [recognition.get_feat(crops[i:i + self.tile_embed_batch])
+                 for i in range(0, len(crops), self.tile_embed_batch)]
+        return np.concatenate(feats) if feats else np.zeros((0, 0), dtype=np.float32)
+
+    def extract_all_face_embeddings(self, image_bytes, allow_mask_override: Optional[bool] = None,
+                                    tiled: Optional[bool] = None) -> List[Dict[str, object]]:
+        """Detect every face in a group photo and embed each one.
+        Returns a list of {bbox, det_score, embedding (base64)[, mask_confidence]}; masked faces
+        are returned with "masked": True and no embedding. Liveness/pose gates are single-face
+        checks and are not applied here.
+        tiled: detect on overlapping tiles at detector scale (see _detect_tiled); None tiles
+        images whose longer side is at least tile_min_side."""
+        try:
+            image = self.process_image(image_bytes)
+            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            if tiled is None:
+                tiled = self.tile_min_side > 0 and max(rgb_image.shape[:2]) >= self.tile_min_side
+
+            # (bbox, det_score, embedding, keypoints); tiled faces are embedded afterwards in one batch
+            if tiled:
+                boxes, kpss = self._detect_tiled(rgb_image)
+                detections = [(boxes[i, :4], float(boxes[i, 4]), None, kpss[i]) for i in range(len(boxes))]
+            else:
+                detections = [(face.bbox, float(getattr(face, 'det_score', 0.0)), face.embedding, None)
+                              for face in self.recognizer.get(rgb_image)]
+
+            results, pending = [], []
+            for bbox, det_score, embedding, kps in detections:
+                bbox = bbox.astype(int)
+                entry = {
+                    "bbox": [int(v) for v in bbox],
+                    "det_score": det_score
+                }
+                if self.enable_mask and not bool(allow_mask_override):
+                    has_mask, mask_confidence = self._check_for_mask(image, bbox)
+                    entry["mask_confidence"] = float(mask_confidence)
+                    if has_mask or (mask_confidence > self.mask_conf_threshold):
+                        entry["masked"] = True
+                        results.append(entry)
+                        continue
+                if embedding is None:
+                    pending.append((entry, kps))
+                else:
+                    entry["embedding"] = base64.b64encode(embedding.astype(np.float32).tobytes()).decode('utf-8')
+                results.append(entry)
+
+            if pending:
+                feats = self._embed_aligned(rgb_image, [kps for _, kps in pending])
+                for (entry, _), feat in zip(pending, feats):
+                    entry["embedding"] = base64.b64encode(feat.astype(np.float32).tobytes()).decode('utf-8')
+            return results
+
+        except Exception as e:
+            logger.error(f"Group embedding extraction failed: {str(e)}")
+            raise Exception(f"Group embedding extraction failed: {str(e)}")
+
+    def _detect(self, rgb_image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Detection only (no landmark/attribute models): (boxes N x 5, keypoints N x 5 x 2)"""
+        boxes, kpss = self.recognizer.det_model.detect(rgb_image, max_num=0, metric='default')
+        if boxes is None or len(boxes) == 0:
+            return np.zeros((0, 5), dtype=np.float32), np.zeros((0, 5, 2), dtype=np.float32)
+        return boxes, kpss
+
+    def extract_video_tracks(self, video_path: str, sample_fps: Optional[float] = None,
+                             tiled: bool = False) -> Dict[str, object]:
+        """Sample a recorded video at sample_fps, follow faces across the samples with an IoU
+        tracker and embed each track on at most video_embeds_per_track of its frames.
+        Returns {"tracks": [{track_id, first_seen, last_seen, hits, det_score, bbox, embedding
+        (normalized mean, base64), face_image}], "duration", "frames_sampled", "processing_seconds"};
+        times are seconds into the video. Tracks seen on fewer than video_min_track_hits samples
+        are dropped. Mask and single-face liveness gates are not applied."""
+        started = time.time()
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise Exception("Cannot open video file")
+        try:
+            fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+            sample_fps = min(sample_fps or self.video_sample_fps, fps)
+            step = max(1, int(round(fps / sample_fps)))
+            gap = max(1, int(round(self.video_embed_gap * fps / step)))  # samples between embeddings of a track
+            tracker = IoUTracker(self.video_track_iou, self.video_track_max_age)
+            detect = self._detect_tiled if tiled else self._detect
+
+            frame_index, sampled = 0, 0
+            # grab() skips retrieving and converting the frames that are not sampled
+            while capture.grab():
+                if frame_index % step == 0:
+                    ok, frame = capture.retrieve()
+                    if not ok:
+                        break
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    boxes, kpss = detect(rgb)
+                    tracks = tracker.update(boxes[:, :4], boxes[:, 4], sampled, frame_index / fps)
+                    due = [i for i, track in enumerate(tracks)
+                           if track.wants_embedding(sampled, self.video_embeds_per_track, gap)]
+                    if due:
+                        for i, feat in zip(due, self._embed_aligned(rgb, [kpss[i] for i in due])):
+                            track = tracks[i]
+                            track.add_embedding(feat, sampled)
+                            if track.best_crop is None or boxes[i, 4] >= track.best_score:
+                                x1, y1, x2, y2 = np.clip(boxes[i, :4], 0, None).astype(int)
+                                track.best_crop = frame[y1:y2, x1:x2].copy()
+                    sampled += 1
+                frame_index += 1
+        finally:
+            capture.release()
+
+        results = []
+        for track in tracker.close():
+            embedding = track.embedding()
+            if embedding is None or track.hits < self.video_min_track_hits:
+                continue
+            face_image = None
+            if track.best_crop is not None and track.best_crop.size:
+                _, img_buf = cv2.imencode('.jpg', track.best_crop)
+                face_image = base64.b64encode(img_buf).decode('utf-8')
+            results.append({
+                "track_id": track.track_id,
+                "first_seen": round(track.first_seen, 2),
+                "last_seen": round(track.last_seen, 2),
+                "hits": track.hits,
+                "det_score": float(track.best_score),
+                "bbox": [int(v) for v in track.best_box[:4]],
+                "embedding": base64.b64encode(embedding.astype(np.float32).tobytes()).decode('utf-8'),
+                "face_image": face_image
+            })
+
+        elapsed = time.time() - started
+        duration = frame_index / fps
+        logger.info(
+            f"Video: {duration:.1f}s in {elapsed:.1f}s ({duration / max(elapsed, 1e-6):.1f}x real time), "
+            f"{sampled} samples, {len(results)} tracks"
+        )
+        return {
+            "tracks": results,
+            "duration": round(duration, 2),
+            "frames_sampled": sampled,
+            "processing_seconds": round(elapsed, 2)
+        }
+
+    def extract_embedding_from_sequence(self, frames: List[bytes], min_liveness_override: Optional[float] = None, allow_mask_override: Optional[bool] = None) -> Tuple[str, str, Dict[str, float], Dict[str, object]]:
         """Process a short sequence (0.8–1.0s) of JPEG frames for stronger liveness.
-        Returns (embedding_base64, face_image_base64, scores)
+        Returns (embedding_base64, face_image_base64, scores, enrollment) where enrollment holds
+        diverse per-frame "templates" and their normalized "centroid" (all base64)
         """
         try:
             if not frames or len(frames) < 3:
@@ -362,6 +573,9 @@ class FaceService:
             best_face = None
             best_lap = 0.0
             best_crop_bgr = None
+            frame_embeddings: List[np.ndarray] = []
+            frame_sharpness: List[float] = []
+            frame_det_scores: List[float] = []
             for b in frames:
                 img_bgr = self.process_image(b)
                 rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
@@ -381,6 +595,9 @@ class FaceService:
                 x1, y1, x2, y2 = bbox
                 crop = img_bgr[y1:y2, x1:x2]
                 lap = self._laplacian_sharpness(crop)
+                frame_embeddings.append(face.embedding)
+                frame_sharpness.append(lap)
+                frame_det_scores.append(float(getattr(face, 'det_score', 1.0)))
                 if lap > best_lap:
                     best_lap = lap
                     best_face = face
@@ -416,7 +633,15 @@ class FaceService:
             embedding_base64 = base64.b64encode(best_face.embedding.tobytes()).decode('utf-8')
             _, img_buf = cv2.imencode('.jpg', best_crop_bgr)
             face_image_base64 = base64.b64encode(img_buf).decode('utf-8')
-            return embedding_base64, face_image_base64, scores
+            # best-quality distinct templates across the sequence, for multi-template enrollment
+            from utils.recognition import FaceRecognizer
+            templates, centroid = FaceRecognizer.select_templates(frame_embeddings, frame_sharpness, frame_det_scores)
+            enrollment = {
+                'templates': [FaceRecognizer.embedding_to_base64(t) for t in templates],
+                'centroid': FaceRecognizer.embedding_to_base64(centroid)
+            }
+            scores['template_count'] = len(templates)
+            return embedding_base64, face_image_base64, scores, enrollment
         except Exception as e:
             logger.error(f"Sequence embedding extraction failed: {str(e)}")
             raise Exception(f"Sequence embedding extraction failed: {str(e)}")
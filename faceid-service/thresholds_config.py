@@ -29,6 +29,29 @@ MOTION_FRAMES_REQUIRED = 2    # Number of motion frames required (lowered from 3
 # Face Comparison Thresholds - Increase threshold to check face matching more strictly
 FACE_SIMILARITY_THRESHOLD = 0.8  # Face comparison threshold (increased from 0.6 to 0.8)
 
+# Multi-template Enrollment (sequence registration)
+TEMPLATE_MAX = 5                  # Best-quality distinct frames kept per user
+TEMPLATE_MIN_SIMILARITY = 0.5     # Frames less similar than this to the sharpest one are another face
+TEMPLATE_DEDUP_SIMILARITY = 0.97  # Frames more similar than this to a kept template add nothing
+TEMPLATE_RERANK_MARGIN = 0.1      # Centroid candidates within this margin below the threshold are re-ranked on templates
+TEMPLATE_CANDIDATES = 10          # Centroid candidates re-ranked per query
+
+# Tiled Detection (high-resolution group photos)
+TILE_SIZE = 640          # Tile side in pixels (the detector input size)
+TILE_OVERLAP = 0.25      # Fraction of a tile shared with its neighbour
+TILE_MIN_SIDE = 1280     # Group photos with a longer side of at least this are tiled (0 = only on request)
+TILE_WORKERS = 4         # Tiles detected in parallel
+TILE_NMS_IOU = 0.4       # Boxes overlapping more than this are merged
+TILE_EMBED_BATCH = 32    # Aligned faces embedded per recognition call
+
+# Offline Video Ingestion (recorded lectures)
+VIDEO_SAMPLE_FPS = 2.0        # Frames per second of video run through detection
+VIDEO_TRACK_IOU = 0.3         # Minimum box overlap to continue a track on the next sample
+VIDEO_TRACK_MAX_AGE = 4       # Samples a track may go undetected before it ends
+VIDEO_EMBEDS_PER_TRACK = 3    # Frames embedded per track (averaged)
+VIDEO_EMBED_GAP = 2.0         # Seconds between embeddings of the same track
+VIDEO_MIN_TRACK_HITS = 2      # Tracks seen on fewer samples are dropped as spurious
+
 # Feature Flags
 ENABLE_QUALITY = True
 ENABLE_POSE = True
@@ -38,3 +61,20 @@ BLOCK_STRICT = True
 
 # Debug Mode - Enable to see detailed processing
 DEBUG_MODE = True
+
+# Face Index (identification against the enrolled gallery)
+INDEX_BACKEND = "exact"      # "exact", "ivf" (inverted lists, numpy) or "hnsw" (needs hnswlib)
+INDEX_QUANTIZATION = "none"  # "exact" backend storage: "none" (float32), "float16" or "int8"
+INDEX_RERANK = 32            # Quantized candidates re-scored in float32 read from the mapped snapshot (> 0 requires SNAPSHOT_DIR; 0 = off)
+IVF_NLIST = 0                # Number of inverted lists (0 = sqrt of gallery size)
+IVF_NPROBE = 8               # Lists scanned per query (higher = better recall, slower)
+HNSW_M = 16                  # Graph degree
+HNSW_EF_CONSTRUCTION = 200   # Build-time candidate list size
+HNSW_EF_SEARCH = 64          # Query-time candidate list size (higher = better recall, slower)
+
+# Gallery Snapshots (shared across worker processes)
+SNAPSHOT_DIR = ""              # Directory for versioned gallery snapshots ("" = disabled)
+SNAPSHOT_POLL_INTERVAL = 1.0   # Seconds between checks for a newer published version
+SNAPSHOT_KEEP = 3              # Versions kept on disk
+SNAPSHOT_COMPACT_DELTAS = 1000 # Writes appended to a version's delta log before a full version is republished
+SNAPSHOT_VERIFY = True         # Verify the sha256 checksum when loading a version
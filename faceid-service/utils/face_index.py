@@ -0,0 +1,718 @@
+import base64
+import numpy as np
+import threading
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from .gallery_snapshot import Snapshot, SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows (or a single vector) as float32"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(ids: List[str], scores: np.ndarray, k: int) -> List[Tuple[str, float]]:
+    if len(ids) == 0 or k <= 0:
+        return []
+    k = min(k, len(ids))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(ids[i], float(scores[i])) for i in top]
+
+
+class _VectorTable:
+    """Growable matrix of normalized vectors with O(1) amortized add and swap-remove.
+    Rows are stored as float32, float16, or int8 with a per-row scale."""
+
+    SCAN_CHUNK = 16384  # rows decoded to float32 at a time when scanning quantized rows
+
+    def __init__(self, dim: int, capacity: int = 1024, dtype=np.float32):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.matrix = np.zeros((capacity, dim), dtype=self.dtype)
+        self.scales = np.ones(capacity, dtype=np.float32) if self.dtype == np.int8 else None
+        self.ids: List[str] = []
+        self.pos: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self) -> int:
+        n = len(self.ids)
+        return n * self.dim * self.dtype.itemsize + (n * 4 if self.scales is not None else 0)
+
+    def _encode(self, i: int, vector: np.ndarray):
+        if self.scales is not None:
+            scale = float(np.max(np.abs(vector))) / 127.0 or 1.0
+            self.matrix[i] = np.round(vector / scale).astype(np.int8)
+            self.scales[i] = scale
+        else:
+            self.matrix[i] = vector
+
+    def add(self, entry_id: str, vector: np.ndarray):
+        if entry_id in self.pos:
+            self._encode(self.pos[entry_id], vector)
+            return
+        if len(self.ids) == self.matrix.shape[0]:
+            grown = np.zeros((self.matrix.shape[0] * 2, self.dim), dtype=self.dtype)
+            grown[:len(self.ids)] = self.matrix[:len(self.ids)]
+            self.matrix = grown
+            if self.scales is not None:
+                self.scales = np.concatenate([self.scales, np.ones(len(self.scales), dtype=np.float32)])
+        self.pos[entry_id] = len(self.ids)
+        self._encode(len(self.ids), vector)
+        self.ids.append(entry_id)
+
+    def remove(self, entry_id: str) -> bool:
+        i = self.pos.pop(entry_id, None)
+        if i is None:
+            return False
+        last = len(self.ids) - 1
+        if i != last:
+            moved = self.ids[last]
+            self.matrix[i] = self.matrix[last]
+            if self.scales is not None:
+                self.scales[i] = self.scales[last]
+            self.ids[i] = moved
+            self.pos[moved] = i
+        self.ids.pop()
+        return True
+
+    def get(self, entry_id: str) -> Optional[np.ndarray]:
+        i = self.pos.get(entry_id)
+        return None if i is None else self.rows(np.array([i]))[0]
+
+    def rows(self, positions: np.ndarray) -> np.ndarray:
+        rows = self.matrix[positions].astype(np.float32)
+        return rows * self.scales[positions, None] if self.scales is not None else rows
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        n = len(self.ids)
+        if self.dtype == np.float32:
+            return self.matrix[:n] @ query
+        # numpy has no BLAS path for int8/float16, so decode in cache-sized chunks
+        out = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.SCAN_CHUNK):
+            end = min(start + self.SCAN_CHUNK, n)
+            out[start:end] = self.matrix[start:end].astype(np.float32) @ query
+            if self.scales is not None:
+                out[start:end] *= self.scales[start:end]
+        return out
+
+
+class ExactIndex:
+    """Brute-force inner product over every enrolled vector"""
+
+    name = "exact"
+
+    def __init__(self, dim: int):
+        self.table = _VectorTable(dim)
+
+    def __len__(self):
+        return len(self.table)
+
+    def add(self, entry_id: str, vector: np.ndarray):
+        self.table.add(entry_id, vector)
+
+    def remove(self, entry_id: str) -> bool:
+        return self.table.remove(entry_id)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        return _top_k(self.table.ids, self.table.scores(query), k)
+
+    def vectors(self) -> Tuple[List[str], np.ndarray]:
+        return list(self.table.ids), self.table.matrix[:len(self.table)]
+
+
+class MappedIndex:
+    """Exact search over a memory-mapped snapshot matrix (shared between processes). Writes
+    applied since the snapshot go to a small private overlay: replaced or removed rows are
+    masked out of the mapping and new rows are searched alongside it."""
+
+    name = "mapped"
+
+    def __init__(self, ids: List[str], matrix: np.ndarray):
+        self.ids = ids
+        self.matrix = matrix
+        self.pos = {entry_id: i for i, entry_id in enumerate(ids)}
+        self.masked: set = set()  # mapped rows replaced or removed since the snapshot
+        self.overlay: Optional[ExactIndex] = None
+
+    def __len__(self):
+        return len(self.ids) - len(self.masked) + (len(self.overlay) if self.overlay is not None else 0)
+
+    def add(self, entry_id: str, vector: np.ndarray):
+        i = self.pos.pop(entry_id, None)
+        if i is not None:
+            self.masked.add(i)
+        if self.overlay is None:
+            self.overlay = ExactIndex(self.matrix.shape[1])
+        self.overlay.add(entry_id, vector)
+
+    def remove(self, entry_id: str) -> bool:
+        i = self.pos.pop(entry_id, None)
+        if i is not None:
+            self.masked.add(i)
+            return True
+        return self.overlay is not None and self.overlay.remove(entry_id)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        scores = self.matrix @ query
+        if not self.masked and self.overlay is None:
+            return _top_k(self.ids, scores, k)
+        if self.masked:
+            scores[list(self.masked)] = -np.inf
+        hits = [hit for hit in _top_k(self.ids, scores, k) if hit[1] != -np.inf]
+        if self.overlay is not None:
+            hits.extend(self.overlay.search(query, k))
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:k]
+
+    def vectors(self) -> Tuple[List[str], np.ndarray]:
+        if not self.masked and self.overlay is None:
+            return list(self.ids), self.matrix
+        live = [i for i in range(len(self.ids)) if i not in self.masked]
+        ids, rows = [self.ids[i] for i in live], [self.matrix[live]]
+        if self.overlay is not None:
+            overlay_ids, overlay_rows = self.overlay.vectors()
+            ids.extend(overlay_ids)
+            rows.append(overlay_rows)
+        return ids, np.vstack(rows)
+
+
+class QuantizedIndex:
+    """Brute-force scan over float16 or per-row scaled int8 codes. The top `rerank` candidates
+    are re-scored in float32 read from the memory-mapped snapshot the index was built from
+    (attach()), or from a small overlay for entries written since, so no resident float32 copy
+    of the gallery is kept and the 2x/4x memory saving holds with re-ranking on. Without
+    attached rows scores come from the codes alone (FaceIndex only allows that with rerank=0)."""
+
+    name = "quantized"
+
+    def __init__(self, dim: int, dtype: str = "int8", rerank: int = 32):
+        self.codes = _VectorTable(dim, dtype=np.int8 if dtype == "int8" else np.float16)
+        self.rerank = rerank
+        self._mapped: Optional[np.ndarray] = None  # read-only float32 rows on disk
+        self._mapped_pos: Dict[str, int] = {}
+        self._overlay: Dict[str, np.ndarray] = {}  # float32 rows of entries added since attach()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def attach(self, ids: List[str], matrix: np.ndarray):
+        """Re-rank from matrix (a mapped snapshot whose rows are ids) instead of the codes"""
+        self._mapped = matrix
+        self._mapped_pos = {entry_id: i for i, entry_id in enumerate(ids)}
+        self._overlay = {}
+
+    def add(self, entry_id: str, vector: np.ndarray):
+        self.codes.add(entry_id, vector)
+        if self._mapped is not None:
+            self._overlay[entry_id] = np.asarray(vector, dtype=np.float32).copy()
+
+    def remove(self, entry_id: str) -> bool:
+        self._overlay.pop(entry_id, None)
+        self._mapped_pos.pop(entry_id, None)
+        return self.codes.remove(entry_id)
+
+    def _exact_row(self, entry_id: str) -> Optional[np.ndarray]:
+        row = self._overlay.get(entry_id)
+        if row is None and entry_id in self._mapped_pos:
+            row = self._mapped[self._mapped_pos[entry_id]]
+        return row
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        n = len(self.codes)
+        if n == 0 or k <= 0:
+            return []
+        approx = self.codes.scores(query)
+        if self._mapped is None or self.rerank <= 0:
+            return _top_k(self.codes.ids, approx, k)
+        m = min(max(k, self.rerank), n)
+        candidates = np.argpartition(-approx, m - 1)[:m]
+        ids = [self.codes.ids[i] for i in candidates]
+        exact = np.array(approx[candidates], dtype=np.float32)
+        for j, entry_id in enumerate(ids):
+            row = self._exact_row(entry_id)
+            if row is not None:
+                exact[j] = float(np.asarray(row, dtype=np.float32) @ query)
+        return _top_k(ids, exact, k)
+
+    def nbytes(self) -> int:
+        """Resident bytes (the mapped rows live in the shared page cache)"""
+        return self.codes.nbytes() + sum(row.nbytes for row in self._overlay.values())
+
+    def vectors(self) -> Tuple[List[str], np.ndarray]:
+        n = len(self.codes)
+        ids = list(self.codes.ids)
+        matrix = normalize(self.codes.rows(np.arange(n))) if n else np.zeros((0, self.codes.matrix.shape[1]), dtype=np.float32)
+        for i, entry_id in enumerate(ids):
+            row = self._exact_row(entry_id)
+            if row is not None:
+                matrix[i] = row
+        return ids, matrix
+
+
+class IVFFlatIndex:
+    """Inverted file index: vectors are bucketed by nearest k-means centroid and only the
+    nprobe closest buckets are scanned (exactly) per query. Below train_min vectors it
+    behaves as exact search; it retrains when the gallery has grown 4x since the last training."""
+
+    name = "ivf"
+
+    def __init__(self, dim: int, nlist: int = 0, nprobe: int = 8, train_min: int = 1024):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_min = train_min
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[_VectorTable] = [_VectorTable(dim)]
+        self.list_of: Dict[str, int] = {}
+        self.trained_size = 0
+
+    def __len__(self):
+        return len(self.list_of)
+
+    def add(self, entry_id: str, vector: np.ndarray):
+        if entry_id in self.list_of:
+            self.remove(entry_id)
+        list_no = 0 if self.centroids is None else int(np.argmax(self.centroids @ vector))
+        self.lists[list_no].add(entry_id, vector)
+        self.list_of[entry_id] = list_no
+        size = len(self.list_of)
+        if size >= self.train_min and size >= 4 * max(self.trained_size, self.train_min // 4):
+            self._train()
+
+    def remove(self, entry_id: str) -> bool:
+        list_no = self.list_of.pop(entry_id, None)
+        if list_no is None:
+            return False
+        return self.lists[list_no].remove(entry_id)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        if self.centroids is None:
+            probe = [0]
+        else:
+            n = min(self.nprobe, len(self.lists))
+            probe = np.argpartition(-(self.centroids @ query), n - 1)[:n]
+        ids, scores = [], []
+        for list_no in probe:
+            table = self.lists[list_no]
+            if len(table):
+                ids.extend(table.ids)
+                scores.append(table.scores(query))
+        if not ids:
+            return []
+        return _top_k(ids, np.concatenate(scores), k)
+
+    def vectors(self) -> Tuple[List[str], np.ndarray]:
+        ids, rows = [], []
+        for table in self.lists:
+            ids.extend(table.ids)
+            rows.append(table.matrix[:len(table)])
+        return ids, np.vstack(rows)
+
+    def _train(self, iterations: int = 10):
+        # Spherical k-means on (a sample of) the current vectors, then re-bucket everything
+        ids, data = self.vectors()
+        nlist = min(self.nlist or max(1, int(np.sqrt(len(ids)))), len(ids))
+        rng = np.random.default_rng(0)
+        sample = data[rng.choice(len(data), size=min(len(data), 256 * nlist), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = normalize(centroids)
+
+        self.centroids = centroids
+        self.lists = [_VectorTable(self.dim, capacity=max(16, 2 * len(ids) // nlist)) for _ in range(nlist)]
+        self.list_of = {}
+        assign = np.argmax(data @ centroids.T, axis=1)
+        for entry_id, vector, list_no in zip(ids, data, assign):
+            self.lists[int(list_no)].add(entry_id, vector)
+            self.list_of[entry_id] = int(list_no)
+        self.trained_size = len(ids)
+        logger.info(f"IVF index trained: {len(ids)} vectors, {nlist} lists")
+
+
+class HNSWIndex:
+    """Hierarchical navigable small-world graph (hnswlib, inner-product space)"""
+
+    name = "hnsw"
+
+    def __init__(self, dim: int, m: int = 16, ef_construction: int = 200, ef_search: int = 64):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the hnsw backend. Install with: pip install hnswlib")
+        self.dim = dim
+        self.ef_search = ef_search
+        self.capacity = 1024
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        self.index.init_index(max_elements=self.capacity, ef_construction=ef_construction, M=m,
+                              allow_replace_deleted=True)
+        self.label_of: Dict[str, int] = {}
+        self.id_of: Dict[int, str] = {}
+        self.next_label = 0
+
+    def __len__(self):
+        return len(self.label_of)
+
+    def add(self, entry_id: str, vector: np.ndarray):
+        if entry_id in self.label_of:
+            self.remove(entry_id)
+        if self.index.get_current_count() >= self.capacity:
+            self.capacity *= 2
+            self.index.resize_index(self.capacity)
+        label = self.next_label
+        self.next_label += 1
+        # Reuses the slot of a deleted element when there is one
+        self.index.add_items(vector.reshape(1, -1), np.array([label]), replace_deleted=True)
+        self.label_of[entry_id] = label
+        self.id_of[label] = entry_id
+
+    def remove(self, entry_id: str) -> bool:
+        label = self.label_of.pop(entry_id, None)
+        if label is None:
+            return False
+        self.id_of.pop(label, None)
+        self.index.mark_deleted(label)
+        return True
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        k = min(k, len(self.label_of))
+        if k <= 0:
+            return []
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(query.reshape(1, -1), k=k)
+        # ip space distance is 1 - inner product
+        return [(self.id_of[int(l)], float(1.0 - d)) for l, d in zip(labels[0], distances[0]) if int(l) in self.id_of]
+
+    def vectors(self) -> Tuple[List[str], np.ndarray]:
+        ids = list(self.label_of)
+        if not ids:
+            return [], np.zeros((0, self.dim), dtype=np.float32)
+        return ids, np.asarray(self.index.get_items([self.label_of[i] for i in ids]), dtype=np.float32)
+
+
+def _pack(vector) -> str:
+    # float32 rows travel through the delta log as base64
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).reshape(-1).tobytes()).decode("ascii")
+
+
+def _unpack(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+
+def _config(name: str, default):
+    try:
+        import thresholds_config
+        default = getattr(thresholds_config, name, default)
+    except ImportError:
+        pass
+    value = os.getenv(f"FACE_{name}")
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() == "true"
+    return type(default)(value)
+
+
+class FaceIndex:
+    """Identification index over enrolled embeddings with a pluggable backend
+    ("exact", "ivf" or "hnsw"; "exact" can scan quantized codes). Thread-safe;
+    add/remove are O(1) amortized.
+
+    With SNAPSHOT_DIR set, the gallery is also published as versioned on-disk snapshots.
+    Every worker process maps the current version read-only (the float32 exact backend
+    searches the mapping directly, so the pages are shared) and polls for changes. A write is
+    applied on top of the latest state and appended to the current version's delta log, which
+    other workers replay incrementally; after SNAPSHOT_COMPACT_DELTAS logged writes the writer
+    publishes a full version, which workers that replayed the same log adopt without
+    rebuilding their index."""
+
+    def __init__(self, backend: Optional[str] = None, snapshot_dir: Optional[str] = None):
+        self.backend = backend or _config("INDEX_BACKEND", "exact")
+        self._lock = threading.RLock()
+        self._index = None
+        self._meta: Dict[str, dict] = {}
+        self._templates: Dict[str, np.ndarray] = {}  # id -> normalized templates (multi-template users)
+        self.dim: Optional[int] = None
+        self.version: Optional[int] = None
+        self._delta_offset = 0  # bytes of the version's delta log applied
+        self._delta_count = 0   # records of the version's delta log applied
+        self._checked_at = 0.0
+        self._poll_interval = _config("SNAPSHOT_POLL_INTERVAL", 1.0)
+        self._compact_after = _config("SNAPSHOT_COMPACT_DELTAS", 1000)
+
+        snapshot_dir = snapshot_dir if snapshot_dir is not None else _config("SNAPSHOT_DIR", "")
+        if (self.backend == "exact" and _config("INDEX_QUANTIZATION", "none") in ("int8", "float16")
+                and _config("INDEX_RERANK", 32) > 0 and not snapshot_dir):
+            # Re-ranking reads float32 rows from the mapped snapshot; without one the threshold
+            # would silently apply to approximate code scores
+            raise ValueError("INDEX_QUANTIZATION with INDEX_RERANK > 0 needs SNAPSHOT_DIR for the float32 "
+                             "re-rank rows; set SNAPSHOT_DIR, or INDEX_RERANK=0 to accept code scores")
+        self._store = None
+        if snapshot_dir:
+            self._store = SnapshotStore(snapshot_dir, keep=_config("SNAPSHOT_KEEP", 3),
+                                        verify=_config("SNAPSHOT_VERIFY", True))
+            self._refresh(force=True)
+
+    def _new_index(self, dim: int):
+        if self.backend == "hnsw":
+            if hnswlib is not None:
+                return HNSWIndex(dim, m=_config("HNSW_M", 16), ef_construction=_config("HNSW_EF_CONSTRUCTION", 200),
+                                 ef_search=_config("HNSW_EF_SEARCH", 64))
+            logger.warning("hnswlib not installed, falling back to ivf index")
+            self.backend = "ivf"
+        if self.backend == "ivf":
+            return IVFFlatIndex(dim, nlist=_config("IVF_NLIST", 0), nprobe=_config("IVF_NPROBE", 8))
+        quantization = _config("INDEX_QUANTIZATION", "none")
+        if quantization in ("int8", "float16"):
+            return QuantizedIndex(dim, dtype=quantization, rerank=_config("INDEX_RERANK", 32))
+        return ExactIndex(dim)
+
+    def _shares_mapping(self) -> bool:
+        return self.backend == "exact" and _config("INDEX_QUANTIZATION", "none") not in ("int8", "float16")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index) if self._index is not None else 0
+
+    # Snapshots
+
+    def _refresh(self, force: bool = False):
+        # Catch up with other workers, at most once per poll interval. Lock held by caller
+        # (or during __init__).
+        now = time.monotonic()
+        if self._store is None or (not force and now - self._checked_at < self._poll_interval):
+            return
+        self._checked_at = now
+        version = self._store.current_version()
+        if version is None:
+            return
+        if version != self.version:
+            base = None
+            if self.version is not None:
+                # Finish our version's log first: the new one may be a compaction of it
+                self._apply_deltas()
+                manifest = self._store.manifest(version) or {}
+                base = (manifest.get("base_version"), manifest.get("base_deltas"))
+            if base == (self.version, self._delta_count):
+                if not self._adopt(version):
+                    return
+            else:
+                snapshot = self._store.load(version)
+                if snapshot is None:
+                    return
+                self._load_snapshot(snapshot)
+        self._apply_deltas()
+
+    def _load_snapshot(self, snapshot: Snapshot):
+        self._meta = dict(zip(snapshot.ids, snapshot.meta))
+        self._templates = dict(snapshot.templates)
+        self.dim = int(snapshot.matrix.shape[1]) if len(snapshot.ids) else None
+        if not snapshot.ids:
+            self._index = None
+        elif self._shares_mapping():
+            self._index = MappedIndex(snapshot.ids, snapshot.matrix)
+        else:
+            # ivf/hnsw/quantized keep their own structures; build them from the mapped rows
+            self._index = self._new_index(self.dim)
+            for entry_id, vector in zip(snapshot.ids, snapshot.matrix):
+                self._index.add(entry_id, np.array(vector))
+            if isinstance(self._index, QuantizedIndex):
+                # Re-rank from the mapped float32 rows rather than a resident copy
+                self._index.attach(snapshot.ids, snapshot.matrix)
+        self.version, self._delta_offset, self._delta_count = snapshot.version, 0, 0
+        logger.info(f"Loaded gallery snapshot v{snapshot.version} ({len(snapshot.ids)} faces)")
+
+    def _adopt(self, version: int) -> bool:
+        # version holds exactly the state already in memory (we published it, or it compacts
+        # the log we replayed): keep the built index and only move float32 rows to its mapping
+        if self._shares_mapping() or isinstance(self._index, QuantizedIndex):
+            snapshot = self._store.load(version)
+            if snapshot is None:
+                return False
+            if self._shares_mapping():
+                self._load_snapshot(snapshot)
+            else:
+                self._index.attach(snapshot.ids, snapshot.matrix)
+        self.version, self._delta_offset, self._delta_count = version, 0, 0
+        return True
+
+    def _apply_deltas(self):
+        records, self._delta_offset = self._store.read_deltas(self.version, self._delta_offset)
+        for record in records:
+            if record["op"] == "remove":
+                self._remove(record["id"])
+            else:
+                self._upsert(record["id"], _unpack(record["embedding"]), record.get("meta"),
+                             [_unpack(t) for t in record.get("templates") or []])
+            self._delta_count += 1
+
+    @contextmanager
+    def _write(self, compact: bool = False):
+        # Yields a list for the delta records of the write; they are appended to the current
+        # version's log, or a full version is published (compact, first write, log full)
+        with self._lock:
+            deltas = []
+            if self._store is None:
+                yield deltas
+                return
+            with self._store.locked():
+                # Apply on top of whatever other workers wrote last
+                self._refresh(force=True)
+                yield deltas
+                if compact or self.version is None:
+                    self._publish()
+                    return
+                for record in deltas:
+                    self._delta_offset = self._store.append_delta(self.version, record)
+                    self._delta_count += 1
+                if self._delta_count >= self._compact_after:
+                    self._publish(base=(self.version, self._delta_count))
+
+    def _publish(self, base: Optional[Tuple[int, int]] = None):
+        # base: (version, delta count) the published state equals, so replaying readers can adopt it
+        ids, matrix = self._index.vectors() if self._index is not None else ([], np.zeros((0, self.dim or 0), dtype=np.float32))
+        extra = {"base_version": base[0], "base_deltas": base[1]} if base else None
+        version = self._store.publish(ids, [self._meta.get(i, {}) for i in ids], matrix, extra=extra,
+                                      templates=self._templates)
+        self._adopt(version)
+
+    # Writes
+
+    def rebuild(self, entries: List[tuple]):
+        """Replace the whole gallery with (id, embedding, meta[, templates]) entries"""
+        with self._write(compact=True):
+            self._index, self._meta, self._templates, self.dim = None, {}, {}, None
+            for entry in entries:
+                self._upsert(*entry)
+
+    def upsert(self, entry_id: str, embedding: np.ndarray, meta: Optional[dict] = None,
+               templates: Optional[List[np.ndarray]] = None):
+        """Add an entry or replace its embedding. With templates, embedding is searched as the
+        user's centroid and close candidates are re-ranked on their templates."""
+        with self._write() as deltas:
+            self._upsert(entry_id, embedding, meta, templates)
+            deltas.append({"op": "upsert", "id": entry_id, "embedding": _pack(embedding), "meta": meta or {},
+                           "templates": [_pack(t) for t in templates or []]})
+
+    def _upsert(self, entry_id: str, embedding: np.ndarray, meta: Optional[dict],
+                templates: Optional[List[np.ndarray]] = None):
+        vector = normalize(np.asarray(embedding, dtype=np.float32).reshape(-1))
+        if self._index is None:
+            self.dim = vector.shape[0]
+            self._index = self._new_index(self.dim)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Embedding dimension {vector.shape[0]} does not match gallery dimension {self.dim}")
+        self._index.add(entry_id, vector)
+        self._meta[entry_id] = meta or {}
+        self._templates.pop(entry_id, None)
+        if templates:
+            rows = normalize(np.vstack([np.asarray(t, dtype=np.float32).reshape(-1) for t in templates]))
+            if rows.shape[1] == self.dim:
+                self._templates[entry_id] = rows
+
+    def remove(self, entry_id: str) -> bool:
+        with self._write() as deltas:
+            removed = self._remove(entry_id)
+            deltas.append({"op": "remove", "id": entry_id})
+            return removed
+
+    def _remove(self, entry_id: str) -> bool:
+        self._meta.pop(entry_id, None)
+        self._templates.pop(entry_id, None)
+        if self._index is None:
+            return False
+        return self._index.remove(entry_id)
+
+    # Reads
+
+    def check(self, entries: List[Tuple[str, np.ndarray]]) -> dict:
+        """Diff the index against (id, embedding) pairs from the source of truth"""
+        with self._lock:
+            self._refresh()
+            ids, matrix = self._index.vectors() if self._index is not None else ([], None)
+            held = {entry_id: i for i, entry_id in enumerate(ids)}
+            missing, stale = [], []
+            truth = set()
+            for entry_id, embedding in entries:
+                truth.add(entry_id)
+                i = held.get(entry_id)
+                if i is None:
+                    missing.append(entry_id)
+                    continue
+                vector = normalize(np.asarray(embedding, dtype=np.float32).reshape(-1))
+                # Quantized rows without a float32 copy are only approximately equal
+                if vector.shape[0] != matrix.shape[1] or float(matrix[i] @ vector) < 0.999:
+                    stale.append(entry_id)
+            extra = [entry_id for entry_id in ids if entry_id not in truth]
+            return {
+                "consistent": not (missing or stale or extra),
+                "size": len(ids),
+                "missing": missing,
+                "stale": stale,
+                "extra": extra
+            }
+
+    def identify(self, embedding: np.ndarray, top_k: int = 1, threshold: Optional[float] = None) -> List[dict]:
+        """Best matches above threshold (default FACE_SIMILARITY_THRESHOLD), best first"""
+        if threshold is None:
+            threshold = _config("FACE_SIMILARITY_THRESHOLD", 0.8)
+        query = normalize(np.asarray(embedding, dtype=np.float32).reshape(-1))
+        with self._lock:
+            self._refresh()
+            if self._index is None or query.shape[0] != self.dim:
+                return []
+            if not self._templates:
+                hits = self._index.search(query, top_k)
+            else:
+                hits = self._rerank(query, top_k, threshold)
+            return [
+                {"id": entry_id, "similarity": score, "meta": self._meta.get(entry_id, {})}
+                for entry_id, score in hits if score > threshold
+            ]
+
+    def _rerank(self, query: np.ndarray, top_k: int, threshold: float) -> List[Tuple[str, float]]:
+        # First pass on centroids (one row per user); candidates within the margin below the
+        # threshold are re-scored as their best template, so the cost stays one row per user
+        margin = _config("TEMPLATE_RERANK_MARGIN", 0.1)
+        candidates = self._index.search(query, max(top_k, _config("TEMPLATE_CANDIDATES", 10)))
+        hits = []
+        for entry_id, score in candidates:
+            templates = self._templates.get(entry_id)
+            if templates is not None and score > threshold - margin:
+                score = max(score, float(np.max(templates @ query)))
+            hits.append((entry_id, score))
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:top_k]
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh()
+            stats = {"backend": self.backend, "size": len(self), "dim": self.dim,
+                     "multi_template": len(self._templates)}
+            if isinstance(self._index, QuantizedIndex):
+                stats["quantization"] = str(self._index.codes.dtype)
+                stats["bytes"] = self._index.nbytes()
+            if self._store is not None:
+                stats["snapshot_version"] = self.version
+                stats["snapshot_deltas"] = self._delta_count
+                stats["shared"] = isinstance(self._index, MappedIndex)
+            return stats
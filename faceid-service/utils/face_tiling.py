@@ -0,0 +1,50 @@
+import numpy as np
+from typing import List, Tuple
+
+
+def tile_grid(width: int, height: int, tile: int, overlap: float) -> List[Tuple[int, int, int, int]]:
+    """Overlapping (x0, y0, x1, y1) tiles of at most tile x tile covering a width x height image.
+    Neighbouring tiles share about overlap * tile pixels, so a face smaller than that is
+    whole in at least one tile."""
+    stride = max(1, int(tile * (1.0 - overlap)))
+
+    def starts(size: int) -> List[int]:
+        if size <= tile:
+            return [0]
+        positions = list(range(0, size - tile, stride))
+        positions.append(size - tile)  # last tile flush with the edge
+        return positions
+
+    return [(x, y, min(x + tile, width), min(y + tile, height))
+            for y in starts(height) for x in starts(width)]
+
+
+def touches_inner_edge(box: np.ndarray, tile: Tuple[int, int, int, int], width: int, height: int,
+                       margin: float = 2.0) -> bool:
+    """True if a box (tile coordinates) is cut by a tile edge that lies inside the image.
+    Such a face is truncated here and whole in a neighbouring tile."""
+    x0, y0, x1, y1 = tile
+    return ((x0 > 0 and box[0] <= margin) or (y0 > 0 and box[1] <= margin)
+            or (x1 < width and box[2] >= (x1 - x0) - margin)
+            or (y1 < height and box[3] >= (y1 - y0) - margin))
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> List[int]:
+    """Greedy non-maximum suppression; indices of kept boxes, highest score first"""
+    if len(boxes) == 0:
+        return []
+    boxes = np.asarray(boxes, dtype=np.float32)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    order = np.argsort(-np.asarray(scores))
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(int(i))
+        rest = order[1:]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        h = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = w * h
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return keep
@@ -0,0 +1,107 @@
+import numpy as np
+from typing import List, Optional
+
+
+def iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Pairwise IoU of two sets of [x1, y1, x2, y2] boxes (len(a) x len(b))"""
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)), dtype=np.float32)
+    a = np.asarray(a, dtype=np.float32)[:, None, :4]
+    b = np.asarray(b, dtype=np.float32)[None, :, :4]
+    w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = w * h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+
+class Track:
+    """One face followed across sampled frames. Embeddings are added by the caller for a few
+    of its frames only; embedding() is their normalized mean."""
+
+    def __init__(self, track_id: int, box: np.ndarray, score: float, frame: int, timestamp: float):
+        self.track_id = track_id
+        self.box = box
+        self.hits = 1
+        self.first_frame = self.last_frame = frame
+        self.first_seen = self.last_seen = timestamp
+        self.best_score = score
+        self.best_box = box
+        self.best_crop: Optional[np.ndarray] = None  # BGR face crop of the best embedded frame
+        self.embeddings: List[np.ndarray] = []
+        self.last_embedded = -1
+
+    def update(self, box: np.ndarray, score: float, frame: int, timestamp: float):
+        self.box = box
+        self.hits += 1
+        self.last_frame = frame
+        self.last_seen = timestamp
+        if score > self.best_score:
+            self.best_score = score
+            self.best_box = box
+
+    def wants_embedding(self, frame: int, per_track: int, gap: int) -> bool:
+        """Embed on the first frame, then every gap frames until per_track embeddings are held"""
+        return len(self.embeddings) < per_track and (self.last_embedded < 0 or frame - self.last_embedded >= gap)
+
+    def add_embedding(self, embedding: np.ndarray, frame: int):
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            self.embeddings.append(np.asarray(embedding, dtype=np.float32) / norm)
+        self.last_embedded = frame
+
+    def embedding(self) -> Optional[np.ndarray]:
+        if not self.embeddings:
+            return None
+        mean = np.mean(self.embeddings, axis=0)
+        norm = np.linalg.norm(mean)
+        return mean / norm if norm > 0 else None
+
+
+class IoUTracker:
+    """Greedy IoU association of detections to the tracks seen in the last max_age sampled
+    frames. Cheap enough to run on every sampled frame; identity comes from the embeddings."""
+
+    def __init__(self, iou_threshold: float = 0.3, max_age: int = 4):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.active: List[Track] = []
+        self.finished: List[Track] = []
+        self._next_id = 1
+
+    def update(self, boxes: np.ndarray, scores: np.ndarray, frame: int, timestamp: float) -> List[Track]:
+        """Assign this frame's detections; returns the track of each detection, in order"""
+        self._expire(frame)
+        assigned: List[Optional[Track]] = [None] * len(boxes)
+        if self.active and len(boxes):
+            overlaps = iou_matrix(np.array([t.box for t in self.active]), boxes)
+            # Highest overlaps first; each track and detection is used once
+            for flat in np.argsort(-overlaps, axis=None):
+                t, d = np.unravel_index(flat, overlaps.shape)
+                if overlaps[t, d] < self.iou_threshold:
+                    break
+                track = self.active[t]
+                if assigned[d] is not None or track.last_frame == frame:
+                    continue
+                track.update(boxes[d], float(scores[d]), frame, timestamp)
+                assigned[d] = track
+        for d in range(len(boxes)):
+            if assigned[d] is None:
+                track = Track(self._next_id, boxes[d], float(scores[d]), frame, timestamp)
+                self._next_id += 1
+                self.active.append(track)
+                assigned[d] = track
+        return assigned
+
+    def _expire(self, frame: int):
+        alive = []
+        for track in self.active:
+            (alive if frame - track.last_frame <= self.max_age else self.finished).append(track)
+        self.active = alive
+
+    def close(self) -> List[Track]:
+        """End every track; returns all tracks in order of appearance"""
+        self.finished.extend(self.active)
+        self.active = []
+        return sorted(self.finished, key=lambda t: t.track_id)
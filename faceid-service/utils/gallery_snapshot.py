@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import threading
+import numpy as np
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within one process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = ".lock"
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "ids.json"
+TEMPLATES_FILE = "templates.npy"
+DELTAS_FILE = "deltas.jsonl"
+
+
+class Snapshot:
+    """One published gallery version: a read-only memory-mapped matrix of normalized float32
+    rows plus the id and meta of each row. Pages are shared between every process mapping
+    the same version through the OS page cache."""
+
+    def __init__(self, version: int, ids: List[str], meta: List[dict], matrix: np.ndarray, manifest: dict,
+                 templates: Optional[Dict[str, np.ndarray]] = None):
+        self.version = version
+        self.ids = ids
+        self.meta = meta
+        self.matrix = matrix
+        self.manifest = manifest
+        self.templates = templates or {}  # id -> rows of the mapped templates matrix
+
+
+def _checksum(paths: List[str]) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _fsync(path: str):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+class SnapshotStore:
+    """Versioned gallery snapshots under one directory:
+
+        <directory>/v<N>/{vectors.npy, templates.npy, ids.json, manifest.json}
+        <directory>/v<N>/deltas.jsonl  (writes applied on top of v<N>, appended in order)
+        <directory>/CURRENT  -> "v<N>"
+
+    A version is written to a temp directory, checksummed and renamed into place, then
+    CURRENT is swapped with os.replace, so readers only ever see complete versions.
+    Single writes are appended to the current version's delta log instead of publishing
+    a new version each time."""
+
+    def __init__(self, directory: str, keep: int = 3, verify: bool = True):
+        self.directory = directory
+        self.keep = keep
+        self.verify = verify
+        self._thread_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """Exclusive writer lock across threads and (where flock exists) processes"""
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, LOCK_FILE), "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def current_version(self) -> Optional[int]:
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE), "r", encoding="utf-8") as f:
+                return int(f.read().strip().lstrip("v"))
+        except (OSError, ValueError):
+            return None
+
+    def _versions(self) -> List[int]:
+        versions = []
+        for name in os.listdir(self.directory):
+            if name.startswith("v") and name[1:].isdigit():
+                versions.append(int(name[1:]))
+        return sorted(versions)
+
+    def publish(self, ids: List[str], meta: List[dict], matrix: np.ndarray, extra: Optional[Dict] = None,
+                templates: Optional[Dict[str, np.ndarray]] = None) -> int:
+        """Write a new version and make it current. Returns the version number.
+        templates maps an id to its extra template rows (multi-template enrollment)."""
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        templates = {i: t for i, t in (templates or {}).items() if len(t)}
+        slices, offset = {}, 0
+        for entry_id, rows in templates.items():
+            slices[entry_id] = [offset, len(rows)]
+            offset += len(rows)
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.directory)
+        try:
+            vectors_path = os.path.join(staging, VECTORS_FILE)
+            templates_path = os.path.join(staging, TEMPLATES_FILE)
+            ids_path = os.path.join(staging, IDS_FILE)
+            np.save(vectors_path, matrix)
+            template_rows = [templates[i] for i in slices]
+            np.save(templates_path, np.vstack(template_rows).astype(np.float32) if template_rows
+                    else np.zeros((0, matrix.shape[1] if matrix.ndim == 2 else 0), dtype=np.float32))
+            with open(ids_path, "w", encoding="utf-8") as f:
+                json.dump([{"id": i, "meta": m, **({"templates": slices[i]} if i in slices else {})}
+                           for i, m in zip(ids, meta)], f)
+            for path in (vectors_path, templates_path, ids_path):
+                _fsync(path)
+
+            manifest = {
+                "count": len(ids),
+                "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+                "sha256": _checksum([vectors_path, templates_path, ids_path]),
+                "created_at": time.time(),
+                **(extra or {})
+            }
+
+            # Another process may publish concurrently; take the next free version number
+            version = (self._versions() or [0])[-1] + 1
+            while True:
+                manifest["version"] = version
+                with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+                    json.dump(manifest, f)
+                try:
+                    os.rename(staging, os.path.join(self.directory, f"v{version}"))
+                    break
+                except OSError:
+                    if not os.path.exists(os.path.join(self.directory, f"v{version}")):
+                        raise
+                    version += 1
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        pointer = os.path.join(self.directory, f".{CURRENT_FILE}.{os.getpid()}")
+        with open(pointer, "w", encoding="utf-8") as f:
+            f.write(f"v{version}")
+            f.flush()
+            os.fsync(f.fileno())
+        # Never move CURRENT backwards if a newer version landed meanwhile
+        current = self.current_version()
+        if current is None or current < version:
+            os.replace(pointer, os.path.join(self.directory, CURRENT_FILE))
+        else:
+            os.remove(pointer)
+        self._prune()
+        logger.info(f"Published gallery snapshot v{version} ({len(ids)} faces)")
+        return version
+
+    def manifest(self, version: int) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.directory, f"v{version}", MANIFEST_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def append_delta(self, version: int, record: dict) -> int:
+        """Append one write to version's delta log (hold locked()). Returns the log size after it."""
+        path = os.path.join(self.directory, f"v{version}", DELTAS_FILE)
+        with open(path, "ab") as f:
+            f.write((json.dumps(record) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def read_deltas(self, version: int, offset: int = 0) -> Tuple[List[dict], int]:
+        """Records appended to version's delta log after byte offset, and the offset past them.
+        A line still being written is left for the next read."""
+        try:
+            with open(os.path.join(self.directory, f"v{version}", DELTAS_FILE), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return [], offset
+        end = data.rfind(b"\n") + 1
+        return [json.loads(line) for line in data[:end].splitlines() if line.strip()], offset + end
+
+    def load(self, version: Optional[int] = None) -> Optional[Snapshot]:
+        """Map a version (default: current) read-only, or None if there is none or it fails verification."""
+        version = version if version is not None else self.current_version()
+        if version is None:
+            return None
+        path = os.path.join(self.directory, f"v{version}")
+        try:
+            with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            vectors_path = os.path.join(path, VECTORS_FILE)
+            templates_path = os.path.join(path, TEMPLATES_FILE)
+            ids_path = os.path.join(path, IDS_FILE)
+            if self.verify and _checksum([vectors_path, templates_path, ids_path]) != manifest.get("sha256"):
+                logger.error(f"Gallery snapshot v{version} failed checksum verification")
+                return None
+            with open(ids_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            # Zero-row arrays are loaded plainly; there is nothing to share
+            matrix = np.load(vectors_path, mmap_mode="r" if entries else None)
+            has_templates = any(e.get("templates") for e in entries)
+            template_matrix = np.load(templates_path, mmap_mode="r" if has_templates else None)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load gallery snapshot v{version}: {str(e)}")
+            return None
+        if matrix.shape[0] != len(entries):
+            logger.error(f"Gallery snapshot v{version} has {matrix.shape[0]} rows but {len(entries)} ids")
+            return None
+        templates = {
+            e["id"]: template_matrix[e["templates"][0]:e["templates"][0] + e["templates"][1]]
+            for e in entries if e.get("templates")
+        }
+        return Snapshot(version, [e["id"] for e in entries], [e.get("meta") or {} for e in entries], matrix, manifest,
+                        templates)
+
+    def _prune(self):
+        # Unlinked versions stay readable for processes that still map them (POSIX)
+        for version in self._versions()[:-self.keep]:
+            shutil.rmtree(os.path.join(self.directory, f"v{version}"), ignore_errors=True)
@@ -29,6 +29,43 @@ class FaceRecognizer:
             logger.error(f"Error in embedding comparison: {str(e)}")
             return False, 0.0
     
+    @staticmethod
+    def select_templates(embeddings, sharpness, det_scores=None, max_templates=None, min_similarity=None,
+                         dedup_similarity=None):
+        """
+        Pick up to max_templates good embeddings of one face from a frame sequence
+        Frames are taken best first by quality (sharpness x detection score); similarity is only
+        used to skip a frame that duplicates a kept template (above dedup_similarity) or is
+        another face (below min_similarity to the best frame), so blurred or badly detected
+        outliers are never preferred for being different.
+        Returns: (templates, centroid) as normalized float32 arrays
+        """
+        from thresholds_config import TEMPLATE_MAX, TEMPLATE_MIN_SIMILARITY, TEMPLATE_DEDUP_SIMILARITY
+        max_templates = TEMPLATE_MAX if max_templates is None else max_templates
+        min_similarity = TEMPLATE_MIN_SIMILARITY if min_similarity is None else min_similarity
+        dedup_similarity = TEMPLATE_DEDUP_SIMILARITY if dedup_similarity is None else dedup_similarity
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        quality = np.asarray(sharpness, dtype=np.float32)
+        if det_scores is not None:
+            quality = quality * np.asarray(det_scores, dtype=np.float32)
+        order = np.argsort(-quality, kind="stable")
+        anchor = int(order[0])
+        same_face = vectors @ vectors[anchor] >= min_similarity
+
+        chosen = [anchor]
+        for i in order[1:]:
+            if len(chosen) >= max_templates:
+                break
+            if same_face[i] and float(np.max(vectors[chosen] @ vectors[i])) < dedup_similarity:
+                chosen.append(int(i))
+
+        templates = vectors[chosen]
+        centroid = templates.mean(axis=0)
+        centroid /= np.linalg.norm(centroid)
+        return templates, centroid.astype(np.float32)
+
     @staticmethod
     def embedding_to_base64(embedding):
         """Convert numpy array to base64 string"""
@@ -3,6 +3,9 @@ import base64
 import numpy as np
 from typing import Dict, Any, Optional, List, Tuple
 import logging
+import json
+import threading
+import time
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +20,15 @@ class APIController:
         self.user_url = user_url.rstrip("/")
         self.timeout = 30
         self.max_retries = 3
+        # Bodies of conditional GETs keyed by (url, params): (ETag, Last-Modified, body)
+        self._validator_cache: Dict[Tuple[str, tuple], Tuple[Optional[str], Optional[str], Dict[str, Any]]] = {}
+        # Dashboard state kept up to date from the user-service change feed
+        self._feed_state = None
+        # Pushed updates (server-sent events); event_version increases on every applied push
+        self._feed_cond = threading.Condition()
+        self._subscriber = None
+        self._subscribed = False
+        self.event_version = 0
     
     def _make_request(self, method: str, url: str, **kwargs) -> requests.Response:
         kwargs.setdefault('timeout', self.timeout)
@@ -45,6 +57,29 @@ class APIController:
             error_msg = data.get("message", f"HTTP {response.status_code}")
             raise Exception(error_msg)
     
+    def _get_cached(self, url: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # GET with If-None-Match/If-Modified-Since; a 304 reuses the cached body
+        key = (url, tuple(sorted((params or {}).items())))
+        cached = self._validator_cache.get(key)
+        headers = {}
+        if cached:
+            if cached[0]:
+                headers["If-None-Match"] = cached[0]
+            if cached[1]:
+                headers["If-Modified-Since"] = cached[1]
+        
+        response = self._make_request("GET", url, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[2]
+        
+        data = self._handle_response(response)
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._validator_cache[key] = (etag, last_modified, data)
+        else:
+            self._validator_cache.pop(key, None)
+        return data
+    
     def check_faceid_service(self) -> bool:
         try:
             response = self._make_request("GET", f"{self.faceid_url}/health")
@@ -56,8 +91,8 @@ class APIController:
     
     def check_user_service(self) -> bool:
         try:
-            response = self._make_request("GET", f"{self.user_url}/api/students")
-            return response.status_code in [200, 500]
+            response = self._make_request("GET", f"{self.user_url}/health")
+            return response.status_code == 200
         except Exception as e:
             logger.error(f"User service check failed: {str(e)}")
             return False
@@ -120,12 +155,49 @@ class APIController:
     
     def get_students_list(self) -> Dict[str, Any]:
         try:
-            response = self._make_request("GET", f"{self.user_url}/api/students")
-            return self._handle_response(response)
+            # Embeddings are not requested; follow cursor pages until the last one
+            params = {"fields": "student_id,username,full_name,class_name", "limit": 500}
+            result = None
+            while True:
+                page = self._get_cached(f"{self.user_url}/api/students", params)
+                if result is None:
+                    result = {**page, "students": list(page.get("students", []))}
+                else:
+                    result["students"].extend(page.get("students", []))
+                if not page.get("next_cursor"):
+                    break
+                # Attendance is the same for every page; only fetch it once
+                params = {**params, "cursor": page["next_cursor"], "attendance": "0"}
+            result.pop("next_cursor", None)
+            return result
         except Exception as e:
             logger.error(f"Get students list failed: {str(e)}")
             return {"students": [], "attendance": [], "storage": "unknown"}
     
+    def get_users_list(self) -> Dict[str, Any]:
+        try:
+            users, params = [], {"limit": 500}
+            while True:
+                page = self._get_cached(f"{self.user_url}/api/users", params)
+                users.extend(page.get("users", []))
+                if not page.get("next_cursor"):
+                    break
+                params = {**params, "cursor": page["next_cursor"]}
+            return {"success": True, "total": len(users), "users": users}
+        except Exception as e:
+            logger.error(f"Get users list failed: {str(e)}")
+            return {"success": False, "users": [], "message": str(e)}
+    
+    def get_daily_attendance(self, date_str: str, class_id: Optional[str] = None) -> Dict[str, Any]:
+        try:
+            params = {"date": date_str}
+            if class_id:
+                params["classId"] = class_id
+            return self._get_cached(f"{self.user_url}/api/attendance/daily", params)
+        except Exception as e:
+            logger.error(f"Get daily attendance failed: {str(e)}")
+            return {"success": False, "message": str(e)}
+    
     def register_student(self, student_data: Dict[str, Any], 
                         image_bytes: Optional[bytes] = None,
                         frames: Optional[List[bytes]] = None) -> Dict[str, Any]:
@@ -159,24 +231,37 @@ class APIController:
             logger.error(f"Student registration failed: {str(e)}")
             raise Exception(f"Student registration failed: {str(e)}")
     
-    def checkin_student(self, image_bytes: bytes) -> Dict[str, Any]:
+    def checkin_student(self, image_bytes: bytes, kiosk_id: Optional[str] = None) -> Dict[str, Any]:
         try:
             files = {"file": ("face.jpg", image_bytes, "image/jpeg")}
-            response = self._make_request("POST", f"{self.user_url}/api/checkin", files=files)
+            # kiosk_id: frames of one person in front of this kiosk are tracked and identified once
+            data = {"kiosk_id": kiosk_id} if kiosk_id else None
+            response = self._make_request("POST", f"{self.user_url}/api/checkin", files=files, data=data)
             return self._handle_response(response)
         except Exception as e:
             logger.error(f"Check-in failed: {str(e)}")
             raise Exception(f"Check-in failed: {str(e)}")
     
-    def checkout_student(self, image_bytes: bytes) -> Dict[str, Any]:
+    def checkout_student(self, image_bytes: bytes, kiosk_id: Optional[str] = None) -> Dict[str, Any]:
         try:
             files = {"file": ("face.jpg", image_bytes, "image/jpeg")}
-            response = self._make_request("POST", f"{self.user_url}/api/checkout", files=files)
+            # kiosk_id: frames of one person in front of this kiosk are tracked and identified once
+            data = {"kiosk_id": kiosk_id} if kiosk_id else None
+            response = self._make_request("POST", f"{self.user_url}/api/checkout", files=files, data=data)
             return self._handle_response(response)
         except Exception as e:
             logger.error(f"Check-out failed: {str(e)}")
             raise Exception(f"Check-out failed: {str(e)}")
     
+    def end_kiosk_track(self, kiosk_id: str) -> bool:
+        # Next person at the kiosk: drop its server-side face track
+        try:
+            response = self._make_request("DELETE", f"{self.user_url}/api/kiosk/{kiosk_id}/track")
+            return bool(self._handle_response(response).get("ended"))
+        except Exception as e:
+            logger.warning(f"Ending kiosk track failed: {str(e)}")
+            return False
+    
     def get_attendance_summary(self, date_str: str) -> Dict[str, Any]:
         try:
             params = {"date": date_str}
@@ -187,36 +272,122 @@ class APIController:
             logger.error(f"Get attendance summary failed: {str(e)}")
             return {"success": False, "message": str(e)}
     
+    def get_attendance_statuses(self, date_str: str, student_ids: Optional[List[str]] = None) -> Dict[str, str]:
+        # Status of every student (or of student_ids) for a date, in one request
+        params = {"date": date_str}
+        if student_ids is not None:
+            params["student_ids"] = ",".join(student_ids)
+        return self._get_cached(f"{self.user_url}/api/attendance-status", params).get("statuses", {})
+    
     def check_student_attendance_status(self, student_id: str, date_str: str) -> str:
         try:
-            summary_res = self.get_attendance_summary(date_str)
-            if summary_res.get("success"):
-                summary = summary_res.get("summary", [])
-                for item in summary:
-                    if item.get("student_id") == student_id:
-                        has_checkin = bool(item.get("checkin"))
-                        has_checkout = bool(item.get("checkout"))
-                        if has_checkin and has_checkout:
-                            return "completed"
-                        elif has_checkin:
-                            return "checked_in"
-                        else:
-                            return "not_checked"
-            return "not_checked"
+            return self.get_attendance_statuses(date_str, [student_id]).get(student_id, "not_checked")
         except Exception as e:
             logger.error(f"Check attendance status failed: {str(e)}")
             return "error"
     
+    def get_changes(self, cursor: Optional[str] = None) -> Dict[str, Any]:
+        params = {"cursor": cursor} if cursor else {}
+        response = self._make_request("GET", f"{self.user_url}/api/changes", params=params)
+        return self._handle_response(response)
+    
+    def _apply_changes(self, delta: Dict[str, Any]):
+        # Merge a /changes payload into the local state; must be called with _feed_cond held
+        state = self._feed_state
+        if delta.get("reset") or state is None:
+            state = {"students": {}, "attendance": [], "seen": set(), "date": delta.get("date")}
+        elif state["date"] != delta.get("date"):
+            # New day: yesterday's attendance no longer applies
+            state["attendance"], state["seen"], state["date"] = [], set(), delta.get("date")
+        
+        for student in delta.get("students", []):
+            state["students"][student.get("student_id")] = student
+        for event in delta.get("attendance", []):
+            key = (event.get("student_id"), event.get("type"), event.get("timestamp"))
+            if event.get("date", state["date"]) == state["date"] and key not in state["seen"]:
+                state["seen"].add(key)
+                state["attendance"].append(event)
+        
+        state["cursor"] = delta.get("cursor")
+        self._feed_state = state
+    
+    def _sync_feed_state(self) -> Dict[str, Any]:
+        # While subscribed, pushes keep the state current; otherwise pull the deltas since the last refresh
+        with self._feed_cond:
+            if self._subscribed and self._feed_state is not None:
+                return self._feed_state
+            cursor = self._feed_state["cursor"] if self._feed_state else None
+        delta = self.get_changes(cursor)
+        with self._feed_cond:
+            self._apply_changes(delta)
+            return self._feed_state
+    
+    def subscribe_events(self):
+        # Start (once) the background subscription to the user-service event stream
+        with self._feed_cond:
+            if self._subscriber is None:
+                self._subscriber = threading.Thread(target=self._run_subscriber, name="user-events", daemon=True)
+                self._subscriber.start()
+    
+    def wait_for_event(self, version: int, timeout: float) -> int:
+        # Block until a push newer than version arrives (or timeout); returns the current version
+        with self._feed_cond:
+            self._feed_cond.wait_for(lambda: self.event_version != version, timeout=timeout)
+            return self.event_version
+    
+    def _run_subscriber(self):
+        backoff = 1
+        while True:
+            with self._feed_cond:
+                cursor = self._feed_state["cursor"] if self._feed_state else None
+            headers = {"Accept": "text/event-stream"}
+            if cursor:
+                headers["Last-Event-ID"] = cursor
+            try:
+                # Read timeout well above the server's 15s keepalive so dead connections are noticed
+                with requests.get(f"{self.user_url}/api/events", headers=headers,
+                                  stream=True, timeout=(5, 60)) as response:
+                    response.raise_for_status()
+                    backoff = 1
+                    with self._feed_cond:
+                        # The server resumes from Last-Event-ID, so nothing missed while disconnected is lost
+                        self._subscribed = True
+                    event, data = None, []
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line is None:
+                            continue
+                        if line == "":
+                            if event == "changes" and data:
+                                self._on_push(json.loads("\n".join(data)))
+                            event, data = None, []
+                        elif line.startswith("event:"):
+                            event = line[6:].strip()
+                        elif line.startswith("data:"):
+                            data.append(line[5:].strip())
+            except Exception as e:
+                logger.warning(f"Event stream disconnected: {str(e)}")
+            
+            with self._feed_cond:
+                self._subscribed = False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+    
+    def _on_push(self, delta: Dict[str, Any]):
+        with self._feed_cond:
+            self._apply_changes(delta)
+            self.event_version += 1
+            self._feed_cond.notify_all()
+    
     def get_dashboard_data(self) -> Dict[str, Any]:
         try:
-            students_data = self.get_students_list()
-            students = students_data.get("students", [])
-            attendance = students_data.get("attendance", [])
+            state = self._sync_feed_state()
+            students = list(state["students"].values())
+            attendance = list(state["attendance"])
             
             total_students = len(students)
             present_today = len([a for a in attendance if a.get("type") in ["checkin", "attendance"]])
             
-            today = datetime.now().strftime("%Y-%m-%d")
+            today = state["date"] or datetime.now().strftime("%Y-%m-%d")
             
             return {
                 "total_students": total_students,
@@ -19,13 +19,15 @@ def handle_attendance_submission():
         return
     
     attendance_type = determine_attendance_action()
+    # Continuous (kiosk) mode: the server tracks the person across captures and identifies them once
+    kiosk_id = st.session_state.get('kiosk_id') if st.session_state.get('continuous_mode', True) else None
     
     with st.spinner("Submitting student attendance..."):
         try:
             if attendance_type == "checkin":
-                response = api_controller.checkin_student(face_bytes)
+                response = api_controller.checkin_student(face_bytes, kiosk_id)
             elif attendance_type == "checkout":
-                response = api_controller.checkout_student(face_bytes)
+                response = api_controller.checkout_student(face_bytes, kiosk_id)
             else:
                 st.warning("Invalid attendance status!")
                 return
@@ -190,6 +192,8 @@ def handle_continuous_mode():
         st.session_state.attendance_status = 'not_started'
         st.session_state.attendance_scan_count = 0
         st.session_state.current_student_id = None
+        if st.session_state.get('kiosk_id'):
+            api_controller.end_kiosk_track(st.session_state.kiosk_id)
     
     reset_attendance_states()
     
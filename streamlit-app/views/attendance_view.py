@@ -2,6 +2,7 @@ import streamlit as st
 import cv2
 import numpy as np
 import time
+import uuid
 import logging
 from datetime import datetime
 from streamlit_webrtc import webrtc_streamer, WebRtcMode
@@ -42,6 +43,9 @@ def render_attendance():
         st.session_state.attendance_status = 'not_started'
     if 'continuous_mode' not in st.session_state:
         st.session_state.continuous_mode = True
+    if 'kiosk_id' not in st.session_state:
+        # Identifies this kiosk's stream to the user-service face tracks
+        st.session_state.kiosk_id = uuid.uuid4().hex
     if 'current_student_id' not in st.session_state:
         st.session_state.current_student_id = None
     if 'last_scan_times' not in st.session_state:
@@ -12,6 +12,10 @@ def render_dashboard():
     </div>
     """, unsafe_allow_html=True)
     
+    # Version of the pushed state before the fetch: a push landing during the fetch still triggers a rerun
+    api_controller.subscribe_events()
+    version = api_controller.event_version
+    
     dashboard_data = get_dashboard_data()
     
     render_metrics_cards(dashboard_data)
@@ -19,6 +23,30 @@ def render_dashboard():
     render_attendance_list_by_date(dashboard_data)
     
     render_quick_actions()
+    
+    watch_live_updates(version)
+
+# Seconds between checks for pushed updates (local, no requests)
+LIVE_UPDATE_CHECK = 1.0
+
+def watch_live_updates(version):
+    # Rerun when user-service pushes a check-in/check-out or registration; an idle dashboard sends no requests
+    fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    if fragment is not None:
+        # The script run ends here; the fragment re-checks the in-memory version on a timer
+        @fragment(run_every=LIVE_UPDATE_CHECK)
+        def check():
+            if api_controller.event_version != version:
+                st.rerun()
+        check()
+        return
+    
+    # Older Streamlit: keep the run waiting for a push and rerun only once one has arrived
+    placeholder = st.empty()
+    while api_controller.wait_for_event(version, timeout=LIVE_UPDATE_CHECK) == version:
+        # Touch the page so Streamlit can interrupt the wait when the user interacts
+        placeholder.empty()
+    st.rerun()
 
 def get_dashboard_data():
     try:
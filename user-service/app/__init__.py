@@ -1,7 +1,35 @@
+import threading
 from flask import Flask
 from flask_cors import CORS
 from .controllers.auth_controller import auth_bp
-from .controllers.attendance_controller import attendance_bp
+from .controllers.attendance_controller import attendance_bp, attendance_service
+from .config.settings import Config
+from .utils.face_gallery import face_gallery, index_entry
+from .utils.logger import logger
+from .utils.conditional import versions
+
+def _warm_face_gallery():
+    # Local snapshot + users updated since it was written, instead of streaming the collection
+    try:
+        user_repo = attendance_service.user_repo
+        face_gallery.restore(user_repo.get_gallery_records, user_repo.get_gallery_records_since)
+    except Exception as e:
+        logger.log_error(f"Face gallery warm-up failed: {str(e)}")
+        return
+    
+    # The faceid index lives only as long as faceid-service (without its SNAPSHOT_DIR), so seed it
+    # from the warmed gallery; later writes reach it through the write-behind queue
+    if Config.FACEID_INDEX_SYNC:
+        try:
+            records = face_gallery.records()
+            if records is None:
+                records = attendance_service.user_repo.get_gallery_records()
+            entries = [entry for entry in (index_entry(record) for record in records) if entry]
+            result = attendance_service.face_service.sync_gallery_index(entries)
+            if not result.get("success"):
+                logger.log_error(f"FaceID index seed failed: {result.get('error') or result.get('message')}")
+        except Exception as e:
+            logger.log_error(f"FaceID index seed failed: {str(e)}")
 
 def create_app():
     app = Flask(__name__)
@@ -11,6 +39,13 @@ def create_app():
     app.register_blueprint(auth_bp, url_prefix="/api")
     app.register_blueprint(attendance_bp, url_prefix="/api")
     
+    # Users registered or re-enrolled through other worker processes reach this one's gallery
+    face_gallery.set_sync(lambda: versions.count("users"), attendance_service.user_repo.get_gallery_records_since,
+                          Config.GALLERY_SYNC_INTERVAL / 1000)
+    
+    # Warm the face gallery in the background so the first check-in is served from memory
+    threading.Thread(target=_warm_face_gallery, daemon=True).start()
+    
     # Health check endpoint
     @app.route("/health", methods=["GET"])
     def health_check():
@@ -24,6 +24,39 @@ class Config:
     REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', '2000'))   # 2s
     FACEID_TIMEOUT = int(os.getenv('FACEID_TIMEOUT', '1500'))     # 1.5s (reserve 0.5s for other processing)
     
+    # Write-behind queue for attendance writes (journal + background flush)
+    WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+    WRITE_BEHIND_JOURNAL_DIR = os.getenv('WRITE_BEHIND_JOURNAL_DIR', 'journal')
+    WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '100'))      # Firestore batch limit is 500
+    WRITE_BEHIND_FLUSH_INTERVAL = int(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '200'))  # ms
+    WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', '10'))  # then dead-lettered
+    
+    # History cache for past-date attendance queries (closed dates never change)
+    HISTORY_CACHE_DIR = os.getenv('HISTORY_CACHE_DIR', 'cache')
+    HISTORY_CACHE_MAX_BYTES = int(os.getenv('HISTORY_CACHE_MAX_BYTES', '104857600'))  # 100MB on disk
+    HISTORY_CACHE_MEMORY_ENTRIES = int(os.getenv('HISTORY_CACHE_MEMORY_ENTRIES', '256'))
+    HISTORY_CACHE_TODAY_TTL = int(os.getenv('HISTORY_CACHE_TODAY_TTL', '5000'))  # ms
+    
+    # In-memory face gallery, sharded by class (LRU of loaded classes)
+    GALLERY_MAX_SHARDS = int(os.getenv('GALLERY_MAX_SHARDS', '64'))
+    GALLERY_MATCH_THRESHOLD = float(os.getenv('GALLERY_MATCH_THRESHOLD', '0.8'))  # faceid-service FACE_SIMILARITY_THRESHOLD
+    GALLERY_TEMPLATE_MARGIN = float(os.getenv('GALLERY_TEMPLATE_MARGIN', '0.1'))  # re-rank centroid hits this close on templates
+    GALLERY_SNAPSHOT_PATH = os.getenv('GALLERY_SNAPSHOT_PATH', 'cache/face_gallery.npz')  # empty = no snapshot
+    GALLERY_SYNC_INTERVAL = int(os.getenv('GALLERY_SYNC_INTERVAL', '2000'))  # ms between polls for other workers' user writes
+    FACEID_INDEX_SYNC = os.getenv('FACEID_INDEX_SYNC', 'false').lower() == 'true'  # mirror gallery writes into faceid-service /gallery
+    FACEID_IDENTIFY = os.getenv('FACEID_IDENTIFY', 'false').lower() == 'true'  # identify via faceid-service /identify (needs FACEID_INDEX_SYNC)
+    FACEID_IDENTIFY_TOP_K = int(os.getenv('FACEID_IDENTIFY_TOP_K', '10'))
+    
+    # Kiosk face tracks (continuous check-in: consecutive frames of one person identified once)
+    KIOSK_TRACK_MAX_GAP = int(os.getenv('KIOSK_TRACK_MAX_GAP', '10000'))  # ms between frames of one track
+    KIOSK_TRACK_IOU = float(os.getenv('KIOSK_TRACK_IOU', '0.3'))
+    KIOSK_TRACK_MIN_SIMILARITY = float(os.getenv('KIOSK_TRACK_MIN_SIMILARITY', '0.6'))  # frame vs track average
+    KIOSK_TRACK_MIN_FRAMES = int(os.getenv('KIOSK_TRACK_MIN_FRAMES', '3'))  # frames between re-verifications of a matched track
+    
+    # Offline video ingestion (recorded lectures, see ingest_video.py)
+    VIDEO_MAX_SIZE = int(os.getenv('VIDEO_MAX_SIZE', '1073741824'))  # 1GB
+    VIDEO_TIMEOUT = int(os.getenv('VIDEO_TIMEOUT', '1800'))  # s, faceid-service processing of one video
+    
     # Logging
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
     LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify
 from ..services.attendance_service import AttendanceService
 from ..utils.validators import validate_attendance_request
 from ..utils.logger import logger
+from ..utils.conditional import conditional_json
 import time
 
 attendance_bp = Blueprint("attendance", __name__)
@@ -82,6 +83,46 @@ def mark_attendance_multi():
         logger.log_response(status_code=500, response_time=response_time)
         return jsonify({"success": False, "error": "Server error"}), 500
 
+@attendance_bp.route("/attendance/video", methods=["POST"])
+def mark_attendance_video():
+    # Mark attendance from a recorded lecture video (see ingest_video.py)
+    start_time = time.time()
+    
+    try:
+        # 1. Validate input
+        video = request.files.get("video")
+        if video is None or video.filename == "":
+            logger.log_request("POST", "/attendance/video", error="Video is required")
+            return jsonify({"success": False, "error": "Video is required"}), 400
+        try:
+            sample_fps = float(request.form["sample_fps"]) if request.form.get("sample_fps") else None
+        except ValueError:
+            return jsonify({"success": False, "error": "Invalid sample_fps"}), 400
+        
+        # 2. Call service
+        result = attendance_service.mark_attendance_video(
+            video_file=video,
+            note=request.form.get('note'),
+            class_id=request.form.get('classId'),
+            sample_fps=sample_fps,
+            attendance_date=request.form.get('date'),
+            recorded_at=request.form.get('recorded_at')
+        )
+        
+        response_time = (time.time() - start_time) * 1000
+        logger.log_response(
+            status_code=200 if result["success"] else 400,
+            response_time=response_time
+        )
+        
+        return jsonify(result), 200 if result["success"] else 400
+        
+    except Exception as e:
+        response_time = (time.time() - start_time) * 1000
+        logger.log_error(str(e))
+        logger.log_response(status_code=500, response_time=response_time)
+        return jsonify({"success": False, "error": "Server error"}), 500
+
 @attendance_bp.route("/attendance/daily", methods=["GET"])
 def get_daily_attendance():
     # Get attendance list by date
@@ -95,15 +136,20 @@ def get_daily_attendance():
         limit = int(request.args.get('limit', 100))
         class_id = request.args.get('classId')  # Support classId
         
-        result = attendance_service.get_daily_attendance(attendance_date, limit, class_id)
+        def build():
+            result = attendance_service.get_daily_attendance(attendance_date, limit, class_id)
+            return result, 200 if result["success"] else 400
+        
+        # Records embed user info, so the response depends on both collections
+        response = conditional_json(["users", f"attendance:{attendance_date}"], build)
         
         response_time = (time.time() - start_time) * 1000
         logger.log_response(
-            status_code=200 if result["success"] else 400,
+            status_code=response.status_code,
             response_time=response_time
         )
         
-        return jsonify(result), 200 if result["success"] else 400
+        return response
         
     except Exception as e:
         response_time = (time.time() - start_time) * 1000
@@ -180,24 +226,74 @@ def get_attendance_stats():
         if not start_date or not end_date:
             return jsonify({"success": False, "error": "Missing start_date or end_date"}), 400
         
-        # This would need to be implemented in AttendanceService
-        # For now, return a placeholder
-        result = {
-            "success": True,
-            "start_date": start_date,
-            "end_date": end_date,
-            "stats": {
-                "total_records": 0,
-                "present_count": 0,
-                "absent_count": 0,
-                "unique_users": 0
-            }
-        }
+        if start_date > end_date:
+            return jsonify({"success": False, "error": "start_date must not be after end_date"}), 400
+        
+        result = attendance_service.get_attendance_stats(start_date, end_date)
+        
+        response_time = (time.time() - start_time) * 1000
+        logger.log_response(
+            status_code=200 if result["success"] else 400,
+            response_time=response_time
+        )
+        
+        return jsonify(result), 200 if result["success"] else 400
+        
+    except Exception as e:
+        response_time = (time.time() - start_time) * 1000
+        logger.log_error(str(e))
+        logger.log_response(status_code=500, response_time=response_time)
+        return jsonify({"success": False, "error": "Server error"}), 500
+
+@attendance_bp.route("/attendance/rollups/rebuild", methods=["POST"])
+def rebuild_rollups():
+    # Recount the daily rollups of a date range (backfill of per-class stats)
+    start_time = time.time()
+    
+    try:
+        data = request.get_json() or {}
+        start_date = data.get('start_date')
+        end_date = data.get('end_date')
+        
+        if not start_date or not end_date:
+            return jsonify({"success": False, "error": "Missing start_date or end_date"}), 400
+        
+        if start_date > end_date:
+            return jsonify({"success": False, "error": "start_date must not be after end_date"}), 400
+        
+        result = attendance_service.rebuild_rollups(start_date, end_date)
+        
+        response_time = (time.time() - start_time) * 1000
+        logger.log_response(
+            status_code=200 if result["success"] else 400,
+            response_time=response_time
+        )
+        
+        return jsonify(result), 200 if result["success"] else 400
+        
+    except Exception as e:
+        response_time = (time.time() - start_time) * 1000
+        logger.log_error(str(e))
+        logger.log_response(status_code=500, response_time=response_time)
+        return jsonify({"success": False, "error": "Server error"}), 500
+
+
+@attendance_bp.route("/gallery/check", methods=["GET"])
+def check_gallery():
+    # Diff the face gallery (and faceid index) against Firestore; ?repair=1 rebuilds on mismatch
+    start_time = time.time()
+    
+    try:
+        repair = request.args.get("repair", "0").lower() in ("1", "true")
+        result = attendance_service.check_gallery(repair=repair)
         
         response_time = (time.time() - start_time) * 1000
-        logger.log_response(status_code=200, response_time=response_time)
+        logger.log_response(
+            status_code=200 if result["success"] else 400,
+            response_time=response_time
+        )
         
-        return jsonify(result), 200
+        return jsonify(result), 200 if result["success"] else 400
         
     except Exception as e:
         response_time = (time.time() - start_time) * 1000
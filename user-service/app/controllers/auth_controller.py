@@ -1,16 +1,25 @@
 <<<<<<< HEAD
 
 # Face-based registration/login
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from ..services.face_auth_service import FaceAuthService
 from ..services.firebase_service import FirebaseService
 from ..models.user_models import UserCreate, LoginResult, StudentInfo, AttendanceRecord
+from ..utils.validators import validate_page_request
+from ..utils.conditional import conditional_json
+from ..utils.face_gallery import face_gallery
+from ..utils.kiosk_tracks import kiosk_tracks
+from ..utils.logger import logger
 from datetime import datetime
+import json
 
 auth_bp = Blueprint("auth", __name__)
 face_auth = FaceAuthService(base_url="http://localhost:5000")
 db = FirebaseService()  # Read config from environment variables
 
+DUPLICATE_FACE_THRESHOLD = 0.75
+CHECKIN_MATCH_THRESHOLD = 0.75  # same bar as the per-student comparison in /checkin and /checkout
+
 @auth_bp.route("/register-face", methods=["POST"])
 def register_face():
     file = request.files.get("file")
@@ -41,25 +50,94 @@ def login_face():
 
 @auth_bp.route("/students", methods=["GET"])
 def get_students():
-    """Get student list and today's attendance"""
+    """Get student list and today's attendance
+    Query: fields (comma list, embedding excluded by default), limit, cursor, attendance=0 to skip attendance"""
     try:
-        students = db.get_all_students()
-        attendance = db.get_attendance_today()
-        mode = db.get_mode_info()
-        
-        print(f"DEBUG: /students API - Found {len(students)} students, {len(attendance)} attendance records")
-        for att in attendance:
-            print(f"DEBUG: Attendance record - student_id: {att.get('student_id')}, type: {att.get('type')}, timestamp: {att.get('timestamp')}")
-        
-        return jsonify({
-            "students": students,
-            "attendance": attendance,
-            "storage": mode
-        })
+        page = validate_page_request(request, db.STUDENT_FIELDS)
+        if not page["valid"]:
+            return jsonify({"error": "INVALID_QUERY", "message": page["message"]}), 400
+        
+        include_attendance = request.args.get("attendance", "1").lower() not in ["0", "false", "no"]
+        keys = ["users"]
+        state = ""
+        if include_attendance:
+            keys.append(f"attendance:{datetime.now().strftime('%Y-%m-%d')}")
+            # Journaled check-ins are served before their flush bumps the date's version
+            state = db.get_attendance_sequence()
+        
+        def build():
+            students, next_cursor = db.get_students_page(fields=page["fields"], limit=page["limit"], cursor=page["cursor"])
+            attendance = db.get_attendance_today() if include_attendance else []
+            return {
+                "students": students,
+                "attendance": attendance,
+                "storage": db.get_mode_info(),
+                "next_cursor": next_cursor
+            }, 200
+        
+        return conditional_json(keys, build, state)
     except Exception as e:
         print(f"DEBUG: /students API error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@auth_bp.route("/changes", methods=["GET"])
+def get_changes():
+    """Roster and attendance changes since cursor (query: cursor from the previous response).
+    Without a valid cursor the full roster and today's attendance are returned with reset=true."""
+    try:
+        return jsonify(db.get_changes(request.args.get("cursor")))
+    except Exception as e:
+        logger.log_error(f"/changes API error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@auth_bp.route("/events", methods=["GET"])
+def stream_events():
+    """Server-sent events: pushes the same payloads as /changes whenever students register or check in/out.
+    Reconnects resume from Last-Event-ID (or ?cursor=); idle streams get a keepalive comment every 15s."""
+    cursor = request.headers.get("Last-Event-ID") or request.args.get("cursor")
+    
+    def generate(cursor):
+        while True:
+            payload = db.get_changes(cursor)
+            if payload["reset"] or payload["students"] or payload["attendance"]:
+                yield f"id: {payload['cursor']}\nevent: changes\ndata: {json.dumps(payload, default=str)}\n\n"
+            cursor = payload["cursor"]
+            if not db.changes.wait(cursor, timeout=15):
+                yield ": keepalive\n\n"
+    
+    return Response(
+        stream_with_context(generate(cursor)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@auth_bp.route("/attendance-status", methods=["GET"])
+def get_attendance_status():
+    """Attendance status (not_checked / checked_in / completed) of many students in one call
+    Query: date (YYYY-MM-DD, default today), student_ids (comma list, default all students)"""
+    try:
+        date_str = request.args.get("date") or datetime.now().strftime("%Y-%m-%d")
+        try:
+            datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            return jsonify({"success": False, "error": "INVALID_DATE", "message": "date must be YYYY-MM-DD"}), 400
+        ids_arg = request.args.get("student_ids")
+        student_ids = [s.strip() for s in ids_arg.split(",") if s.strip()] if ids_arg else None
+        
+        def build():
+            statuses = db.get_attendance_statuses(date_str, student_ids)
+            counts = {"not_checked": 0, "checked_in": 0, "completed": 0}
+            for status in statuses.values():
+                counts[status] += 1
+            return {"success": True, "date": date_str, "statuses": statuses, "counts": counts}, 200
+        
+        # Today's statuses come from the ledger, which includes check-ins not yet flushed
+        state = db.get_attendance_sequence() if date_str == datetime.now().strftime("%Y-%m-%d") else ""
+        return conditional_json(["users", f"attendance:{date_str}"], build, state)
+    except Exception as e:
+        logger.log_error(f"/attendance-status API error: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @auth_bp.route("/register-student", methods=["POST"])
 def register_student():
     """Register new student with complete information"""
@@ -101,7 +179,9 @@ def register_student():
                     return jsonify({"success": False, "error": "ENCODE_ERROR", "message": r.text}), 400
                 if not resp.get("success"):
                     return jsonify({"success": False, "error": "ENCODE_ERROR", "message": resp.get("message", "Face encoding failed")}), 400
-                emb_base64 = resp.get("embedding")
+                # Several diverse frames are enrolled; the centroid is what first-pass search runs on
+                emb_base64 = resp.get("centroid") or resp.get("embedding")
+                templates = resp.get("templates")
             else:
                 raw_bytes = file.stream.read()
                 try:
@@ -113,29 +193,9 @@ def register_student():
                     if not resp2.get("success"):
                         return jsonify({"success": False, "error": "ENCODE_ERROR", "message": resp2.get("message", "Face encoding failed")}), 400
                     emb_base64 = resp2.get("embedding")
+                    templates = None
                 except Exception as e2:
                     return jsonify({"success": False, "error": "ENCODE_ERROR", "message": str(e2)}), 400
-            import base64, numpy as np
-            emb_live_bytes = base64.b64decode(emb_base64)
-            emb_live = np.frombuffer(emb_live_bytes, dtype=np.float32)
-            students = db.get_all_students()
-            for s in students:
-                saved = s.get("embedding")
-                if not saved:
-                    continue
-                if isinstance(saved, list):
-                    saved_b64 = base64.b64encode(np.array(saved, dtype=np.float32).tobytes()).decode('utf-8')
-                else:
-                    saved_b64 = saved
-                res = face_auth.compare(saved_b64, emb_base64)
-                similarity = res.get("similarity", 0)
-                print(f"DEBUG: Comparing with student {s.get('student_id')} - similarity: {similarity}")
-                if similarity > 0.75:
-                    return jsonify({
-                        "success": False,
-                        "error": "DUPLICATE_FACE",
-                        "message": "You are already a member of this class"
-                    }), 400
         except Exception as e:
             err_msg = str(e)
             if "Face mask detected" in err_msg:
@@ -150,18 +210,39 @@ def register_student():
                 "message": err_msg
             }), 400
         
-        user = UserCreate(
-            username=username,
-            embedding=emb_base64,
-            student_id=student_id,
-            full_name=full_name,
-            class_name=class_name
-        )
-        
-        user.email = email or username
-        user.image_path = f"http://localhost:5002/uploads/faces/{user.email}/face_{user.email}.jpg"
-        
-        db.save_user(user)
+        # One vectorized top-1 query against the in-memory roster; the reservation makes concurrent
+        # registrations of the same face wait their turn instead of both passing the check. The
+        # local gallery is searched even with FACEID_IDENTIFY: the faceid index is updated
+        # asynchronously and may not hold a student saved moments ago
+        with face_gallery.reserve(emb_base64, threshold=DUPLICATE_FACE_THRESHOLD) as reserved:
+            if not reserved:
+                # Still waiting on a concurrent registration of a similar face; not a known duplicate
+                return jsonify({
+                    "success": False,
+                    "error": "REGISTRATION_BUSY",
+                    "message": "Another registration of a similar face is in progress, please try again"
+                }), 409
+            if face_gallery.best_match(emb_base64, db.get_gallery_records, threshold=DUPLICATE_FACE_THRESHOLD,
+                                       remote=False):
+                return jsonify({
+                    "success": False,
+                    "error": "DUPLICATE_FACE",
+                    "message": "You are already a member of this class"
+                }), 400
+            
+            user = UserCreate(
+                username=username,
+                embedding=emb_base64,
+                templates=templates,
+                student_id=student_id,
+                full_name=full_name,
+                class_name=class_name
+            )
+            
+            user.email = email or username
+            user.image_path = f"http://localhost:5002/uploads/faces/{user.email}/face_{user.email}.jpg"
+            
+            db.save_user(user)
         
         return jsonify({
             "success": True,
@@ -299,6 +380,26 @@ def mark_attendance():
         }), 400
 
 
+def _identify_on_kiosk_track(kiosk_id: str, image_bytes: bytes):
+    """Identify a kiosk frame through the kiosk's face track (see kiosk_tracks): consecutive
+    frames of one person are averaged and matched (and periodically re-verified) against the gallery.
+    Returns (student or None, similarity, track)."""
+    emb_live_base64, bbox = face_auth.encode_with_bbox(image_bytes)
+    track, pending = kiosk_tracks.observe(kiosk_id, emb_live_base64, bbox)
+    if pending is not None:
+        kiosk_tracks.resolve(track, face_gallery.best_match(pending, db.get_gallery_records, threshold=CHECKIN_MATCH_THRESHOLD))
+    if track.match is None:
+        return None, 0, track
+    record = track.match
+    student = {
+        "student_id": record["student_id"],
+        "username": record["username"],
+        "full_name": record["name"],
+        "class_name": record["class_name"]
+    }
+    return student, record["similarity"], track
+
+
 @auth_bp.route("/checkin", methods=["POST"])
 def checkin():
     try:
@@ -308,27 +409,33 @@ def checkin():
             print("DEBUG: No file provided")
             return jsonify({"success": False, "error": "NO_IMAGE", "message": "No image provided"}), 400
         
-        print("DEBUG: File received, encoding face...")
-        emb_live_base64 = face_auth.encode(file.stream.read())
-        import base64, numpy as np
-        emb_live_bytes = base64.b64decode(emb_live_base64)
-        emb_live = np.frombuffer(emb_live_bytes, dtype=np.float32)
+        kiosk_id = request.form.get("kiosk_id")
+        track = None
+        if kiosk_id:
+            # Continuous kiosk stream: identified per face track, on the averaged frames
+            best_match, best_similarity, track = _identify_on_kiosk_track(kiosk_id, file.stream.read())
+        else:
+            print("DEBUG: File received, encoding face...")
+            emb_live_base64 = face_auth.encode(file.stream.read())
+            import base64, numpy as np
+            emb_live_bytes = base64.b64decode(emb_live_base64)
+            emb_live = np.frombuffer(emb_live_bytes, dtype=np.float32)
         
-        print("DEBUG: Getting students list...")
-        students = db.get_all_students()
-        print(f"DEBUG: Found {len(students)} students")
+            print("DEBUG: Getting students list...")
+            students = db.get_all_students()
+            print(f"DEBUG: Found {len(students)} students")
         
-        best_match, best_similarity = None, 0
-        for s in students:
-            saved = s.get("embedding")
-            if saved:
-                if isinstance(saved, list):
-                    saved = base64.b64encode(np.array(saved, dtype=np.float32).tobytes()).decode('utf-8')
-                res = face_auth.compare(saved, emb_live_base64)
-                sim = res.get("similarity", 0)
-                print(f"DEBUG: Student {s.get('student_id')} similarity: {sim}")
-                if sim > best_similarity and sim > 0.75:
-                    best_similarity, best_match = sim, s
+            best_match, best_similarity = None, 0
+            for s in students:
+                saved = s.get("embedding")
+                if saved:
+                    if isinstance(saved, list):
+                        saved = base64.b64encode(np.array(saved, dtype=np.float32).tobytes()).decode('utf-8')
+                    res = face_auth.compare(saved, emb_live_base64)
+                    sim = res.get("similarity", 0)
+                    print(f"DEBUG: Student {s.get('student_id')} similarity: {sim}")
+                    if sim > best_similarity and sim > 0.75:
+                        best_similarity, best_match = sim, s
         
         if not best_match:
             print("DEBUG: No matching student found")
@@ -351,7 +458,10 @@ def checkin():
         db.save_attendance_event(best_match.get("student_id"), now, "attendance")
         print("DEBUG: Attendance event saved successfully")
         
-        return jsonify({"success": True, "student": best_match, "timestamp": now.isoformat(), "similarity": best_similarity})
+        result = {"success": True, "student": best_match, "timestamp": now.isoformat(), "similarity": best_similarity}
+        if track is not None:
+            result.update({"track_id": track.track_id, "track_frames": track.frames})
+        return jsonify(result)
     except Exception as e:
         print(f"DEBUG: Checkin error: {str(e)}")
         import traceback
@@ -368,27 +478,33 @@ def checkout():
             print("DEBUG: No file provided for checkout")
             return jsonify({"success": False, "error": "NO_IMAGE", "message": "No image provided"}), 400
         
-        print("DEBUG: File received for checkout, encoding face...")
-        emb_live_base64 = face_auth.encode(file.stream.read())
-        import base64, numpy as np
-        emb_live_bytes = base64.b64decode(emb_live_base64)
-        emb_live = np.frombuffer(emb_live_bytes, dtype=np.float32)
+        kiosk_id = request.form.get("kiosk_id")
+        track = None
+        if kiosk_id:
+            # Continuous kiosk stream: identified per face track, on the averaged frames
+            best_match, best_similarity, track = _identify_on_kiosk_track(kiosk_id, file.stream.read())
+        else:
+            print("DEBUG: File received for checkout, encoding face...")
+            emb_live_base64 = face_auth.encode(file.stream.read())
+            import base64, numpy as np
+            emb_live_bytes = base64.b64decode(emb_live_base64)
+            emb_live = np.frombuffer(emb_live_bytes, dtype=np.float32)
         
-        print("DEBUG: Getting students list for checkout...")
-        students = db.get_all_students()
-        print(f"DEBUG: Found {len(students)} students for checkout")
-        
-        best_match, best_similarity = None, 0
-        for s in students:
-            saved = s.get("embedding")
-            if saved:
-                if isinstance(saved, list):
-                    saved = base64.b64encode(np.array(saved, dtype=np.float32).tobytes()).decode('utf-8')
-                res = face_auth.compare(saved, emb_live_base64)
-                sim = res.get("similarity", 0)
-                print(f"DEBUG: Student {s.get('student_id')} similarity for checkout: {sim}")
-                if sim > best_similarity and sim > 0.75:
-                    best_similarity, best_match = sim, s
+            print("DEBUG: Getting students list for checkout...")
+            students = db.get_all_students()
+            print(f"DEBUG: Found {len(students)} students for checkout")
+        
+            best_match, best_similarity = None, 0
+            for s in students:
+                saved = s.get("embedding")
+                if saved:
+                    if isinstance(saved, list):
+                        saved = base64.b64encode(np.array(saved, dtype=np.float32).tobytes()).decode('utf-8')
+                    res = face_auth.compare(saved, emb_live_base64)
+                    sim = res.get("similarity", 0)
+                    print(f"DEBUG: Student {s.get('student_id')} similarity for checkout: {sim}")
+                    if sim > best_similarity and sim > 0.75:
+                        best_similarity, best_match = sim, s
         
         if not best_match:
             print("DEBUG: No matching student found for checkout")
@@ -411,7 +527,10 @@ def checkout():
         db.save_attendance_event(best_match.get("student_id"), now, "checkout")
         print("DEBUG: Checkout event saved successfully")
         
-        return jsonify({"success": True, "student": best_match, "timestamp": now.isoformat(), "similarity": best_similarity})
+        result = {"success": True, "student": best_match, "timestamp": now.isoformat(), "similarity": best_similarity}
+        if track is not None:
+            result.update({"track_id": track.track_id, "track_frames": track.frames})
+        return jsonify(result)
     except Exception as e:
         print(f"DEBUG: Checkout error: {str(e)}")
         import traceback
@@ -419,6 +538,12 @@ def checkout():
         return jsonify({"success": False, "error": "CHECKOUT_ERROR", "message": str(e)}), 400
 
 
+@auth_bp.route("/kiosk/<kiosk_id>/track", methods=["DELETE"])
+def end_kiosk_track(kiosk_id):
+    """End the kiosk's current face track, so the next frame starts a new person"""
+    return jsonify({"success": True, "ended": kiosk_tracks.end(kiosk_id)})
+
+
 @auth_bp.route("/attendance-summary", methods=["GET"])
 def attendance_summary():
     try:
@@ -446,8 +571,9 @@ def get_stats():
 =======
 from flask import Blueprint, request, jsonify
 from ..services.user_service import UserService
-from ..utils.validators import validate_register_request
+from ..utils.validators import validate_register_request, validate_page_request
 from ..utils.logger import logger
+from ..utils.conditional import conditional_json
 import time
 
 auth_bp = Blueprint("auth", __name__)
@@ -554,31 +680,42 @@ def update_user_face(user_id):
 
 @auth_bp.route("/users", methods=["GET"])
 def get_all_users():
-    # Get list of all students
+    # Get list of students (query: fields, limit, cursor)
     start_time = time.time()
     
     try:
-        users = user_service.get_all_users()
+        page = validate_page_request(request, user_service.USER_FIELDS)
+        if not page["valid"]:
+            return jsonify({"success": False, "error": page["message"]}), 400
         
-        user_list = []
-        for user in users:
-            user_list.append({
-                "id": user.id,
-                "name": user.name,
-                "email": user.email,
-                "image_path": user.image_path,
-                "created_at": user.created_at.isoformat(),
-                "updated_at": user.updated_at.isoformat()
-            })
+        fields = page["fields"] or list(user_service.USER_FIELDS)
+        
+        def build():
+            users, next_cursor = user_service.get_users_page(fields, page["limit"], page["cursor"])
+            user_list = []
+            for user in users:
+                item = {
+                    "id": user.id,
+                    "name": user.name,
+                    "email": user.email,
+                    "image_path": user.image_path,
+                    "created_at": user.created_at.isoformat() if user.created_at else None,
+                    "updated_at": user.updated_at.isoformat() if user.updated_at else None
+                }
+                user_list.append({k: item[k] for k in fields})
+            return {
+                "success": True,
+                "total": len(user_list),
+                "users": user_list,
+                "next_cursor": next_cursor
+            }, 200
+        
+        response = conditional_json(["users"], build)
         
         response_time = (time.time() - start_time) * 1000
-        logger.log_response(status_code=200, response_time=response_time)
+        logger.log_response(status_code=response.status_code, response_time=response_time)
         
-        return jsonify({
-            "success": True,
-            "total": len(user_list),
-            "users": user_list
-        }), 200
+        return response
         
     except Exception as e:
         response_time = (time.time() - start_time) * 1000
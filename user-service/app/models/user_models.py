@@ -5,7 +5,8 @@ from datetime import datetime
 
 class UserCreate(BaseModel):
     username: str
-    embedding: str  # Base64 encoded embedding
+    embedding: str  # Base64 encoded embedding (centroid of templates when there are several)
+    templates: Optional[List[str]] = None  # Base64 per-frame templates from sequence enrollment
     student_id: Optional[str] = None
     full_name: Optional[str] = None
     class_name: Optional[str] = None
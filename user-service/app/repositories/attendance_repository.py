@@ -1,24 +1,113 @@
 from google.cloud import firestore
-from typing import Optional, List
-from datetime import datetime, date
+from typing import Callable, Dict, Optional, List
+from datetime import datetime, date, timezone
 from ..models.user_models import AttendanceRecord
 from ..config.settings import Config
+from ..utils.history_cache import history_cache
+from ..utils.conditional import versions
 
 class AttendanceRepository:
     # Repository handling Attendance data in Firestore
 
+    APPLIED_ENTRIES_KEEP = 100  # write-behind entry IDs remembered per daily doc for replay dedup
+
     def __init__(self):
         self.db = firestore.Client(project=Config.FIREBASE_PROJECT_ID)
         self.collection = "attendance"
+        self.rollup_collection = "attendance_rollups"
     
     def create_attendance_record(self, attendance_data: dict) -> str:
         # Create new attendance record
         doc_ref = self.db.collection(self.collection).document()
         doc_ref.set(attendance_data)
+        if attendance_data.get("date"):
+            versions.bump(f"attendance:{attendance_data['date']}")
         return doc_ref.id
     
+    def set_captured_image(self, attendance_date: str, attendance_ids: List[str], url: str):
+        # Point attendance docs at an image once it has been uploaded
+        batch = self.db.batch()
+        for attendance_id in attendance_ids:
+            batch.update(self.db.collection(self.collection).document(attendance_id), {"captured_image": url})
+        versions.bump(f"attendance:{attendance_date}", batch)
+        batch.commit()
+        history_cache.invalidate(attendance_date)
+    
+    def daily_doc_id(self, user_id: str, attendance_date: str) -> str:
+        # Deterministic document ID: one attendance doc per user per day
+        return f"{user_id}_{attendance_date}"
+    
+    def _legacy_daily_docs(self, attendance_date: str, user_ids: List[str], transaction=None) -> dict:
+        # Auto-ID docs written before deterministic IDs were used, by user ID (one query per 30 users)
+        # Only needed for users whose deterministic doc does not exist yet
+        legacy = {}
+        for start in range(0, len(user_ids), 30):
+            query = (self.db.collection(self.collection)
+                     .where("date", "==", attendance_date)
+                     .where("user_id", "in", user_ids[start:start + 30]))
+            docs = transaction.get(query) if transaction is not None else query.stream()
+            for doc in docs:
+                legacy.setdefault(doc.to_dict().get("user_id"), doc)
+        return legacy
+    
+    @staticmethod
+    def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+        # Firestore returns timezone-aware UTC timestamps; records are written with naive UTC ones
+        if value is not None and value.tzinfo is not None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    
+    @classmethod
+    def _earliest(cls, stored: Optional[datetime], value: datetime) -> datetime:
+        stored = cls._naive_utc(stored)
+        return value if stored is None else min(stored, value)
+    
+    @classmethod
+    def _latest(cls, stored: Optional[datetime], value: datetime) -> datetime:
+        stored = cls._naive_utc(stored)
+        return value if stored is None else max(stored, value)
+    
+    def _apply_rollups(self, writer, new_records: List[dict]):
+        # Fold newly created daily records into per-day rollup docs (one merge write per date)
+        # writer: a transaction or batch; new_records: dicts with user_id, date, status, class_name
+        for attendance_date, delta in self._rollup_deltas(new_records).items():
+            rollup_data = {
+                "date": attendance_date,
+                "total_records": firestore.Increment(delta["total_records"]),
+                "present_count": firestore.Increment(delta["present_count"]),
+                "absent_count": firestore.Increment(delta["absent_count"]),
+                "user_ids": firestore.ArrayUnion(sorted(delta["user_ids"])),
+                "by_class": {
+                    class_name: {key: firestore.Increment(value) for key, value in counts.items()}
+                    for class_name, counts in delta["by_class"].items()
+                },
+                "updated_at": datetime.utcnow()
+            }
+            writer.set(self.db.collection(self.rollup_collection).document(attendance_date), rollup_data, merge=True)
+    
+    @staticmethod
+    def _rollup_deltas(records: List[dict]) -> dict:
+        # Per-date counts of daily records: totals, user IDs and the per-class breakdown
+        deltas = {}
+        for record in records:
+            counter = "present_count" if record.get("status") == "present" else "absent_count"
+            class_name = record.get("class_name") or "Unassigned"
+            delta = deltas.setdefault(record["date"], {"total_records": 0, "present_count": 0,
+                                                       "absent_count": 0, "user_ids": set(), "by_class": {}})
+            delta["total_records"] += 1
+            delta[counter] += 1
+            delta["user_ids"].add(record["user_id"])
+            class_delta = delta["by_class"].setdefault(class_name, {"present_count": 0, "absent_count": 0})
+            class_delta[counter] += 1
+        return deltas
+    
     def get_attendance_by_user_and_date(self, user_id: str, attendance_date: str) -> Optional[AttendanceRecord]:
         # Get attendance record by user and date
+        doc = self.db.collection(self.collection).document(self.daily_doc_id(user_id, attendance_date)).get()
+        if doc.exists:
+            return AttendanceRecord.from_dict(doc.to_dict(), doc.id)
+        
+        # Fall back to records created before deterministic IDs were used
         query = (self.db.collection(self.collection)
                  .where("user_id", "==", user_id)
                  .where("date", "==", attendance_date)
@@ -31,61 +120,161 @@ class AttendanceRepository:
     
     def upsert_daily_attendance(self, user_id: str, attendance_date: str, status: str, 
                                captured_image: str, note: str = None) -> str:
-        # Upsert attendance by date (idempotent)
+        # Upsert attendance by date (idempotent, race-free across concurrent marks)
+        written = self.upsert_daily_attendance_batch([{
+            "user_id": user_id,
+            "date": attendance_date,
+            "status": status,
+            "captured_image": captured_image,
+            "note": note
+        }])
+        return written[0]["attendance_id"]
+    
+    def upsert_daily_attendance_batch(self, items: List[dict]) -> List[dict]:
+        # Upsert many daily attendance records in one transaction
+        # items: dicts with user_id, date, status, captured_image, note (optional class_name for rollups,
+        # optional entry_id: write-behind journal ID, recorded on the doc so a replayed item is not counted twice)
+        # A captured_image of None keeps the image already stored on the record
+        # Optional first_seen/last_seen (naive UTC) are for events that happened before the write,
+        # e.g. a recorded video; they widen the record's span instead of setting last_seen to now
+        # Returns the written values (attendance_id, first_seen, last_seen, captures) per item, in order
+        if not items:
+            return []
+        
         try:
-            # Find current record
-            existing_record = self.get_attendance_by_user_and_date(user_id, attendance_date)
+            doc_refs = [self.db.collection(self.collection).document(self.daily_doc_id(item["user_id"], item["date"]))
+                        for item in items]
             
-            if existing_record:
-                # Update current record
-                update_data = {
-                    "last_seen": datetime.utcnow(),
-                    "captures": existing_record.captures + 1,
-                    "captured_image": captured_image,
-                    "note": note or existing_record.note
-                }
+            # Collapse repeated users into one write per document (last item wins, captures add up)
+            unique_refs = {}
+            latest_item = {}
+            counts = {}
+            entry_ids = {}
+            images = {}  # latest captured_image per document, None items skipped
+            seen = {}  # earliest first_seen and latest last_seen given per document
+            for item, doc_ref in zip(items, doc_refs):
+                unique_refs[doc_ref.id] = doc_ref
+                latest_item[doc_ref.id] = item
+                counts[doc_ref.id] = counts.get(doc_ref.id, 0) + 1
+                if item.get("captured_image") is not None:
+                    images[doc_ref.id] = item["captured_image"]
+                if item.get("entry_id"):
+                    entry_ids.setdefault(doc_ref.id, []).append(item["entry_id"])
+                if item.get("first_seen") and item.get("last_seen"):
+                    first, last = seen.get(doc_ref.id, (item["first_seen"], item["last_seen"]))
+                    seen[doc_ref.id] = (min(first, item["first_seen"]), max(last, item["last_seen"]))
+            
+            @firestore.transactional
+            def _upsert(transaction) -> dict:
+                snapshots = {snap.id: snap for snap in transaction.get_all(list(unique_refs.values()))}
                 
-                # Find document ID of current record
-                query = (self.db.collection(self.collection)
-                         .where("user_id", "==", user_id)
-                         .where("date", "==", attendance_date)
-                         .limit(1))
+                # A user may already have a legacy auto-ID doc for the day; update it instead of adding a second one
+                missing = {}
+                for doc_id in unique_refs:
+                    if snapshots.get(doc_id) is None or not snapshots[doc_id].exists:
+                        item = latest_item[doc_id]
+                        missing.setdefault(item["date"], []).append(item["user_id"])
+                for attendance_date, user_ids in missing.items():
+                    for user_id, snap in self._legacy_daily_docs(attendance_date, user_ids, transaction).items():
+                        snapshots[self.daily_doc_id(user_id, attendance_date)] = snap
                 
-                docs = query.stream()
-                for doc in docs:
-                    doc.reference.update(update_data)
-                    return doc.id
-            else:
-                # Create new record
                 now = datetime.utcnow()
-                attendance_data = {
-                    "user_id": user_id,
-                    "date": attendance_date,
-                    "status": status,
-                    "first_seen": now,
-                    "last_seen": now,
-                    "captures": 1,
-                    "captured_image": captured_image,
-                    "note": note,
-                    "created_at": now
-                }
+                written = {}
+                created = []
+                
+                for doc_id, doc_ref in unique_refs.items():
+                    item = latest_item[doc_id]
+                    snapshot = snapshots.get(doc_id)
+                    
+                    if snapshot is not None and snapshot.exists:
+                        doc_ref = snapshot.reference
+                        existing = snapshot.to_dict()
+                        # Journal entries already applied (replay after a crash or a lost ack) add nothing
+                        applied = set(existing.get("applied_entries") or [])
+                        new_ids = [i for i in entry_ids.get(doc_id, []) if i not in applied]
+                        count = counts[doc_id] - (len(entry_ids.get(doc_id, [])) - len(new_ids))
+                        if count == 0:
+                            written[doc_id] = {
+                                "attendance_id": doc_ref.id,
+                                "user_id": item["user_id"],
+                                "date": item["date"],
+                                "first_seen": existing.get("first_seen"),
+                                "last_seen": existing.get("last_seen"),
+                                "captures": existing.get("captures", 0)
+                            }
+                            continue
+                        
+                        # Update current record
+                        first_seen = existing.get("first_seen")
+                        last_seen = now
+                        update_data = {"captures": firestore.Increment(count)}
+                        if doc_id in seen:
+                            first_seen = self._earliest(first_seen, seen[doc_id][0])
+                            last_seen = self._latest(existing.get("last_seen"), seen[doc_id][1])
+                            update_data["first_seen"] = first_seen
+                        update_data["last_seen"] = last_seen
+                        if doc_id in images:
+                            update_data["captured_image"] = images[doc_id]
+                        if new_ids:
+                            # Only recent entries can still be replayed; keep the list bounded
+                            update_data["applied_entries"] = ((existing.get("applied_entries") or []) + new_ids)[-self.APPLIED_ENTRIES_KEEP:]
+                        if item.get("note"):
+                            update_data["note"] = item["note"]
+                        transaction.update(doc_ref, update_data)
+                        captures = existing.get("captures", 0) + count
+                    else:
+                        # Create new record
+                        first_seen, last_seen = seen.get(doc_id, (now, now))
+                        attendance_data = {
+                            "user_id": item["user_id"],
+                            "date": item["date"],
+                            "status": item["status"],
+                            "first_seen": first_seen,
+                            "last_seen": last_seen,
+                            "captures": counts[doc_id],
+                            "captured_image": images.get(doc_id),
+                            "note": item.get("note"),
+                            "applied_entries": entry_ids.get(doc_id, [])[-self.APPLIED_ENTRIES_KEEP:],
+                            "created_at": now
+                        }
+                        transaction.set(doc_ref, attendance_data)
+                        created.append(item)
+                        captures = counts[doc_id]
+                    
+                    written[doc_id] = {
+                        "attendance_id": doc_ref.id,
+                        "user_id": item["user_id"],
+                        "date": item["date"],
+                        "first_seen": first_seen,
+                        "last_seen": last_seen,
+                        "captures": captures
+                    }
                 
-                doc_ref = self.db.collection(self.collection).document()
-                doc_ref.set(attendance_data)
-                return doc_ref.id
+                # Keep the daily rollups and the dates' versions in step with the records
+                self._apply_rollups(transaction, created)
+                for attendance_date in {item["date"] for item in items}:
+                    versions.bump(f"attendance:{attendance_date}", transaction)
+                return written
+            
+            written = _upsert(self.db.transaction())
+            for attendance_date in {item["date"] for item in items}:
+                history_cache.invalidate(attendance_date)
+            return [written[doc_ref.id] for doc_ref in doc_refs]
                 
         except Exception as e:
             raise Exception(f"Upsert attendance error: {str(e)}")
     
     def get_attendance_by_date(self, attendance_date: str, limit: int = 100) -> List[AttendanceRecord]:
-        # Get attendance list by date
-        query = (self.db.collection(self.collection)
-                 .where("date", "==", attendance_date)
-                 .order_by("last_seen", direction=firestore.Query.DESCENDING)
-                 .limit(limit))
+        # Get attendance list by date (past dates are served from the history cache)
+        def _load():
+            query = (self.db.collection(self.collection)
+                     .where("date", "==", attendance_date)
+                     .order_by("last_seen", direction=firestore.Query.DESCENDING)
+                     .limit(limit))
+            return [[doc.id, doc.to_dict()] for doc in query.stream()]
         
-        docs = query.stream()
-        return [AttendanceRecord.from_dict(doc.to_dict(), doc.id) for doc in docs]
+        docs = history_cache.get_or_load(f"attendance_records_{limit}", attendance_date, _load)
+        return [AttendanceRecord.from_dict(data, doc_id) for doc_id, data in docs]
     
     def get_user_attendance_history(self, user_id: str, limit: int = 50) -> List[AttendanceRecord]:
         # Get user attendance history
@@ -97,16 +286,24 @@ class AttendanceRepository:
         docs = query.stream()
         return [AttendanceRecord.from_dict(doc.to_dict(), doc.id) for doc in docs]
     
-    def mark_absent_batch(self, user_ids: List[str], attendance_date: str) -> int:
-        # Mark absent in bulk for user list
-        created_count = 0
+    def mark_absent_batch(self, user_ids: List[str], attendance_date: str, class_names: Dict[str, str] = None) -> int:
+        # Mark absent in bulk for user list (class_names: user ID -> class, for the rollups)
+        class_names = class_names or {}
+        user_ids = list(dict.fromkeys(user_ids))
         batch = self.db.batch()
         
-        for user_id in user_ids:
-            # Check if attendance record already exists
-            existing = self.get_attendance_by_user_and_date(user_id, attendance_date)
-            if not existing:
-                doc_ref = self.db.collection(self.collection).document()
+        # Check which attendance records already exist in one round trip
+        doc_refs = [self.db.collection(self.collection).document(self.daily_doc_id(user_id, attendance_date))
+                    for user_id in user_ids]
+        existing_ids = {doc.id for doc in self.db.get_all(doc_refs) if doc.exists}
+        # Users with a legacy auto-ID doc for the date already have a record
+        missing_users = [user_id for user_id, doc_ref in zip(user_ids, doc_refs) if doc_ref.id not in existing_ids]
+        existing_ids.update(self.daily_doc_id(user_id, attendance_date)
+                            for user_id in self._legacy_daily_docs(attendance_date, missing_users))
+        
+        created = []
+        for user_id, doc_ref in zip(user_ids, doc_refs):
+            if doc_ref.id not in existing_ids:
                 attendance_data = {
                     "user_id": user_id,
                     "date": attendance_date,
@@ -119,36 +316,93 @@ class AttendanceRepository:
                     "created_at": datetime.utcnow()
                 }
                 batch.set(doc_ref, attendance_data)
-                created_count += 1
+                created.append({**attendance_data, "class_name": class_names.get(user_id)})
         
-        if created_count > 0:
+        if created:
+            self._apply_rollups(batch, created)
+            versions.bump(f"attendance:{attendance_date}", batch)
             batch.commit()
+            history_cache.invalidate(attendance_date)
         
-        return created_count
+        return len(created)
     
-    def get_attendance_stats(self, start_date: str, end_date: str) -> dict:
-        # Get attendance statistics in time range
+    def rebuild_rollups(self, start_date: str, end_date: str,
+                        class_lookup: Callable[[List[str]], Dict[str, str]]) -> List[str]:
+        # Recompute the rollup docs of a date range from the attendance records and overwrite them
+        # (backfill of dates written before rollups, or before writes passed class_name).
+        # class_lookup maps user IDs to classes. Returns the rebuilt dates.
+        # Marks landing on a date while it is rebuilt can be lost, so run it for past dates.
         query = (self.db.collection(self.collection)
                  .where("date", ">=", start_date)
-                 .where("date", "<=", end_date))
+                 .where("date", "<=", end_date)
+                 .select(["user_id", "date", "status"]))
+        
+        by_date = {}
+        for doc in query.stream():
+            data = doc.to_dict()
+            if data.get("user_id") and data.get("date"):
+                by_date.setdefault(data["date"], []).append(data)
+        
+        class_names = class_lookup([record["user_id"] for records in by_date.values() for record in records])
+        records = [{**record, "class_name": class_names.get(record["user_id"])}
+                   for records in by_date.values() for record in records]
+        dates = sorted(by_date)
+        deltas = self._rollup_deltas(records)
+        
+        # One overwrite (plus version bump) per date, in batches under the 500-write limit
+        for start in range(0, len(dates), 200):
+            batch = self.db.batch()
+            for attendance_date in dates[start:start + 200]:
+                delta = deltas[attendance_date]
+                batch.set(self.db.collection(self.rollup_collection).document(attendance_date), {
+                    "date": attendance_date,
+                    "total_records": delta["total_records"],
+                    "present_count": delta["present_count"],
+                    "absent_count": delta["absent_count"],
+                    "user_ids": sorted(delta["user_ids"]),
+                    "by_class": delta["by_class"],
+                    "updated_at": datetime.utcnow()
+                })
+                versions.bump(f"attendance:{attendance_date}", batch)
+            batch.commit()
+        return dates
+    
+    def get_attendance_stats(self, start_date: str, end_date: str) -> dict:
+        # Get attendance statistics in time range from the per-day rollup docs (one small doc per day)
+        query = (self.db.collection(self.rollup_collection)
+                 .where("date", ">=", start_date)
+                 .where("date", "<=", end_date)
+                 .order_by("date"))
         
         docs = query.stream()
         stats = {
             "total_records": 0,
             "present_count": 0,
             "absent_count": 0,
-            "unique_users": set()
+            "unique_users": set(),
+            "by_class": {},
+            "daily": []
         }
         
         for doc in docs:
             data = doc.to_dict()
-            stats["total_records"] += 1
-            stats["unique_users"].add(data.get("user_id"))
+            stats["total_records"] += data.get("total_records", 0)
+            stats["present_count"] += data.get("present_count", 0)
+            stats["absent_count"] += data.get("absent_count", 0)
+            stats["unique_users"].update(data.get("user_ids", []))
+            
+            for class_name, counts in data.get("by_class", {}).items():
+                class_stats = stats["by_class"].setdefault(class_name, {"present_count": 0, "absent_count": 0})
+                class_stats["present_count"] += counts.get("present_count", 0)
+                class_stats["absent_count"] += counts.get("absent_count", 0)
             
-            if data.get("status") == "present":
-                stats["present_count"] += 1
-            elif data.get("status") == "absent":
-                stats["absent_count"] += 1
+            stats["daily"].append({
+                "date": data.get("date", doc.id),
+                "total_records": data.get("total_records", 0),
+                "present_count": data.get("present_count", 0),
+                "absent_count": data.get("absent_count", 0),
+                "unique_users": len(data.get("user_ids", []))
+            })
         
         stats["unique_users"] = len(stats["unique_users"])
         return stats
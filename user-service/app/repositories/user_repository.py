@@ -1,11 +1,18 @@
 from google.cloud import firestore
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 from datetime import datetime
 from ..models.user_models import User
 from ..config.settings import Config
+from ..utils.conditional import versions
+from ..utils.face_gallery import face_gallery, gallery_record, load_gallery_records
+from ..utils.change_feed import publish_student
 
 class UserRepository:
     # Repository handling User data in Firestore
+    
+    # Fields that feed the face gallery (see face_gallery.gallery_record)
+    GALLERY_FIELDS = {"name", "email", "full_name", "student_id", "username", "class_name", "face_encoding", "embedding",
+                      "templates"}
 
     def __init__(self):
         self.db = firestore.Client(project=Config.FIREBASE_PROJECT_ID)
@@ -20,6 +27,9 @@ class UserRepository:
         # 2. Create new document and save
         doc_ref = self.db.collection(self.collection).document()
         doc_ref.set(user_data)
+        versions.bump("users")
+        face_gallery.upsert(gallery_record(doc_ref.id, user_data))
+        publish_student(user_data)
         # 3. Return document ID
         return doc_ref.id
     
@@ -30,6 +40,19 @@ class UserRepository:
             return User.from_dict(doc.to_dict(), doc.id)
         return None
     
+    def get_users_by_ids(self, user_ids: List[str]) -> Dict[str, User]:
+        # Get many users by ID in one round trip, keyed by user ID
+        unique_ids = list(dict.fromkeys(uid for uid in user_ids if uid))
+        if not unique_ids:
+            return {}
+        
+        doc_refs = [self.db.collection(self.collection).document(uid) for uid in unique_ids]
+        return {
+            doc.id: User.from_dict(doc.to_dict(), doc.id)
+            for doc in self.db.get_all(doc_refs)
+            if doc.exists
+        }
+    
     def get_user_by_email(self, email: str) -> Optional[User]:
         # Get user by email
         query = self.db.collection(self.collection).where("email", "==", email).limit(1)
@@ -39,20 +62,69 @@ class UserRepository:
             return User.from_dict(doc.to_dict(), doc.id)
         return None
     
+    def get_class_names(self, user_ids: List[str]) -> Dict[str, str]:
+        # Class of each user in one round trip, reading only class_name (users without one are left out)
+        unique_ids = list(dict.fromkeys(uid for uid in user_ids if uid))
+        if not unique_ids:
+            return {}
+        
+        doc_refs = [self.db.collection(self.collection).document(uid) for uid in unique_ids]
+        return {
+            doc.id: doc.to_dict()["class_name"]
+            for doc in self.db.get_all(doc_refs, field_paths=["class_name"])
+            if doc.exists and doc.to_dict().get("class_name")
+        }
+    
     def get_all_users(self) -> List[User]:
         # Get all users
         docs = self.db.collection(self.collection).stream()
         return [User.from_dict(doc.to_dict(), doc.id) for doc in docs]
     
+    def get_gallery_records(self, class_names: Optional[List[str]] = None) -> List[Dict]:
+        # Records for the face gallery: id, name, email, class_name and embedding (None = every class)
+        return load_gallery_records(self.db, class_names)
+    
+    def get_gallery_records_since(self, marks: Dict[str, str]) -> List[Dict]:
+        # Gallery records updated after the given high-water marks (see face_gallery.high_water_marks)
+        return load_gallery_records(self.db, updated_since=marks)
+    
+    def get_users_page(self, fields: List[str], limit: int = None, cursor: str = None) -> Tuple[List[User], Optional[str]]:
+        # Get a page of users ordered by document ID, reading only the requested fields
+        # Returns (users, next_cursor); next_cursor is None on the last page
+        # With only "id" requested, select the document name so no field (face_encoding included) is read
+        doc_fields = [f for f in fields if f != "id"] or ["__name__"]
+        query = self.db.collection(self.collection).select(doc_fields)
+        query = query.order_by(firestore.FieldPath.document_id())
+        if cursor:
+            query = query.start_after({firestore.FieldPath.document_id(): cursor})
+        if limit:
+            query = query.limit(limit)
+        
+        users = [User.from_dict(doc.to_dict() or {}, doc.id) for doc in query.stream()]
+        next_cursor = users[-1].id if limit and len(users) == limit else None
+        return users, next_cursor
+    
     def update_user(self, user_id: str, update_data: dict) -> bool:
         # Update user information
         try:
             update_data["updated_at"] = datetime.utcnow()
             self.db.collection(self.collection).document(user_id).update(update_data)
+            versions.bump("users")
+            if self.GALLERY_FIELDS.intersection(update_data):
+                self._sync_gallery(user_id)
             return True
         except Exception:
             return False
     
+    def _sync_gallery(self, user_id: str):
+        # Re-read the user, apply it to the face gallery in place and publish the roster change
+        doc = self.db.collection(self.collection).document(user_id).get()
+        if doc.exists:
+            face_gallery.upsert(gallery_record(doc.id, doc.to_dict()))
+            publish_student(doc.to_dict())
+        else:
+            face_gallery.remove(user_id)
+    
     def update_user_face(self, user_id: str, face_encoding: list, image_path: str) -> bool:
         # Update face encoding and image for user
         try:
@@ -62,6 +134,8 @@ class UserRepository:
                 "updated_at": datetime.utcnow()
             }
             self.db.collection(self.collection).document(user_id).update(update_data)
+            versions.bump("users")
+            self._sync_gallery(user_id)
             return True
         except Exception:
             return False
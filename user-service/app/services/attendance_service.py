@@ -1,5 +1,6 @@
+import uuid
 from typing import Dict, Any, List
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
 from ..repositories.user_repository import UserRepository
 from ..repositories.attendance_repository import AttendanceRepository
 from .face_recognition_service import FaceRecognitionService
@@ -7,6 +8,8 @@ from .storage_service import StorageService
 from ..utils.image_processor import resize_image, validate_image_format
 from ..utils.validators import validate_image_size
 from ..utils.logger import logger
+from ..utils.write_behind import write_behind
+from ..utils.face_gallery import face_gallery, index_entry
 from ..config.settings import Config
 
 class AttendanceService:
@@ -17,6 +20,45 @@ class AttendanceService:
         self.attendance_repo = AttendanceRepository()
         self.face_service = FaceRecognitionService()
         self.storage_service = StorageService()
+        
+        # Attendance image uploads and upserts are flushed in the background
+        write_behind.register("attendance_image", self._flush_attendance_images)
+        write_behind.register("attendance_upsert", self._flush_attendance_upserts)
+    
+    def _flush_attendance_images(self, entries: List[Dict[str, Any]]):
+        # Write-behind handler: upload journaled attendance images (idempotent, fixed path per image),
+        # then point the records listed in attendance_ids at them, so no record links a missing file
+        for entry in entries:
+            payload = entry["payload"]
+            url = self.storage_service.upload_image(
+                write_behind.decode_bytes(payload["image"]),
+                payload["path"]
+            )
+            if not url:
+                raise Exception(f"Error uploading attendance image {payload['path']}")
+            if payload.get("attendance_ids"):
+                self.attendance_repo.set_captured_image(payload["date"], payload["attendance_ids"], url)
+    
+    def _flush_attendance_upserts(self, entries: List[Dict[str, Any]]):
+        # Write-behind handler: apply journaled daily attendance upserts in one transaction
+        # (the entry ID is kept on the doc, so a replayed entry is not counted twice). An entry
+        # carrying its image uploads it first and links it only if the upload succeeded; a failed
+        # upload is retried as its own attendance_image entry that links the image once stored
+        items, retries = [], []
+        for entry in entries:
+            item = {**entry["payload"], "entry_id": entry["id"]}
+            image, image_path = item.pop("image", None), item.pop("image_path", None)
+            if image is not None:
+                url = self.storage_service.upload_image(write_behind.decode_bytes(image), image_path)
+                if url:
+                    item["captured_image"] = url
+                else:
+                    retries.append((len(items), {"path": image_path, "image": image}))
+            items.append(item)
+        written = self.attendance_repo.upsert_daily_attendance_batch(items)
+        for i, image in retries:
+            write_behind.enqueue("attendance_image", {**image, "date": items[i]["date"],
+                                                      "attendance_ids": [written[i]["attendance_id"]]})
     
     def mark_attendance_single(self, image_file, user_id: str = None, note: str = None) -> Dict[str, Any]:
         # Mark attendance for 1 face
@@ -56,41 +98,32 @@ class AttendanceService:
                     return {"success": False, "error": "Face does not match student"}
                 
                 matched_user = user
+                class_name = self.user_repo.get_class_names([user.id]).get(user.id)
             else:
-                # Search in all users
-                all_users = self.user_repo.get_all_users()
-                user_dicts = [user.to_dict() for user in all_users]
-                
-                matches = self.face_service.find_matching_users(
-                    encode_result["embedding"],
-                    user_dicts,
-                    Config.MATCH_THRESHOLD
-                )
+                # Search the whole in-memory gallery
+                matches = self._identify(encode_result["embedding"])
                 
                 if not matches:
                     return {"success": False, "error": "No matching student found"}
                 
                 matched_user = self.user_repo.get_user_by_id(matches[0]["user_id"])
+                if not matched_user:
+                    return {"success": False, "error": "Student not found"}
+                class_name = matches[0]["class_name"]
             
-            # Upload attendance image
+            # Journal the attendance upsert together with its image; flushed in the background
             today = date.today().strftime("%Y-%m-%d")
-            attendance_image_url = self.storage_service.upload_attendance_image(
-                resized_image,
-                matched_user.id,
-                today
-            )
-            
-            if not attendance_image_url:
-                return {"success": False, "error": "Error uploading attendance image"}
-            
-            # Record attendance
-            attendance_id = self.attendance_repo.upsert_daily_attendance(
-                matched_user.id,
-                today,
-                "present",
-                attendance_image_url,
-                note
-            )
+            write_behind.enqueue("attendance_upsert", {
+                "user_id": matched_user.id,
+                "date": today,
+                "status": "present",
+                "captured_image": None,
+                "image": write_behind.encode_bytes(resized_image),
+                "image_path": self.storage_service.get_attendance_image_path(matched_user.id, today),
+                "note": note,
+                "class_name": class_name
+            })
+            attendance_id = self.attendance_repo.daily_doc_id(matched_user.id, today)
             
             logger.log_face_recognition(
                 "mark_attendance",
@@ -126,27 +159,20 @@ class AttendanceService:
             if not size_check["valid"]:
                 return {"success": False, "error": size_check["message"]}
             
-            # 2. Resize image
+            # 2. Resize image (stored copy only; back-row faces would fall below detector resolution)
             resized_image = resize_image(image_bytes, (640, 480))
             
-            # 3. Call faceid-service to encode
-            encode_result = self.face_service.encode_face(resized_image)
+            # 3. Call faceid-service to embed every face in the full-resolution photo
+            #    (large photos are detected in overlapping tiles there)
+            encode_result = self.face_service.encode_faces(image_bytes)
             if not encode_result["success"]:
                 return {"success": False, "error": f"Face recognition error: {encode_result['error']}"}
             
-            # 4. Find matching users (can filter by class_id if provided)
-            if class_id:
-                # TODO: Implement filter by class_id when class management is added
-                all_users = self.user_repo.get_all_users()
-            else:
-                all_users = self.user_repo.get_all_users()
-            user_dicts = [user.to_dict() for user in all_users]
-            
-            matches = self.face_service.find_matching_users(
-                encode_result["embedding"],
-                user_dicts,
-                Config.MATCH_THRESHOLD
-            )
+            # 4. Match all faces at once (one student per face, one face per student),
+            #    only within the given classes if class_id is provided
+            class_ids = [c.strip() for c in class_id.split(",") if c.strip()] if class_id else None
+            faces = [face for face in encode_result["faces"] if face.get("embedding")]
+            matches = self._identify_faces(faces, class_ids)
             
             if not matches:
                 return {
@@ -156,56 +182,55 @@ class AttendanceService:
                     "message": "No matching students found"
                 }
             
-            # Process each match
-            results = []
+            # The source photo is stored once and linked from every matched record after the write
             today = date.today().strftime("%Y-%m-%d")
+            image_path = self.storage_service.get_group_attendance_image_path(today, uuid.uuid4().hex)
             
-            for match in matches:
-                try:
-                    # Upload attendance image
-                    attendance_image_url = self.storage_service.upload_attendance_image(
-                        resized_image,
-                        match["user_id"],
-                        f"{today}_{match['user_id']}.jpg"
+            # Record all matches in one transaction; the response is built from the written values
+            results = []
+            try:
+                written = self.attendance_repo.upsert_daily_attendance_batch([
+                    {
+                        "user_id": match["user_id"],
+                        "date": today,
+                        "status": "present",
+                        "captured_image": None,
+                        "note": note,
+                        "class_name": match["class_name"]
+                    }
+                    for match in matches
+                ])
+                write_behind.enqueue("attendance_image", {
+                    "path": image_path,
+                    "image": write_behind.encode_bytes(resized_image),
+                    "date": today,
+                    "attendance_ids": [record["attendance_id"] for record in written]
+                })
+                
+                for match, record in zip(matches, written):
+                    results.append({
+                        "user_id": match["user_id"],
+                        "name": match["name"],
+                        "email": match["email"],
+                        "similarity": match["similarity"],
+                        "distance": match["distance"],
+                        "bbox": match["bbox"],
+                        "matched": True,
+                        "attendance_id": record["attendance_id"],
+                        "first_seen": record["first_seen"].isoformat() if record["first_seen"] else None,
+                        "last_seen": record["last_seen"].isoformat(),
+                        "captures": record["captures"]
+                    })
+                    
+                    logger.log_face_recognition(
+                        "mark_attendance_multi",
+                        user_id=match["user_id"],
+                        similarity=match["similarity"]
                     )
                     
-                    if attendance_image_url:
-                        # Record attendance
-                        attendance_id = self.attendance_repo.upsert_daily_attendance(
-                            match["user_id"],
-                            today,
-                            "present",
-                            attendance_image_url,
-                            note
-                        )
-                        
-                        # Get attendance record information
-                        attendance_record = self.attendance_repo.get_attendance_by_user_and_date(
-                            match["user_id"],
-                            today
-                        )
-                        
-                        results.append({
-                            "user_id": match["user_id"],
-                            "name": match["name"],
-                            "email": match["email"],
-                            "similarity": match["similarity"],
-                            "distance": match["distance"],
-                            "matched": True,
-                            "attendance_id": attendance_id,
-                            "first_seen": attendance_record.first_seen.isoformat() if attendance_record else None,
-                            "last_seen": attendance_record.last_seen.isoformat() if attendance_record else None,
-                            "captures": attendance_record.captures if attendance_record else 0
-                        })
-                        
-                        logger.log_face_recognition(
-                            "mark_attendance_multi",
-                            user_id=match["user_id"],
-                            similarity=match["similarity"]
-                        )
-                        
-                except Exception as e:
-                    logger.log_error("Multi attendance error", user_id=match["user_id"])
+            except Exception as e:
+                logger.log_error("Multi attendance error")
+                for match in matches:
                     results.append({
                         "user_id": match["user_id"],
                         "name": match["name"],
@@ -227,14 +252,252 @@ class AttendanceService:
             logger.log_error("Multi attendance marking error")
             return {"success": False, "error": f"Attendance error: {str(e)}"}
     
+    def mark_attendance_video(self, video_file, note: str = None, class_id: str = None,
+                              sample_fps: float = None, attendance_date: str = None,
+                              recorded_at: str = None) -> Dict[str, Any]:
+        # Mark attendance from a recorded lecture: one record per student identified in any face track
+        # recorded_at: ISO start time of the recording (local time unless it has an offset); needed for a
+        # past date, otherwise the video is taken to have ended at upload
+        try:
+            # 1. Validate video and date
+            video_file.seek(0, 2)
+            video_size = video_file.tell()
+            video_file.seek(0)
+            if video_size == 0:
+                return {"success": False, "error": "Empty video file"}
+            if video_size > Config.VIDEO_MAX_SIZE:
+                return {"success": False, "error": f"Video too large. Maximum {Config.VIDEO_MAX_SIZE // 1024 // 1024}MB"}
+            
+            # Record times are naive UTC, like the other attendance writes
+            start_utc = None
+            if recorded_at:
+                try:
+                    start_utc = datetime.fromisoformat(recorded_at).astimezone(timezone.utc).replace(tzinfo=None)
+                except ValueError:
+                    return {"success": False, "error": "Invalid recorded_at (expected an ISO date and time)"}
+                if start_utc > datetime.utcnow():
+                    return {"success": False, "error": "recorded_at cannot be in the future"}
+                recorded_date = start_utc.replace(tzinfo=timezone.utc).astimezone().strftime("%Y-%m-%d")
+                if attendance_date and attendance_date != recorded_date:
+                    return {"success": False, "error": f"date does not match recorded_at ({recorded_date})"}
+                attendance_date = recorded_date
+            
+            today = date.today().strftime("%Y-%m-%d")
+            attendance_date = attendance_date or today
+            try:
+                datetime.strptime(attendance_date, "%Y-%m-%d")
+            except ValueError:
+                return {"success": False, "error": "Invalid date format (expected YYYY-MM-DD)"}
+            if attendance_date > today:
+                return {"success": False, "error": "Attendance date cannot be in the future"}
+            if attendance_date < today and start_utc is None:
+                return {"success": False, "error": "recorded_at is required for a past date"}
+            
+            # 2. Call faceid-service: sampled detection + IoU tracking, a few embeddings per track
+            encode_result = self.face_service.encode_video(video_file, getattr(video_file, "filename", None), sample_fps)
+            if not encode_result["success"]:
+                return {"success": False, "error": f"Face recognition error: {encode_result['error']}"}
+            tracks = encode_result["tracks"]
+            if start_utc is None:
+                # Uploaded right after the lecture: the recording ended now
+                start_utc = datetime.utcnow() - timedelta(seconds=encode_result["duration"])
+            
+            # 3. Identify every track; a student who left and came back has several tracks,
+            #    so tracks are matched independently and merged per student
+            class_ids = [c.strip() for c in class_id.split(",") if c.strip()] if class_id else None
+            by_user = {}
+            for track in tracks:
+                record = face_gallery.best_match(track["embedding"], self.user_repo.get_gallery_records, class_ids)
+                if record is None:
+                    continue
+                match = by_user.get(record["id"])
+                if match is None:
+                    by_user[record["id"]] = {
+                        "user_id": record["id"],
+                        "name": record["name"],
+                        "email": record["email"],
+                        "class_name": record.get("class_name"),
+                        "similarity": record["similarity"],
+                        "tracks": 1,
+                        "first_seen": track["first_seen"],
+                        "last_seen": track["last_seen"],
+                        "face_image": track.get("face_image")
+                    }
+                    continue
+                match["tracks"] += 1
+                match["first_seen"] = min(match["first_seen"], track["first_seen"])
+                match["last_seen"] = max(match["last_seen"], track["last_seen"])
+                if record["similarity"] > match["similarity"]:
+                    match["similarity"] = record["similarity"]
+                    match["face_image"] = track.get("face_image") or match["face_image"]
+            matches = sorted(by_user.values(), key=lambda m: m["similarity"], reverse=True)
+            
+            # 4. Records are written without images; each student's best face crop (already a base64
+            #    JPEG) is stored in the background under a path of its own, so the kiosk photo of the
+            #    day is not overwritten, and linked once stored. first_seen/last_seen are when the
+            #    student was on the video, not when it was ingested
+            video_id = uuid.uuid4().hex
+            items = []
+            for match in matches:
+                items.append({
+                    "user_id": match["user_id"],
+                    "date": attendance_date,
+                    "status": "present",
+                    "captured_image": None,
+                    "note": note,
+                    "class_name": match["class_name"],
+                    "first_seen": start_utc + timedelta(seconds=match["first_seen"]),
+                    "last_seen": start_utc + timedelta(seconds=match["last_seen"])
+                })
+            
+            # 5. Bulk write, one transaction per WRITE_BEHIND_BATCH_SIZE students
+            results = []
+            batch_size = Config.WRITE_BEHIND_BATCH_SIZE
+            for start in range(0, len(items), batch_size):
+                batch = matches[start:start + batch_size]
+                try:
+                    written = self.attendance_repo.upsert_daily_attendance_batch(items[start:start + batch_size])
+                except Exception as e:
+                    logger.log_error(f"Video attendance write error: {str(e)}")
+                    results.extend({**self._video_result(match), "matched": False, "error": str(e)} for match in batch)
+                    continue
+                for match, record in zip(batch, written):
+                    if match["face_image"]:
+                        write_behind.enqueue("attendance_image", {
+                            "path": self.storage_service.get_video_attendance_image_path(match["user_id"], attendance_date,
+                                                                                        video_id),
+                            "image": match["face_image"],
+                            "date": attendance_date,
+                            "attendance_ids": [record["attendance_id"]]
+                        })
+                    results.append({
+                        **self._video_result(match),
+                        "matched": True,
+                        "attendance_id": record["attendance_id"],
+                        "captures": record["captures"]
+                    })
+            
+            logger.log_face_recognition(
+                "mark_attendance_video",
+                tracks=len(tracks),
+                matched=len(matches),
+                duration=encode_result["duration"],
+                processing_seconds=encode_result["processing_seconds"],
+                classes=class_ids
+            )
+            return {
+                "success": True,
+                "date": attendance_date,
+                "results": results,
+                "tracks": len(tracks),
+                "unmatched_tracks": len(tracks) - sum(m["tracks"] for m in matches),
+                "duration": encode_result["duration"],
+                "frames_sampled": encode_result["frames_sampled"],
+                "processing_seconds": encode_result["processing_seconds"],
+                "message": f"Identified {len(matches)} students in {len(tracks)} face tracks"
+            }
+            
+        except Exception as e:
+            logger.log_error("Video attendance marking error")
+            return {"success": False, "error": f"Attendance error: {str(e)}"}
+    
+    @staticmethod
+    def _video_result(match: Dict[str, Any]) -> Dict[str, Any]:
+        # Per-student fields of a video attendance result (times are seconds into the video)
+        return {
+            "user_id": match["user_id"],
+            "name": match["name"],
+            "email": match["email"],
+            "similarity": match["similarity"],
+            "distance": 1 - match["similarity"],
+            "tracks": match["tracks"],
+            "first_seen": match["first_seen"],
+            "last_seen": match["last_seen"]
+        }
+    
+    def _identify_faces(self, faces: List[Dict[str, Any]], class_ids: List[str] = None) -> List[Dict[str, Any]]:
+        # Jointly match the faces of one photo against the gallery; unmatched faces are dropped
+        assigned = face_gallery.assign(
+            [face["embedding"] for face in faces], self.user_repo.get_gallery_records, class_ids
+        )
+        matches = [
+            {
+                "user_id": record["id"],
+                "name": record["name"],
+                "email": record["email"],
+                "class_name": record.get("class_name"),
+                "similarity": record["similarity"],
+                "distance": 1 - record["similarity"],
+                "bbox": face.get("bbox")
+            }
+            for face, record in zip(faces, assigned) if record is not None
+        ]
+        matches.sort(key=lambda m: m["similarity"], reverse=True)
+        logger.log_face_recognition(
+            "find_matches_multi",
+            faces=len(faces),
+            matched=len(matches),
+            classes=class_ids
+        )
+        return matches
+    
+    def _identify(self, embedding: str, class_ids: List[str] = None) -> List[Dict[str, Any]]:
+        # Match an embedding against the in-memory gallery (one class shard per class ID, or everyone)
+        matches = [
+            {
+                "user_id": record["id"],
+                "name": record["name"],
+                "email": record["email"],
+                "class_name": record.get("class_name"),
+                "similarity": record["similarity"],
+                "distance": 1 - record["similarity"]
+            }
+            for record in face_gallery.search(embedding, self.user_repo.get_gallery_records, class_ids)
+        ]
+        logger.log_face_recognition(
+            "find_matches",
+            similarity=matches[0]["similarity"] if matches else 0.0,
+            classes=class_ids
+        )
+        return matches
+    
+    def check_gallery(self, repair: bool = False) -> Dict[str, Any]:
+        # Diff the in-memory gallery (and the faceid index, when mirrored) against Firestore
+        # repair=True drops the gallery for a reload and re-syncs the faceid index from Firestore
+        try:
+            records = self.user_repo.get_gallery_records()
+            gallery = face_gallery.check(lambda _: records)
+            result = {"success": True, "gallery": gallery, "consistent": gallery["consistent"]}
+            
+            if Config.FACEID_INDEX_SYNC:
+                entries = [entry for entry in (index_entry(record) for record in records) if entry]
+                index = self.face_service.check_gallery_index([{"id": e["id"], "embedding": e["embedding"]} for e in entries])
+                result["faceid_index"] = index
+                result["consistent"] = result["consistent"] and index.get("consistent", False)
+            
+            if repair and not result["consistent"]:
+                face_gallery.invalidate()
+                if Config.FACEID_INDEX_SYNC:
+                    result["faceid_sync"] = self.face_service.sync_gallery_index(entries)
+                result["repaired"] = True
+            
+            logger.log_face_recognition("gallery_check", consistent=result["consistent"], repaired=result.get("repaired", False))
+            return result
+            
+        except Exception as e:
+            logger.log_error("Gallery check error")
+            return {"success": False, "error": f"Gallery check error: {str(e)}"}
+    
     def get_daily_attendance(self, attendance_date: str, limit: int = 100, class_id: str = None) -> Dict[str, Any]:
         # Get attendance list by date
         try:
             records = self.attendance_repo.get_attendance_by_date(attendance_date, limit)
             
+            users = self.user_repo.get_users_by_ids([record.user_id for record in records])
+            
             results = []
             for record in records:
-                user = self.user_repo.get_user_by_id(record.user_id)
+                user = users.get(record.user_id)
                 if user:
                     # TODO: Filter by class_id when class management is implemented
                     # if class_id and user.class_id != class_id:
@@ -296,7 +559,8 @@ class AttendanceService:
     def mark_absent_batch(self, user_ids: List[str], attendance_date: str) -> Dict[str, Any]:
         # Mark absent in bulk
         try:
-            created_count = self.attendance_repo.mark_absent_batch(user_ids, attendance_date)
+            class_names = self.user_repo.get_class_names(user_ids)
+            created_count = self.attendance_repo.mark_absent_batch(user_ids, attendance_date, class_names)
             
             return {
                 "success": True,
@@ -308,3 +572,37 @@ class AttendanceService:
         except Exception as e:
             logger.log_error("Batch absent marking error")
             return {"success": False, "error": f"Error marking absent: {str(e)}"}
+    
+    def rebuild_rollups(self, start_date: str, end_date: str) -> Dict[str, Any]:
+        # Recount the daily rollups of a date range from the attendance records, with each
+        # student's current class (backfill for dates written before rollups carried classes)
+        try:
+            rebuilt = self.attendance_repo.rebuild_rollups(start_date, end_date, self.user_repo.get_class_names)
+            
+            return {
+                "success": True,
+                "start_date": start_date,
+                "end_date": end_date,
+                "dates": rebuilt,
+                "message": f"Rebuilt rollups of {len(rebuilt)} days"
+            }
+            
+        except Exception as e:
+            logger.log_error("Rebuild rollups error")
+            return {"success": False, "error": f"Error rebuilding rollups: {str(e)}"}
+    
+    def get_attendance_stats(self, start_date: str, end_date: str) -> Dict[str, Any]:
+        # Get attendance statistics for a date range (served from daily rollups)
+        try:
+            stats = self.attendance_repo.get_attendance_stats(start_date, end_date)
+            
+            return {
+                "success": True,
+                "start_date": start_date,
+                "end_date": end_date,
+                "stats": stats
+            }
+            
+        except Exception as e:
+            logger.log_error("Get attendance stats error")
+            return {"success": False, "error": f"Error getting statistics: {str(e)}"}
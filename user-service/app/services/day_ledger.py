@@ -0,0 +1,93 @@
+# In-memory ledger of the current day's attendance events (per process)
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set
+
+
+class DayLedger:
+    # Keeps today's attendance events in memory so status checks avoid Firestore queries.
+    # Loaded once per date, updated write-through, and rolled over when the date changes.
+    # Events carry a stable "event_id" (attendance doc / journal entry ID); an event already
+    # returned by the loader is not indexed a second time by record().
+
+    def __init__(self, loader: Callable[[str], List[Dict]]):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._date: Optional[str] = None
+        self._events: List[Dict] = []
+        self._by_student: Dict[str, List[Dict]] = {}
+        self._types_by_student: Dict[str, Set[str]] = {}
+        self._ids: Set[str] = set()
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now().strftime("%Y-%m-%d")
+
+    def _index(self, event: Dict):
+        event_id = event.get("event_id")
+        if event_id:
+            if event_id in self._ids:
+                return
+            self._ids.add(event_id)
+        sid = event.get("student_id", "unknown")
+        self._events.append(event)
+        self._by_student.setdefault(sid, []).append(event)
+        if event.get("type"):
+            self._types_by_student.setdefault(sid, set()).add(event["type"])
+
+    def _ensure_current(self) -> str:
+        # Must be called with the lock held; reloads on first use and at midnight
+        today = self._today()
+        if self._date != today:
+            events = self._loader(today)
+            self._date = today
+            self._events = []
+            self._by_student = {}
+            self._types_by_student = {}
+            self._ids = set()
+            for event in events:
+                self._index(event)
+        return today
+
+    def record(self, event: Dict):
+        """Write-through update after an event has been persisted."""
+        with self._lock:
+            today = self._ensure_current()
+            if event.get("date") == today:
+                self._index(dict(event))
+
+    def events(self) -> List[Dict]:
+        """All events recorded today."""
+        with self._lock:
+            self._ensure_current()
+            return [dict(e) for e in self._events]
+
+    def events_for_student(self, student_id: str) -> List[Dict]:
+        """Today's events for one student."""
+        with self._lock:
+            self._ensure_current()
+            return [dict(e) for e in self._by_student.get(student_id, [])]
+
+    def has_event(self, student_id: str, event_type: str) -> bool:
+        """O(1) check whether a student has an event of the given type today."""
+        with self._lock:
+            self._ensure_current()
+            return event_type in self._types_by_student.get(student_id, ())
+
+    def types_by_student(self) -> Dict[str, Set[str]]:
+        """Event types recorded today per student."""
+        with self._lock:
+            self._ensure_current()
+            return {sid: set(types) for sid, types in self._types_by_student.items()}
+
+    def sequence(self) -> str:
+        """Token for today's events (date and event count); changes with every recorded event,
+        including journaled ones not yet flushed to Firestore."""
+        with self._lock:
+            today = self._ensure_current()
+            return f"{today}:{len(self._events)}"
+
+    def invalidate(self):
+        """Force a reload from the source on next access."""
+        with self._lock:
+            self._date = None
@@ -1,7 +1,7 @@
 # Call faceid-service via HTTP
 import requests
 import json
-from typing import List
+from typing import List, Optional, Tuple
 
 class FaceAuthService:
     # Service calling faceid-service to handle face recognition 
@@ -21,6 +21,18 @@ class FaceAuthService:
             return response.get("embedding", "")
         raise Exception(response.get("message", "Face encoding failed"))
 
+    def encode_with_bbox(self, image_bytes: bytes) -> Tuple[str, Optional[List[int]]]:
+        # Encode one face and also return its box [x1, y1, x2, y2] (kiosk face tracks)
+        files = {"image": ("face.jpg", image_bytes, "image/jpeg")}
+        r = requests.post(f"{self.base_url}/encode-face", files=files, timeout=20)
+        try:
+            response = r.json()
+        except Exception:
+            raise Exception(f"Face encoding failed: {r.text}")
+        if response.get("success"):
+            return response.get("embedding", ""), response.get("bbox")
+        raise Exception(response.get("message", "Face encoding failed"))
+
     def compare(self, emb1, emb2):
         import base64
         import numpy as np
@@ -4,6 +4,8 @@ import numpy as np
 from typing import Dict, Any, List, Tuple
 from ..config.settings import Config
 from ..utils.logger import logger
+from ..utils.write_behind import write_behind
+from ..utils.face_gallery import face_gallery, decode_embedding
 
 class FaceRecognitionService:
     # Service calling faceid-service to handle face recognition
@@ -11,6 +13,73 @@ class FaceRecognitionService:
     def __init__(self):
         self.faceid_url = Config.FACEID_SERVICE_URL
         self.timeout = Config.FACEID_TIMEOUT / 1000  # Convert to seconds
+        
+        # Gallery writes mirrored into the faceid-service index (see FaceGallery._push_index)
+        if Config.FACEID_INDEX_SYNC:
+            write_behind.register("face_index", self._flush_index_updates)
+            # Identification against the (synced) faceid index instead of the in-process gallery
+            if Config.FACEID_IDENTIFY:
+                face_gallery.set_remote(self.identify, Config.FACEID_IDENTIFY_TOP_K)
+    
+    def _flush_index_updates(self, entries: List[Dict]):
+        # Write-behind handler: apply the latest journaled change per user to the faceid index
+        latest = {}
+        for entry in entries:
+            latest[entry["payload"]["id"]] = entry["payload"]
+        for payload in latest.values():
+            if payload["op"] == "remove":
+                response = requests.delete(f"{self.faceid_url}/gallery/{payload['id']}", timeout=self.timeout)
+            else:
+                body = {"embedding": payload["embedding"], "meta": payload.get("meta") or {}}
+                if payload.get("templates"):
+                    body["templates"] = payload["templates"]
+                response = requests.put(f"{self.faceid_url}/gallery/{payload['id']}", json=body, timeout=self.timeout)
+            if response.status_code != 200:
+                raise Exception(f"FaceID index update failed: HTTP {response.status_code}")
+    
+    def sync_gallery_index(self, entries: List[Dict]) -> Dict[str, Any]:
+        # Replace the faceid index with entries [{"id", "embedding", "meta"}] (embedding as base64 float32)
+        try:
+            response = requests.post(f"{self.faceid_url}/gallery/sync", json={"entries": entries}, timeout=60)
+            return response.json()
+        except Exception as e:
+            logger.log_error("FaceID index sync error")
+            return {'success': False, 'error': f'FaceID index sync error: {str(e)}'}
+    
+    def check_gallery_index(self, entries: List[Dict]) -> Dict[str, Any]:
+        # Diff the faceid index against entries [{"id", "embedding"}] from the source of truth
+        try:
+            response = requests.post(f"{self.faceid_url}/gallery/check", json={"entries": entries}, timeout=60)
+            return response.json()
+        except Exception as e:
+            logger.log_error("FaceID index check error")
+            return {'success': False, 'error': f'FaceID index check error: {str(e)}'}
+    
+    def identify(self, embeddings: List, top_k: int, threshold: float):
+        # (top-k faceid index matches per embedding as gallery records with "similarity", index size);
+        # None when faceid-service can't answer (callers fall back to the local gallery)
+        try:
+            encoded = []
+            for embedding in embeddings:
+                vector = decode_embedding(embedding)
+                if vector is None:
+                    return None
+                encoded.append(base64.b64encode(vector.astype(np.float32).tobytes()).decode("utf-8"))
+            response = requests.post(
+                f"{self.faceid_url}/identify",
+                json={"embeddings": encoded, "top_k": top_k, "threshold": threshold},
+                timeout=self.timeout
+            )
+            result = response.json()
+            if response.status_code != 200 or not result.get("success"):
+                raise Exception(result.get("message") or f"HTTP {response.status_code}")
+            return [
+                [{**(m.get("meta") or {}), "id": m["id"], "similarity": float(m["similarity"])} for m in matches]
+                for matches in result["results"]
+            ], result.get("size")
+        except Exception as e:
+            logger.log_error(f"FaceID identify error, using the local gallery: {str(e)}")
+            return None
     
     def encode_face(self, image_bytes: bytes) -> Dict[str, Any]:
         # Call faceid-service to encode face
@@ -66,6 +135,64 @@ class FaceRecognitionService:
                 'error': f'Error calling FaceID service: {str(e)}'
             }
     
+    def encode_faces(self, image_bytes: bytes) -> Dict[str, Any]:
+        # Call faceid-service to embed every face of a group photo
+        try:
+            files = {'image': ('group.jpg', image_bytes, 'image/jpeg')}
+            response = requests.post(
+                f"{self.faceid_url}/encode-faces",
+                files=files,
+                timeout=max(self.timeout, 30)  # full-resolution photos are detected in tiles, then embedded in batches
+            )
+            
+            data = response.json()
+            if response.status_code == 200 and data.get('success'):
+                return {'success': True, 'faces': data.get('faces', [])}
+            return {'success': False, 'error': data.get('message') or data.get('error', f"HTTP {response.status_code}")}
+            
+        except requests.exceptions.Timeout:
+            logger.log_error("FaceID service timeout")
+            return {'success': False, 'error': 'FaceID service not responding'}
+        except requests.exceptions.ConnectionError:
+            logger.log_error("FaceID service connection error")
+            return {'success': False, 'error': 'Cannot connect to FaceID service'}
+        except Exception as e:
+            logger.log_error("FaceID service error")
+            return {'success': False, 'error': f'Error calling FaceID service: {str(e)}'}
+    
+    def encode_video(self, video_file, filename: str = None, sample_fps: float = None) -> Dict[str, Any]:
+        # Call faceid-service to track the faces of a recorded video (one averaged embedding per track)
+        try:
+            files = {'video': (filename or 'video.mp4', video_file, 'application/octet-stream')}
+            form = {'sample_fps': str(sample_fps)} if sample_fps else {}
+            response = requests.post(
+                f"{self.faceid_url}/encode-video",
+                files=files,
+                data=form,
+                timeout=Config.VIDEO_TIMEOUT
+            )
+            
+            data = response.json()
+            if response.status_code == 200 and data.get('success'):
+                return {
+                    'success': True,
+                    'tracks': data.get('tracks', []),
+                    'duration': data.get('duration', 0.0),
+                    'frames_sampled': data.get('frames_sampled', 0),
+                    'processing_seconds': data.get('processing_seconds', 0.0)
+                }
+            return {'success': False, 'error': data.get('message') or data.get('error', f"HTTP {response.status_code}")}
+            
+        except requests.exceptions.Timeout:
+            logger.log_error("FaceID service timeout")
+            return {'success': False, 'error': 'FaceID service not responding'}
+        except requests.exceptions.ConnectionError:
+            logger.log_error("FaceID service connection error")
+            return {'success': False, 'error': 'Cannot connect to FaceID service'}
+        except Exception as e:
+            logger.log_error("FaceID service error")
+            return {'success': False, 'error': f'Error calling FaceID service: {str(e)}'}
+    
     def compare_faces(self, embedding1: str, embedding2: str) -> Dict[str, Any]:
         # Compare 2 face embeddings
         try:
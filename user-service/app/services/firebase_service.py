@@ -2,12 +2,18 @@
 # Set environment variables:
 #   GOOGLE_APPLICATION_CREDENTIALS=path/to/credentials.json
 #   FIREBASE_PROJECT_ID=your_project_id
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from google.cloud import firestore
 from google.oauth2 import service_account
 import os
 import json
 from datetime import datetime
+from .day_ledger import DayLedger
+from ..utils.change_feed import STUDENT_FIELDS, change_feed, publish_student, to_student
+from ..utils.write_behind import write_behind
+from ..utils.history_cache import history_cache
+from ..utils.conditional import versions
+from ..utils.face_gallery import face_gallery, gallery_record, load_gallery_records
 
 class FirebaseService:
     # Service to connect and interact with Firebase Firestore
@@ -44,6 +50,16 @@ class FirebaseService:
             self.db = None
             self.init_error = str(e)
 
+        # Today's events, kept in memory for O(1) check-in/check-out status checks
+        self.ledger = DayLedger(self._load_day_events)
+
+        # Sequence of roster/attendance changes, served to pollers as deltas
+        # (shared with UserRepository, whose writes publish to it too)
+        self.changes = change_feed
+
+        # Check-in/check-out events are journaled and written to Firestore in the background
+        write_behind.register("attendance_event", self._flush_attendance_events)
+
     def _ensure_db(self):
         if not self.db:
             details = {
@@ -60,6 +76,7 @@ class FirebaseService:
         user_data = {
             "username": user.username,
             "embedding": user.embedding,
+            "templates": getattr(user, 'templates', None) or [],
             "student_id": getattr(user, 'student_id', None),
             "full_name": getattr(user, 'full_name', None),
             "class_name": getattr(user, 'class_name', None),
@@ -69,6 +86,9 @@ class FirebaseService:
             "updated_at": datetime.now().isoformat()
         }
         self.db.collection("users").document(user.username).set(user_data)
+        versions.bump("users")
+        face_gallery.upsert(gallery_record(user.username, user_data))
+        publish_student(user_data)
 
     def get_user(self, username: str) -> Optional[dict]:
         self._ensure_db()
@@ -89,37 +109,69 @@ class FirebaseService:
             "init_error": getattr(self, "init_error", None)
         }
     
+    # Public student fields and the user-doc fields each one is derived from
+    STUDENT_FIELDS = STUDENT_FIELDS
+    _STUDENT_SOURCE_FIELDS = {
+        "student_id": ["student_id", "email"],
+        "username": ["username", "student_id", "email"],
+        "full_name": ["full_name", "name"],
+        "class_name": ["class_name"],
+        "embedding": ["embedding", "face_encoding"],
+    }
+
+    def _to_student(self, data: Dict, fields=STUDENT_FIELDS) -> Optional[Dict]:
+        """Map a user doc (student or legacy name/email shape) to the student dict, limited to fields."""
+        return to_student(data, fields)
+
     def get_all_students(self) -> List[Dict]:
         """Get list of all students"""
         self._ensure_db()
         docs = self.db.collection("users").stream()
         students = []
         for doc in docs:
-            data = doc.to_dict()
-            
-            if data.get('student_id') and data.get('full_name'):
-                student = {
-                    'student_id': data.get('student_id'),
-                    'username': data.get('username', data.get('student_id')),
-                    'full_name': data.get('full_name'),
-                    'class_name': data.get('class_name', 'Unassigned'),
-                    'embedding': data.get('embedding', '')
-                }
-                students.append(student)
-            
-            elif data.get('name') and data.get('email'):
-                embedding_base64 = data.get('face_encoding', '')
-                
-                student = {
-                    'student_id': data.get('email', 'unknown'),
-                    'username': data.get('email', 'unknown'),
-                    'full_name': data.get('name', 'Unknown'),
-                    'class_name': 'Unassigned',
-                    'embedding': embedding_base64
-                }
+            student = self._to_student(doc.to_dict())
+            if student:
                 students.append(student)
-        
         return students
+
+    def get_gallery_records(self, class_names: Optional[List[str]] = None) -> List[Dict]:
+        """Face gallery records for the given classes (None = every class)."""
+        self._ensure_db()
+        return load_gallery_records(self.db, class_names)
+
+    def get_students_page(self, fields=None, limit: Optional[int] = None,
+                          cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Get a page of students with only the requested fields (embeddings excluded by default).
+        Only the needed user-doc fields are read (server-side select). Pages are ordered by
+        document ID; pass the returned cursor to continue. Returns (students, next_cursor)."""
+        self._ensure_db()
+        fields = tuple(fields) if fields else tuple(f for f in self.STUDENT_FIELDS if f != "embedding")
+
+        # Always read the fields that decide the doc shape
+        source_fields = {"student_id", "full_name", "name", "email"}
+        for f in fields:
+            source_fields.update(self._STUDENT_SOURCE_FIELDS[f])
+
+        query = (self.db.collection("users")
+                 .select(sorted(source_fields))
+                 .order_by(firestore.FieldPath.document_id()))
+        if cursor:
+            query = query.start_after({firestore.FieldPath.document_id(): cursor})
+        if limit:
+            query = query.limit(limit)
+
+        students = []
+        last_id = None
+        count = 0
+        for doc in query.stream():
+            count += 1
+            last_id = doc.id
+            student = self._to_student(doc.to_dict(), fields)
+            if student:
+                students.append(student)
+
+        next_cursor = last_id if limit and count == limit else None
+        return students, next_cursor
     
     def save_attendance(self, student_id: str, timestamp: datetime):
         """Save attendance record"""
@@ -130,7 +182,16 @@ class FirebaseService:
             "timestamp": timestamp.isoformat(),
             "status": "present"
         }
-        self.db.collection("attendance").add(attendance_data)
+        doc_ref = self.db.collection("attendance").document()
+        batch = self.db.batch()
+        batch.set(doc_ref, attendance_data)
+        self._apply_session_summaries(batch, [attendance_data])
+        versions.bump(f"attendance:{attendance_data['date']}", batch)
+        batch.commit()
+        event = {**attendance_data, "event_id": doc_ref.id}
+        self.ledger.record(event)
+        self.changes.append("attendance", event)
+        history_cache.invalidate(attendance_data["date"])
         return True
 
     def save_attendance_event(self, student_id: str, timestamp: datetime, event_type: str):
@@ -143,50 +204,202 @@ class FirebaseService:
             "type": event_type
         }
         print(f"DEBUG: Saving attendance event: {data}")
-        doc_ref = self.db.collection("attendance").add(data)
-        print(f"DEBUG: Attendance event saved with doc_ref: {doc_ref}")
+        entry_id = write_behind.enqueue("attendance_event", data)
+        print(f"DEBUG: Attendance event journaled with id: {entry_id}")
+        # The journal entry ID becomes the attendance doc ID when flushed
+        event = {**data, "event_id": entry_id}
+        self.ledger.record(event)
+        self.changes.append("attendance", event)
+        # The date's version is bumped when the event is flushed (see _flush_attendance_events)
         return True
+
+    def _flush_attendance_events(self, entries: List[Dict]):
+        """Write-behind handler: commit journaled events in one batch (journal ID as doc ID, so retries are idempotent)."""
+        self._ensure_db()
+        batch = self.db.batch()
+        for entry in entries:
+            batch.set(self.db.collection("attendance").document(entry["id"]), entry["payload"])
+        self._apply_session_summaries(batch, [entry["payload"] for entry in entries])
+        for attendance_date in {entry["payload"].get("date") for entry in entries}:
+            versions.bump(f"attendance:{attendance_date}", batch)
+        batch.commit()
+        for attendance_date in {entry["payload"].get("date") for entry in entries}:
+            history_cache.invalidate(attendance_date)
     
+    def _apply_session_summaries(self, batch, events: List[Dict]):
+        """Fold events into the per-day session summary docs, in the same batch as the event writes.
+        Check-in/check-out times are stored as epoch seconds so Minimum/Maximum transforms keep the
+        first check-in and last check-out without a read, and replays are idempotent."""
+        by_date: Dict[str, Dict[str, Dict]] = {}
+        for e in events:
+            students = by_date.setdefault(e.get("date"), {})
+            entry = students.setdefault(e.get("student_id", "unknown"), {"types": set(), "checkin": None, "checkout": None})
+            event_type = e.get("type") or "attendance"
+            entry["types"].add(event_type)
+            try:
+                ts = datetime.fromisoformat(e["timestamp"]).timestamp()
+            except Exception:
+                continue
+            if event_type == "checkin":
+                entry["checkin"] = ts if entry["checkin"] is None else min(entry["checkin"], ts)
+            elif event_type == "checkout":
+                entry["checkout"] = ts if entry["checkout"] is None else max(entry["checkout"], ts)
+
+        for date_str, students in by_date.items():
+            summary_students = {}
+            for sid, entry in students.items():
+                update = {"types": firestore.ArrayUnion(sorted(entry["types"]))}
+                if entry["checkin"] is not None:
+                    update["checkin_ts"] = firestore.Minimum(entry["checkin"])
+                if entry["checkout"] is not None:
+                    update["checkout_ts"] = firestore.Maximum(entry["checkout"])
+                summary_students[sid] = update
+            batch.set(
+                self.db.collection("attendance_summaries").document(date_str),
+                {"date": date_str, "students": summary_students},
+                merge=True
+            )
+
+    def get_changes(self, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """Roster and attendance changes since cursor. Unknown, stale or missing cursors get a
+        full snapshot (reset=True) so the client can rebuild its state and continue from there."""
+        self._ensure_db()
+        today = datetime.now().strftime("%Y-%m-%d")
+        changes, next_cursor = self.changes.since(cursor)
+        if changes is None:
+            # Cursor taken before the snapshot: changes racing with it are re-sent, never lost
+            students, _ = self.get_students_page()
+            return {
+                "reset": True,
+                "date": today,
+                "students": students,
+                "attendance": self.ledger.events(),
+                "cursor": next_cursor
+            }
+        return {
+            "reset": False,
+            "date": today,
+            "students": [c["data"] for c in changes if c["kind"] == "student"],
+            "attendance": [c["data"] for c in changes if c["kind"] == "attendance"],
+            "cursor": next_cursor
+        }
+
     def get_attendance_today(self) -> List[Dict]:
         """Get today's attendance list"""
         self._ensure_db()
-        today = datetime.now().strftime("%Y-%m-%d")
-        docs = self.db.collection("attendance").where("date", "==", today).stream()
-        return [doc.to_dict() for doc in docs]
+        return self.ledger.events()
+
+    def get_attendance_sequence(self) -> str:
+        """Token that changes whenever today's attendance changes, before the events are flushed
+        and the date's version is bumped (see DayLedger.sequence)."""
+        self._ensure_db()
+        return self.ledger.sequence()
 
     def get_today_events_for_student(self, student_id: str) -> List[Dict]:
         """Get all today's events for a student (checkin/checkout)."""
         self._ensure_db()
-        today = datetime.now().strftime("%Y-%m-%d")
-        print(f"DEBUG: Getting events for student {student_id} on {today}")
-        docs = self.db.collection("attendance").where("date", "==", today).where("student_id", "==", student_id).stream()
-        events = [doc.to_dict() for doc in docs]
-        print(f"DEBUG: Found {len(events)} events for student {student_id}: {events}")
-        return events
+        return self.ledger.events_for_student(student_id)
 
     def has_checked_in_today(self, student_id: str) -> bool:
-        events = self.get_today_events_for_student(student_id)
-        return any(e.get("type") == "checkin" for e in events)
+        self._ensure_db()
+        return self.ledger.has_event(student_id, "checkin")
 
     def has_checked_out_today(self, student_id: str) -> bool:
-        events = self.get_today_events_for_student(student_id)
-        return any(e.get("type") == "checkout" for e in events)
+        self._ensure_db()
+        return self.ledger.has_event(student_id, "checkout")
     
     def has_attendance_today(self, student_id: str) -> bool:
         """Check if student has attended today"""
-        events = self.get_today_events_for_student(student_id)
-        return any(e.get("type") == "attendance" for e in events)
+        self._ensure_db()
+        return self.ledger.has_event(student_id, "attendance")
+
+    def get_attendance_statuses(self, date_str: str, student_ids: Optional[List[str]] = None) -> Dict[str, str]:
+        """Status per student for a date: not_checked / checked_in / completed.
+        Today comes from the in-memory ledger, other dates from the cached event list.
+        Without student_ids every student on the roster is included."""
+        self._ensure_db()
+        if date_str == datetime.now().strftime("%Y-%m-%d"):
+            types_by_student = self.ledger.types_by_student()
+        else:
+            types_by_student: Dict[str, set] = {}
+            for e in self.get_attendance_by_date(date_str):
+                types_by_student.setdefault(e.get("student_id", "unknown"), set()).add(e.get("type") or "attendance")
+
+        if student_ids is None:
+            students, _ = self.get_students_page(fields=["student_id"])
+            student_ids = [s["student_id"] for s in students]
+
+        statuses = {}
+        for sid in student_ids:
+            types = types_by_student.get(sid, ())
+            # /checkin records its event as "attendance"
+            if "checkin" in types or "attendance" in types:
+                statuses[sid] = "completed" if "checkout" in types else "checked_in"
+            else:
+                statuses[sid] = "not_checked"
+        return statuses
 
     def get_attendance_by_date(self, date_str: str) -> List[Dict]:
-        """Get all attendance records by date (including type)."""
+        """Get all attendance records by date (including type). Past dates are served from the history cache."""
         self._ensure_db()
+        return history_cache.get_or_load("attendance_events", date_str, lambda: self._query_attendance_by_date(date_str))
+
+    def _query_attendance_by_date(self, date_str: str) -> List[Dict]:
         docs = self.db.collection("attendance").where("date", "==", date_str).stream()
         return [doc.to_dict() for doc in docs]
 
+    def _load_day_events(self, date_str: str) -> List[Dict]:
+        """Events for a date, including journaled ones not yet flushed to Firestore, each with
+        its "event_id". Pending entries are read first; one flushed before the query returns it
+        is the same doc (journal ID = doc ID) and is kept once."""
+        pending = [e for e in write_behind.pending_entries("attendance_event") if e["payload"].get("date") == date_str]
+        self._ensure_db()
+        docs = self.db.collection("attendance").where("date", "==", date_str).stream()
+        events = {doc.id: {**doc.to_dict(), "event_id": doc.id} for doc in docs}
+        for entry in pending:
+            events.setdefault(entry["id"], {**entry["payload"], "event_id": entry["id"]})
+        return list(events.values())
+
     def summarize_sessions(self, date_str: str) -> List[Dict]:
         """Summarize sessions by student: first checkin, last checkout, duration (minutes)."""
         self._ensure_db()
-        records = self.get_attendance_by_date(date_str)
+        return history_cache.get_or_load("session_summary", date_str, lambda: self._summarize_sessions(date_str))
+
+    def _summarize_sessions(self, date_str: str) -> List[Dict]:
+        doc = self.db.collection("attendance_summaries").document(date_str).get()
+        if not doc.exists or not doc.to_dict().get("seeded"):
+            # Dates recorded before summary docs existed, or a doc started mid-day that misses earlier events
+            return self._seed_session_summary(date_str)
+
+        summary = []
+        for sid, entry in (doc.to_dict().get("students") or {}).items():
+            checkin_ts = entry.get("checkin_ts")
+            checkout_ts = entry.get("checkout_ts")
+            duration_min = 0
+            if checkin_ts is not None and checkout_ts is not None:
+                duration_min = int((checkout_ts - checkin_ts) // 60)
+            summary.append({
+                "student_id": sid,
+                "date": date_str,
+                "checkin": datetime.fromtimestamp(checkin_ts).isoformat() if checkin_ts is not None else None,
+                "checkout": datetime.fromtimestamp(checkout_ts).isoformat() if checkout_ts is not None else None,
+                "duration_min": duration_min
+            })
+        return summary
+
+    def _seed_session_summary(self, date_str: str) -> List[Dict]:
+        """Fold a day's recorded events into its summary doc once and mark it seeded, so later reads use the doc.
+        The merges are Minimum/Maximum/ArrayUnion, so events already in the doc or flushed meanwhile count once."""
+        records = self._query_attendance_by_date(date_str)
+        batch = self.db.batch()
+        self._apply_session_summaries(batch, records)
+        batch.set(self.db.collection("attendance_summaries").document(date_str),
+                  {"date": date_str, "seeded": True}, merge=True)
+        batch.commit()
+        return self._aggregate_sessions(date_str, records)
+
+    def _aggregate_sessions(self, date_str: str, records: List[Dict]) -> List[Dict]:
+        """Re-aggregate a day's raw event stream into session summaries."""
         by_student: Dict[str, List[Dict]] = {}
         for r in records:
             by_student.setdefault(r.get("student_id", "unknown"), []).append(r)
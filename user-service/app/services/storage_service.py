@@ -25,7 +25,7 @@ class StorageService:
                 f.write(image_bytes)
             
             # Return temporary local URL
-            public_url = f"http://localhost:5002/{local_path}"
+            public_url = self.get_public_url(file_path)
             
             logger.log_request("upload_image", f"/storage/{file_path}")
             return public_url
@@ -34,6 +34,10 @@ class StorageService:
             logger.log_error(str(e))
             return None
     
+    def get_public_url(self, file_path: str) -> str:
+        # URL an uploaded file is served from (known before the upload happens)
+        return f"http://localhost:5002/uploads/{file_path}"
+    
     def upload_face_image(self, image_bytes: bytes, user_id: str, filename: str = None) -> Optional[str]:
         # Upload face image for user
         if not filename:
@@ -42,10 +46,23 @@ class StorageService:
         file_path = f"faces/{user_id}/{filename}"
         return self.upload_image(image_bytes, file_path)
     
+    def get_attendance_image_path(self, user_id: str, attendance_date: str) -> str:
+        # Storage path of a user's attendance image for a date
+        filename = f"attendance_{attendance_date}_{user_id}.jpg"
+        return f"attendance/{attendance_date}/{user_id}/{filename}"
+    
+    def get_group_attendance_image_path(self, attendance_date: str, photo_id: str) -> str:
+        # Storage path of a multi-face attendance photo shared by all matched users
+        return f"attendance/{attendance_date}/group/attendance_{attendance_date}_{photo_id}.jpg"
+    
+    def get_video_attendance_image_path(self, user_id: str, attendance_date: str, video_id: str) -> str:
+        # Storage path of a user's face crop from one recorded video (kept apart from the kiosk photo)
+        filename = f"attendance_{attendance_date}_{user_id}_video_{video_id}.jpg"
+        return f"attendance/{attendance_date}/{user_id}/{filename}"
+    
     def upload_attendance_image(self, image_bytes: bytes, user_id: str, attendance_date: str) -> Optional[str]:
         # Upload attendance image
-        filename = f"attendance_{attendance_date}_{user_id}.jpg"
-        file_path = f"attendance/{attendance_date}/{user_id}/{filename}"
+        file_path = self.get_attendance_image_path(user_id, attendance_date)
         return self.upload_image(image_bytes, file_path)
     
     def delete_image(self, file_path: str) -> bool:
@@ -9,6 +9,9 @@ from ..models.user_models import User
 
 class UserService:
     # Service handling business logic for User
+    
+    # Fields exposed by the user listing endpoints (face_encoding is never listed)
+    USER_FIELDS = ("id", "name", "email", "image_path", "created_at", "updated_at")
 
     def __init__(self):
         self.user_repo = UserRepository()
@@ -133,6 +136,10 @@ class UserService:
         # Get list of all students
         return self.user_repo.get_all_users()
     
+    def get_users_page(self, fields: list, limit: int = None, cursor: str = None) -> tuple:
+        # Get a page of students with only the requested fields; returns (users, next_cursor)
+        return self.user_repo.get_users_page(fields, limit, cursor)
+    
     def search_users_by_name(self, name: str) -> list:
         # Search students by name
         return self.user_repo.search_users_by_name(name)
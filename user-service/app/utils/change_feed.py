@@ -0,0 +1,99 @@
+# In-memory feed of roster and attendance changes (per process)
+import threading
+import uuid
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+
+class ChangeFeed:
+    # Every write appends a change with a monotonic sequence number. Clients poll with the
+    # cursor from their previous response and get only the changes after it.
+    #
+    # Cursors are "<epoch>:<seq>". The epoch changes on every process start, so a cursor from
+    # before a restart (or one older than the retained window) cannot be served incrementally
+    # and the caller must fall back to a full snapshot.
+
+    def __init__(self, max_changes: int = 10000):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._epoch = uuid.uuid4().hex[:12]
+        self._seq = 0
+        self._changes: deque = deque(maxlen=max_changes)
+
+    def cursor(self) -> str:
+        """Cursor pointing at the latest change."""
+        with self._lock:
+            return f"{self._epoch}:{self._seq}"
+
+    def append(self, kind: str, data: Dict) -> int:
+        """Record a change and return its sequence number."""
+        with self._lock:
+            self._seq += 1
+            self._changes.append((self._seq, kind, dict(data)))
+            self._cond.notify_all()
+            return self._seq
+
+    def since(self, cursor: Optional[str]) -> Tuple[Optional[List[Dict]], str]:
+        """Changes after cursor as ({"seq", "kind", "data"} list, next_cursor).
+        Returns None instead of the list when the cursor cannot be served incrementally."""
+        with self._lock:
+            next_cursor = f"{self._epoch}:{self._seq}"
+            seq = self._parse(cursor)
+            if seq is None:
+                return None, next_cursor
+            oldest = self._changes[0][0] if self._changes else self._seq + 1
+            if seq < oldest - 1:
+                # Changes between cursor and the retained window were dropped
+                return None, next_cursor
+            changes = [{"seq": s, "kind": k, "data": dict(d)} for s, k, d in self._changes if s > seq]
+            return changes, next_cursor
+
+    def wait(self, cursor: Optional[str], timeout: float) -> bool:
+        """Block until there are changes after cursor (or it is invalid). False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._parse(cursor) != self._seq, timeout=timeout)
+
+    def _parse(self, cursor: Optional[str]) -> Optional[int]:
+        # Must be called with the lock held; sequence number of a cursor from this epoch
+        epoch, _, seq = (cursor or "").partition(":")
+        if epoch != self._epoch or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        return int(seq)
+
+
+# Public student fields (see FirebaseService.get_students_page)
+STUDENT_FIELDS = ("student_id", "username", "full_name", "class_name", "embedding")
+
+
+def to_student(data: Dict, fields=STUDENT_FIELDS) -> Optional[Dict]:
+    # Student dict of a user doc (student or legacy name/email shape), limited to fields
+    if data.get('student_id') and data.get('full_name'):
+        student = {
+            'student_id': data.get('student_id'),
+            'username': data.get('username', data.get('student_id')),
+            'full_name': data.get('full_name'),
+            'class_name': data.get('class_name', 'Unassigned'),
+            'embedding': data.get('embedding', '')
+        }
+    elif data.get('name') and data.get('email'):
+        student = {
+            'student_id': data.get('email', 'unknown'),
+            'username': data.get('email', 'unknown'),
+            'full_name': data.get('name', 'Unknown'),
+            'class_name': 'Unassigned',
+            'embedding': data.get('face_encoding', '')
+        }
+    else:
+        return None
+    return {k: student[k] for k in fields}
+
+
+def publish_student(data: Dict):
+    # Append a user doc's roster change (without the embedding) to the feed
+    student = to_student(data, [f for f in STUDENT_FIELDS if f != "embedding"])
+    if student:
+        change_feed.append("student", student)
+
+
+# Create global instance (shared by every writer of users and attendance in this process)
+change_feed = ChangeFeed()
@@ -0,0 +1,106 @@
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Tuple
+from flask import request, jsonify, Response
+from google.cloud import firestore
+from ..config.settings import Config
+from .logger import logger
+
+
+class VersionTracker:
+    # Version counters for collections ("users") and dates ("attendance:2024-01-31"), persisted
+    # in Firestore (one doc per key in the "versions" collection) so every worker process and
+    # every restart derives the same validators
+    #
+    # Every write path bumps the keys it touches, inside its own batch or transaction where it
+    # has one. Listings derive their ETag from the count and update time of the counter docs of
+    # the keys they read (one batched read per conditional request).
+
+    def __init__(self, collection: str = "versions"):
+        self.collection = collection
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._db = None
+
+    def _ref(self, key: str):
+        with self._lock:
+            if self._db is None:
+                self._db = firestore.Client(project=Config.FIREBASE_PROJECT_ID)
+        return self._db.collection(self.collection).document(key.replace("/", "_"))
+
+    def bump(self, key: str, writer=None):
+        """Record a write to key; with a batch or transaction as writer, as part of that write."""
+        data = {"key": key, "count": firestore.Increment(1), "updated_at": firestore.SERVER_TIMESTAMP}
+        if writer is not None:
+            writer.set(self._ref(key), data, merge=True)
+            return
+        try:
+            self._ref(key).set(data, merge=True)
+        except Exception as e:
+            # The data write already succeeded; clients may revalidate as unchanged until the next bump
+            logger.log_error(f"Version bump failed for {key}: {str(e)}")
+
+    def count(self, key: str) -> int:
+        """Current count of key (0 if never bumped); raises when Firestore can't be read."""
+        snapshot = self._ref(key).get()
+        return snapshot.get("count") if snapshot.exists else 0
+
+    def validators(self, keys: Iterable[str], variant: str = "") -> Tuple[str, float]:
+        """(ETag, last-modified epoch seconds) for a response built from keys."""
+        keys = sorted(set(keys))
+        try:
+            refs = [self._ref(key) for key in keys]
+            snapshots = {snap.id: snap for snap in self._db.get_all(refs)}
+        except Exception as e:
+            # Without the counters nothing can be proven unchanged: a validator that never matches
+            logger.log_error(f"Version read failed: {str(e)}")
+            return uuid.uuid4().hex[:20], time.time()
+
+        state = []
+        for key, ref in zip(keys, refs):
+            snapshot = snapshots.get(ref.id)
+            if snapshot is not None and snapshot.exists:
+                state.append((key, snapshot.get("count"), snapshot.update_time.timestamp()))
+            else:
+                # Never bumped: unchanged as far as this tracker knows, but not older than this process
+                state.append((key, 0, self._started))
+        token = "|".join([variant] + [f"{key}={count}@{ts}" for key, count, ts in state])
+        last_modified = max([ts for _, _, ts in state] or [self._started])
+        return hashlib.sha1(token.encode("utf-8")).hexdigest()[:20], last_modified
+
+
+def conditional_json(keys: Iterable[str], build: Callable[[], Tuple[dict, int]], state: str = ""):
+    # Serve build() as JSON with ETag/Last-Modified, or 304 when the client's copy is still current.
+    # Validators are taken before building, so a write racing with the build can only cause a
+    # spare 200 later, never a stale 304.
+    # state: extra token for data the response reads before it is persisted (and versioned),
+    # e.g. today's unflushed attendance events
+    etag, last_modified = versions.validators(keys, variant=f"{request.full_path}|{state}")
+    last_modified_dt = datetime.fromtimestamp(int(last_modified), tz=timezone.utc)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        # Last-Modified doesn't move with state, so only the ETag can prove such a response unchanged
+        not_modified = not state and request.if_modified_since is not None and last_modified_dt <= request.if_modified_since
+
+    if not_modified:
+        response = Response(status=304)
+    else:
+        body, status = build()
+        response = jsonify(body)
+        response.status_code = status
+        if status != 200:
+            return response
+
+    response.set_etag(etag)
+    response.last_modified = last_modified_dt
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+# Create global instance
+versions = VersionTracker()
@@ -0,0 +1,754 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from ..config.settings import Config
+from .logger import logger
+from .write_behind import write_behind
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+UNASSIGNED_CLASS = "Unassigned"
+
+
+def assign_one_to_one(scores: np.ndarray, threshold: float) -> List[Optional[int]]:
+    # Column assigned to each row (face) maximizing total similarity, each column used at most
+    # once and only pairs above threshold kept. Hungarian (scipy) when available, else greedy.
+    assignment: List[Optional[int]] = [None] * scores.shape[0]
+    if scores.size == 0:
+        return assignment
+    if linear_sum_assignment is not None:
+        # Pairs at or below threshold get no credit, so they never displace a real match
+        gain = np.where(scores > threshold, scores, 0.0)
+        rows, cols = linear_sum_assignment(gain, maximize=True)
+        for r, c in zip(rows, cols):
+            if scores[r, c] > threshold:
+                assignment[r] = int(c)
+        return assignment
+    used = set()
+    rows, cols = np.nonzero(scores > threshold)
+    for k in np.argsort(-scores[rows, cols]):
+        r, c = int(rows[k]), int(cols[k])
+        if assignment[r] is None and c not in used:
+            assignment[r] = c
+            used.add(c)
+    return assignment
+
+
+def decode_embedding(value) -> Optional[np.ndarray]:
+    # Stored embeddings are base64 float32 bytes (faceid-service format) or plain float lists
+    if value is None or len(value) == 0:
+        return None
+    try:
+        if isinstance(value, str):
+            return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+        return np.asarray(value, dtype=np.float32)
+    except Exception:
+        return None
+
+
+def _normalize(value) -> Optional[np.ndarray]:
+    emb = decode_embedding(value)
+    if emb is None or not np.all(np.isfinite(emb)):
+        return None
+    norm = np.linalg.norm(emb)
+    return emb / norm if norm > 0 else None
+
+
+def _normalize_templates(value) -> Optional[np.ndarray]:
+    # Templates of a multi-template user (list of stored embeddings, or a matrix) as normalized rows
+    if value is None or len(value) == 0:
+        return None
+    rows = [emb for emb in (_normalize(v) for v in value) if emb is not None]
+    if not rows or any(row.shape != rows[0].shape for row in rows):
+        return None
+    return np.vstack(rows).astype(np.float32)
+
+
+_NOT_META = ("embedding", "templates", "updated_at")
+
+
+def load_gallery_records(db, class_names: Optional[List[str]] = None,
+                         updated_since: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
+    # Gallery records from the users collection (None = every class). Handles both the student
+    # shape (student_id/full_name/embedding) and the name/email/face_encoding shape.
+    # updated_since takes high-water marks from high_water_marks() and returns only newer docs.
+    fields = ["name", "email", "full_name", "student_id", "username", "class_name", "face_encoding", "embedding",
+              "templates", "updated_at"]
+    query = db.collection("users").select(fields)
+    if updated_since:
+        # updated_at is a Firestore timestamp (UserRepository) or an ISO string (FirebaseService.save_user);
+        # the two types never compare with each other, so each has its own mark and query
+        docs = []
+        if updated_since.get("timestamp"):
+            docs.extend(query.where("updated_at", ">", datetime.fromisoformat(updated_since["timestamp"])).stream())
+        if updated_since.get("string"):
+            docs.extend(query.where("updated_at", ">", updated_since["string"]).stream())
+    elif class_names is not None and UNASSIGNED_CLASS not in class_names:
+        # Firestore "in" accepts up to 30 values
+        docs = []
+        for i in range(0, len(class_names), 30):
+            docs.extend(query.where("class_name", "in", class_names[i:i + 30]).stream())
+    else:
+        # Docs without a class can't be queried for; scan and filter
+        docs = query.stream()
+
+    records = []
+    for doc in docs:
+        record = gallery_record(doc.id, doc.to_dict())
+        if class_names is not None and record["class_name"] not in class_names:
+            continue
+        records.append(record)
+    return records
+
+
+def gallery_record(doc_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    # Gallery record of one users doc
+    return {
+        "id": doc_id,
+        "name": data.get("name") or data.get("full_name", ""),
+        "email": data.get("email") or data.get("student_id", ""),
+        "student_id": data.get("student_id") or data.get("email", ""),
+        "username": data.get("username") or doc_id,
+        "class_name": data.get("class_name") or UNASSIGNED_CLASS,
+        "updated_at": data.get("updated_at"),
+        "embedding": data.get("face_encoding") or data.get("embedding"),
+        "templates": data.get("templates") or None
+    }
+
+
+def index_entry(record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # faceid-service /gallery entry for a gallery record: base64 float32 embedding plus meta
+    emb = decode_embedding(record.get("embedding"))
+    if emb is None:
+        return None
+    entry = {
+        "id": record["id"],
+        "embedding": base64.b64encode(emb.astype(np.float32).tobytes()).decode("utf-8"),
+        "meta": {k: v for k, v in record.items() if k not in _NOT_META + ("id",)}
+    }
+    templates = _normalize_templates(record.get("templates"))
+    if templates is not None:
+        entry["templates"] = [base64.b64encode(row.tobytes()).decode("utf-8") for row in templates]
+    return entry
+
+
+def high_water_marks(records: List[Dict[str, Any]], marks: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    # Latest updated_at seen, kept per stored type: {"timestamp": iso, "string": iso}
+    marks = dict(marks or {})
+    for record in records:
+        value = record.get("updated_at")
+        if isinstance(value, datetime):
+            if not marks.get("timestamp") or value > datetime.fromisoformat(marks["timestamp"]):
+                marks["timestamp"] = value.isoformat()
+        elif isinstance(value, str) and value > marks.get("string", ""):
+            marks["string"] = value
+    return marks
+
+
+def save_gallery_snapshot(path: str, records: List[Dict[str, Any]], marks: Dict[str, str]):
+    # Persist decoded, normalized embeddings and templates plus meta and high-water marks (write + rename)
+    rows, meta, template_rows, slices = [], [], [], []
+    offset = 0
+    for record in records:
+        emb = _normalize(record.get("embedding"))
+        if emb is None or (rows and emb.shape[0] != rows[0].shape[0]):
+            continue
+        rows.append(emb.astype(np.float32))
+        meta.append({k: v for k, v in record.items() if k not in _NOT_META})
+        templates = _normalize_templates(record.get("templates"))
+        if templates is not None and templates.shape[1] == emb.shape[0]:
+            template_rows.append(templates)
+            slices.append((offset, len(templates)))
+            offset += len(templates)
+        else:
+            slices.append((0, 0))
+    matrix = np.vstack(rows) if rows else np.zeros((0, 0), dtype=np.float32)
+    template_matrix = np.vstack(template_rows) if template_rows else np.zeros((0, matrix.shape[1]), dtype=np.float32)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, matrix=matrix, meta=np.array(json.dumps(meta)), marks=np.array(json.dumps(marks)),
+                 templates=template_matrix, template_slices=np.array(slices, dtype=np.int64).reshape(-1, 2))
+    os.replace(tmp_path, path)
+
+
+def load_gallery_snapshot(path: str) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, str]]]:
+    # (records with normalized embeddings, marks), or None if there is no usable snapshot
+    try:
+        with np.load(path) as data:
+            matrix = data["matrix"]
+            meta = json.loads(str(data["meta"]))
+            marks = json.loads(str(data["marks"]))
+            templates = data["templates"]
+            slices = data["template_slices"]
+    except (OSError, ValueError, KeyError):
+        return None
+    if matrix.shape[0] != len(meta) or slices.shape[0] != len(meta):
+        return None
+    records = []
+    for m, row, (start, count) in zip(meta, matrix, slices):
+        records.append({**m, "embedding": row, "templates": templates[start:start + count] if count else None})
+    return records, marks
+
+
+class _Shard:
+    # Embeddings of one class as a pre-normalized matrix (one row per person)
+    #
+    # Rows are append-only: an update appends a new row and tombstones the old one (meta None),
+    # so a view taken by a search is never rewritten underneath it. Tombstones are compacted
+    # away once they make up half the rows, keeping upsert/remove O(1) amortized. Users enrolled
+    # with several templates are searched on their centroid row; the templates ride alongside.
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self._matrix: Optional[np.ndarray] = None
+        self.meta: List[Optional[Dict[str, Any]]] = []
+        self.templates: List[Optional[np.ndarray]] = []
+        self.pos: Dict[str, int] = {}
+        self.size = 0
+        self.dead = 0
+        for record in records:
+            self.upsert(record)
+
+    def __len__(self):
+        return self.size - self.dead
+
+    def view(self):
+        """(matrix, meta, templates) of the rows written so far; dead rows have meta None."""
+        if self._matrix is None:
+            return np.zeros((0, 0), dtype=np.float32), [], []
+        return self._matrix[:self.size], self.meta, self.templates
+
+    def upsert(self, record: Dict[str, Any]) -> bool:
+        emb = _normalize(record.get("embedding"))
+        if emb is None:
+            return False
+        if self._matrix is None:
+            self._matrix = np.zeros((16, emb.shape[0]), dtype=np.float32)
+        if emb.shape[0] != self._matrix.shape[1]:
+            return False
+        self.remove(record.get("id"))
+
+        if self.size == self._matrix.shape[0]:
+            if self.dead * 2 >= self.size:
+                self._compact()
+            if self.size == self._matrix.shape[0]:
+                grown = np.zeros((self._matrix.shape[0] * 2, self._matrix.shape[1]), dtype=np.float32)
+                grown[:self.size] = self._matrix[:self.size]
+                self._matrix = grown
+        self._matrix[self.size] = emb
+        templates = _normalize_templates(record.get("templates"))
+        self.templates.append(templates if templates is not None and templates.shape[1] == emb.shape[0] else None)
+        self.meta.append({k: v for k, v in record.items() if k not in _NOT_META})
+        if record.get("id") is not None:
+            self.pos[record["id"]] = self.size
+        self.size += 1
+        return True
+
+    def remove(self, record_id: Optional[str]) -> bool:
+        i = self.pos.pop(record_id, None) if record_id is not None else None
+        if i is None:
+            return False
+        # A concurrent search holding this list at worst skips the row being removed
+        self.meta[i] = None
+        self.dead += 1
+        return True
+
+    def get(self, record_id: str) -> Optional[np.ndarray]:
+        i = self.pos.get(record_id)
+        return None if i is None else self._matrix[i]
+
+    def _compact(self):
+        live = [i for i in range(self.size) if self.meta[i] is not None]
+        matrix = np.zeros_like(self._matrix)
+        matrix[:len(live)] = self._matrix[live]
+        self.meta = [self.meta[i] for i in live]
+        self.templates = [self.templates[i] for i in live]
+        self.pos = {m["id"]: n for n, m in enumerate(self.meta) if m.get("id") is not None}
+        self._matrix, self.size, self.dead = matrix, len(live), 0
+
+
+class FaceGallery:
+    # In-memory face gallery partitioned by class
+    #
+    # Shards are loaded on demand through the loader passed to search() and kept in an LRU of
+    # max_shards classes. A class-scoped search only scores that class's rows; a search without
+    # classes loads the whole gallery once and from then on keeps every shard resident (the LRU
+    # bound no longer applies, however many classes there are), so whole-school searches never
+    # re-stream Firestore. Writes to users apply in place through upsert()/remove();
+    # invalidate() drops classes wholesale.
+    #
+    # Writes through another worker process reach this one through set_sync(): searches poll the
+    # "users" version counter at most once per interval and, when it moved, apply the records
+    # updated since the gallery's high-water marks (or drop partially loaded classes, which have
+    # no common mark, for a reload on use).
+    #
+    # With a snapshot_path, a full load is also written to disk with its updated_at high-water
+    # marks when its content differs from the last snapshot, and restore() warms the gallery on
+    # boot from that file plus the docs updated since, instead of streaming the whole collection.
+    #
+    # With a remote set (set_remote), searches are answered by the faceid-service index instead.
+    # The resident shards answer when the remote call fails, when the remote index does not hold
+    # as many users as the (complete) resident gallery (not synced yet, restarted, or behind on
+    # the write-behind queue), and for searches that pass remote=False.
+
+    def __init__(self, max_shards: int = 64, snapshot_path: Optional[str] = None):
+        self.max_shards = max_shards
+        self.snapshot_path = snapshot_path
+        self._lock = threading.Lock()
+        self._shards: "OrderedDict[str, _Shard]" = OrderedDict()
+        self._complete = False  # every class is resident (and exempt from eviction)
+        self._snapshot_fingerprint: Optional[str] = None  # content of the snapshot on disk
+        self._generation = 0  # bumped by every write, so loads that overlap one are not installed
+        self._reserved: Dict[str, np.ndarray] = {}  # faces being registered right now
+        self._released = threading.Condition(self._lock)
+        self._remote: Optional[Callable[[List, int, float], Optional[Tuple[List[List[Dict[str, Any]]], Optional[int]]]]] = None
+        self._remote_top_k = 10
+        self._marks: Optional[Dict[str, str]] = None  # updated_at high-water marks of a complete gallery
+        self._sync: Optional[Tuple[Callable[[], Optional[int]], Callable[[Dict[str, str]], List[Dict[str, Any]]]]] = None
+        self._sync_interval = 0.0
+        self._synced_at = 0.0
+        self._seen_version: Optional[int] = None  # users version the gallery has caught up with
+
+    def set_remote(self, identify, top_k: int = 10):
+        """Answer searches with identify(embeddings, top_k, threshold), which returns (per embedding
+        its best records above threshold as gallery records with "similarity", remote index size),
+        or None on failure."""
+        self._remote = identify
+        self._remote_top_k = top_k
+
+    def set_sync(self, version: Callable[[], Optional[int]], delta_loader: Callable[[Dict[str, str]], List[Dict[str, Any]]],
+                 interval: float):
+        """Catch up with writes made by other processes: version() returns the users version
+        counter, delta_loader(marks) the records updated since high-water marks."""
+        self._sync = (version, delta_loader)
+        self._sync_interval = interval
+
+    def _catch_up(self):
+        # At most once per interval: when the users version moved, apply the records written since
+        if self._sync is None:
+            return
+        version_reader, delta_loader = self._sync
+        now = time.monotonic()
+        with self._lock:
+            if now - self._synced_at < self._sync_interval:
+                return
+            self._synced_at = now
+            seen = self._seen_version
+        try:
+            version = version_reader()
+        except Exception as e:
+            logger.log_error(f"Gallery version poll failed: {str(e)}")
+            return
+        if version is None or version == seen:
+            return
+
+        with self._lock:
+            marks = dict(self._marks) if self._complete and self._marks is not None else None
+        if marks is None:
+            # Classes loaded at different times share no mark; reload them on use
+            if seen is not None:
+                self.invalidate()
+            with self._lock:
+                self._seen_version = version
+            return
+        try:
+            updated = delta_loader(marks)
+        except Exception as e:
+            logger.log_error(f"Gallery catch-up failed: {str(e)}")
+            return
+        for record in updated:
+            # Already mirrored to the faceid index by the process that wrote it
+            self._apply(record)
+        with self._lock:
+            if self._marks is not None:
+                self._marks = high_water_marks(updated, self._marks)
+            self._seen_version = version
+        if updated:
+            logger.log_face_recognition("gallery_catch_up", records=len(updated), version=version)
+
+    def _remote_matches(self, embeddings: List, class_ids: Optional[List[str]],
+                        threshold: float) -> Optional[List[List[Dict[str, Any]]]]:
+        # Candidates per embedding from the remote index, limited to class_ids; None = use the shards
+        if self._remote is None:
+            return None
+        answer = self._remote(embeddings, self._remote_top_k, threshold)
+        if answer is None:
+            return None
+        results, size = answer
+        if len(results) != len(embeddings):
+            return None
+        with self._lock:
+            local_size = sum(len(shard) for shard in self._shards.values()) if self._complete else None
+        if local_size is not None and size != local_size:
+            # The remote index is missing users (or holds stale ones); the shards are authoritative
+            logger.log_face_recognition("gallery_remote_mismatch", remote=size, local=local_size)
+            return None
+        if class_ids is None:
+            return results
+        if any(len(matches) >= self._remote_top_k for matches in results):
+            # The top-k may have crowded out members of the wanted classes
+            return None
+        wanted = set(class_ids)
+        return [[m for m in matches if (m.get("class_name") or UNASSIGNED_CLASS) in wanted] for matches in results]
+
+    def search(self, embedding, loader: Callable[[Optional[List[str]]], List[Dict[str, Any]]],
+               class_ids: Optional[List[str]] = None, threshold: float = None,
+               remote: bool = True) -> List[Dict[str, Any]]:
+        """Records scoring above threshold, best first, each with a "similarity" key.
+        loader(class_ids) returns records ({"class_name", "embedding", ...}); None means all classes.
+        remote=False searches the resident shards even when a remote index is set."""
+        if threshold is None:
+            threshold = Config.GALLERY_MATCH_THRESHOLD
+        query = _normalize(embedding)
+        if query is None:
+            return []
+        self._catch_up()
+        remote = self._remote_matches([query], class_ids, threshold) if remote else None
+        if remote is not None:
+            return sorted(remote[0], key=lambda m: m["similarity"], reverse=True)
+
+        matches = []
+        margin = Config.GALLERY_TEMPLATE_MARGIN
+        for matrix, meta, templates in self._get_shards(loader, class_ids):
+            if matrix.shape[0] == 0 or matrix.shape[1] != query.shape[0]:
+                continue
+            scores = matrix @ query
+            # One row per user; near misses of multi-template users are re-scored on their best template
+            for i in np.flatnonzero(scores > threshold - margin):
+                if meta[i] is None:
+                    continue
+                score = float(scores[i])
+                if templates[i] is not None:
+                    score = max(score, float(np.max(templates[i] @ query)))
+                if score > threshold:
+                    matches.append({**meta[i], "similarity": score})
+
+        matches.sort(key=lambda m: m["similarity"], reverse=True)
+        return matches
+
+    def assign(self, embeddings: List, loader: Callable[[Optional[List[str]]], List[Dict[str, Any]]],
+               class_ids: Optional[List[str]] = None, threshold: float = None) -> List[Optional[Dict[str, Any]]]:
+        """One record (with "similarity") or None per embedding, no record used twice.
+        For group photos: the faces x gallery similarities come from one matrix product per
+        shard, then a one-to-one assignment keeps the best consistent set of matches."""
+        if threshold is None:
+            threshold = Config.GALLERY_MATCH_THRESHOLD
+        queries = [_normalize(e) for e in embeddings]
+        valid = [i for i, q in enumerate(queries) if q is not None]
+        result: List[Optional[Dict[str, Any]]] = [None] * len(embeddings)
+        if not valid:
+            return result
+        dim = queries[valid[0]].shape[0]
+        valid = [i for i in valid if queries[i].shape[0] == dim]
+        self._catch_up()
+        remote = self._remote_matches([queries[i] for i in valid], class_ids, threshold)
+        if remote is not None:
+            # Score matrix over the union of every face's candidates (absent pairs score 0)
+            columns = list({m["id"]: m for matches in remote for m in matches}.values())
+            position = {m["id"]: j for j, m in enumerate(columns)}
+            scores = np.zeros((len(valid), len(columns)), dtype=np.float32)
+            for row, matches in enumerate(remote):
+                for m in matches:
+                    scores[row, position[m["id"]]] = m["similarity"]
+            for row, col in enumerate(assign_one_to_one(scores, threshold)):
+                if col is not None:
+                    result[valid[row]] = {**columns[col], "similarity": float(scores[row, col])}
+            return result
+        Q = np.vstack([queries[i] for i in valid])
+        margin = Config.GALLERY_TEMPLATE_MARGIN
+
+        blocks, columns = [], []
+        for matrix, meta, templates in self._get_shards(loader, class_ids):
+            if matrix.shape[0] == 0 or matrix.shape[1] != dim:
+                continue
+            scores = Q @ matrix.T
+            # Only gallery rows some face could match are kept as assignment columns
+            keep = [j for j in np.flatnonzero(np.max(scores, axis=0) > threshold - margin) if meta[j] is not None]
+            for j in keep:
+                column = scores[:, j]
+                if templates[j] is not None:
+                    column = np.maximum(column, np.max(Q @ templates[j].T, axis=1))
+                blocks.append(column)
+                columns.append(meta[j])
+        if not columns:
+            return result
+
+        scores = np.column_stack(blocks)
+        for row, col in enumerate(assign_one_to_one(scores, threshold)):
+            if col is not None:
+                result[valid[row]] = {**columns[col], "similarity": float(scores[row, col])}
+        return result
+
+    def best_match(self, embedding, loader: Callable[[Optional[List[str]]], List[Dict[str, Any]]],
+                   class_ids: Optional[List[str]] = None, threshold: float = None,
+                   remote: bool = True) -> Optional[Dict[str, Any]]:
+        """Top-1 record scoring above threshold, or None."""
+        matches = self.search(embedding, loader, class_ids, threshold, remote)
+        return matches[0] if matches else None
+
+    @contextmanager
+    def reserve(self, embedding, threshold: float = None, timeout: float = 30.0) -> Iterator[bool]:
+        """Hold a face for the duration of its registration. A registration of the same face that is
+        already in flight is waited for first, so concurrent duplicates are checked one after the other.
+        Yields False if the other registration does not finish within timeout. Reservations are
+        per process: registrations handled by different worker processes are not serialized."""
+        if threshold is None:
+            threshold = Config.GALLERY_MATCH_THRESHOLD
+        query = _normalize(embedding)
+        token = uuid.uuid4().hex
+
+        def same_face_in_flight() -> bool:
+            held = [e for e in self._reserved.values() if query is not None and e.shape == query.shape]
+            return bool(held) and float(np.max(np.vstack(held) @ query)) > threshold
+
+        with self._released:
+            acquired = self._released.wait_for(lambda: not same_face_in_flight(), timeout=timeout)
+            if acquired and query is not None:
+                self._reserved[token] = query
+        try:
+            yield acquired
+        finally:
+            with self._released:
+                if self._reserved.pop(token, None) is not None:
+                    self._released.notify_all()
+
+    def restore(self, loader: Callable[[Optional[List[str]]], List[Dict[str, Any]]],
+                delta_loader: Callable[[Dict[str, str]], List[Dict[str, Any]]]) -> int:
+        """Warm every class from the local snapshot plus the records delta_loader(marks) returns
+        (updated since the snapshot was written). Falls back to loader(None) without a snapshot.
+        Returns the number of records loaded."""
+        with self._lock:
+            generation = self._generation
+        snapshot = load_gallery_snapshot(self.snapshot_path) if self.snapshot_path else None
+        if snapshot is None:
+            records = loader(None)
+            marks = high_water_marks(records)
+            changed = len(records)
+        else:
+            records, marks = snapshot
+            with self._lock:
+                self._snapshot_fingerprint = self._fingerprint(records)
+            updated = delta_loader(marks)
+            by_id = {record["id"]: record for record in records}
+            by_id.update((record["id"], record) for record in updated)
+            records = list(by_id.values())
+            marks = high_water_marks(updated, marks)
+            changed = len(updated)
+
+        if not self._install(records, generation, marks):
+            return 0
+        self._persist(records, marks)
+        logger.log_face_recognition("gallery_restore", records=len(records), fetched=changed,
+                                    from_snapshot=snapshot is not None)
+        return len(records)
+
+    def records(self) -> Optional[List[Dict[str, Any]]]:
+        """Every resident record with its embedding row and templates, or None unless the whole
+        gallery is resident (used to seed the faceid-service index)."""
+        with self._lock:
+            if not self._complete:
+                return None
+            records = []
+            for shard in self._shards.values():
+                matrix, meta, templates = shard.view()
+                records.extend({**m, "embedding": matrix[i], "templates": templates[i]}
+                               for i, m in enumerate(meta) if m is not None)
+            return records
+
+    def _install(self, records: List[Dict[str, Any]], generation: int, marks: Dict[str, str]) -> bool:
+        loaded = {name: _Shard(group) for name, group in self._group(records).items()}
+        with self._lock:
+            if generation != self._generation:
+                # A user was written while loading; let the next search reload
+                return False
+            self._shards = OrderedDict(loaded)
+            self._complete = True
+            self._marks = marks
+            return True
+
+    @staticmethod
+    def _fingerprint(records: List[Dict[str, Any]]) -> str:
+        # Identity of a record set: every write to a user doc moves its updated_at
+        digest = hashlib.sha1()
+        for key in sorted(f"{record['id']}@{record.get('updated_at')}" for record in records):
+            digest.update(key.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _persist(self, records: List[Dict[str, Any]], marks: Dict[str, str]):
+        # Rewrite the snapshot only if the records differ from the ones already on disk
+        if not self.snapshot_path:
+            return
+        fingerprint = self._fingerprint(records)
+        with self._lock:
+            if fingerprint == self._snapshot_fingerprint:
+                return
+        try:
+            save_gallery_snapshot(self.snapshot_path, records, marks)
+        except Exception as e:
+            logger.log_error(f"Gallery snapshot write failed: {str(e)}")
+            return
+        with self._lock:
+            self._snapshot_fingerprint = fingerprint
+
+    def upsert(self, record: Dict[str, Any]):
+        """Apply one added or changed user (a gallery_record()) to the resident shards, in place."""
+        self._apply(record)
+        self._push_index("upsert", record)
+
+    def _apply(self, record: Dict[str, Any]):
+        class_name = record.get("class_name") or UNASSIGNED_CLASS
+        with self._lock:
+            self._generation += 1
+            # The class may have changed; at most max_shards dict lookups
+            for shard in self._shards.values():
+                shard.remove(record["id"])
+            shard = self._shards.get(class_name)
+            if shard is None and self._complete:
+                shard = self._shards[class_name] = _Shard([])
+            if shard is not None:
+                shard.upsert(record)
+                self._evict()
+        # Classes that are not resident pick the change up from Firestore when they are loaded
+
+    def remove(self, record_id: str):
+        """Drop one user from the resident shards."""
+        with self._lock:
+            self._generation += 1
+            for shard in self._shards.values():
+                shard.remove(record_id)
+        self._push_index("remove", {"id": record_id})
+
+    def _push_index(self, op: str, record: Dict[str, Any]):
+        # Mirror the change into the faceid-service index through the write-behind queue
+        if not Config.FACEID_INDEX_SYNC:
+            return
+        payload = {"op": op, "id": record["id"]}
+        if op == "upsert":
+            entry = index_entry(record)
+            if entry is None:
+                return
+            payload.update(entry)
+        write_behind.enqueue("face_index", payload)
+
+    def check(self, loader: Callable[[Optional[List[str]]], List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Diff the resident shards against loader(None) (the source of truth).
+        Only resident classes are compared; the rest are loaded fresh on use anyway."""
+        truth = {record["id"]: record for record in loader(None)}
+        with self._lock:
+            resident = {name: shard for name, shard in self._shards.items()}
+            found = {}
+            for name, shard in resident.items():
+                for record_id in shard.pos:
+                    found[record_id] = (name, np.array(shard.get(record_id)))
+
+        missing, stale = [], []
+        for record_id, record in truth.items():
+            emb = _normalize(record.get("embedding"))
+            class_name = record.get("class_name") or UNASSIGNED_CLASS
+            if record_id not in found:
+                if class_name in resident and emb is not None:
+                    missing.append(record_id)
+                continue
+            name, row = found[record_id]
+            if name != class_name or emb is None or row.shape != emb.shape or float(row @ emb) < 1 - 1e-5:
+                stale.append(record_id)
+        extra = [record_id for record_id in found if record_id not in truth]
+
+        return {
+            "consistent": not (missing or stale or extra),
+            "resident_classes": len(resident),
+            "resident_records": len(found),
+            "source_records": len(truth),
+            "missing": missing,
+            "stale": stale,
+            "extra": extra
+        }
+
+    def invalidate(self, class_id: Optional[str] = None):
+        """Drop one class (or every class) so it is reloaded on next use."""
+        with self._lock:
+            self._generation += 1
+            if class_id is None:
+                self._shards.clear()
+            else:
+                self._shards.pop(class_id, None)
+            self._complete = False
+            self._marks = None
+
+    def _get_shards(self, loader, class_ids: Optional[List[str]]) -> List[Tuple[np.ndarray, List, List]]:
+        # Views of the shards to search, taken under the lock
+        if class_ids is None:
+            with self._lock:
+                if self._complete:
+                    return [shard.view() for shard in self._shards.values()]
+            with self._lock:
+                generation = self._generation
+            records = loader(None)
+            loaded = {name: _Shard(group) for name, group in self._group(records).items()}
+            with self._lock:
+                if generation != self._generation:
+                    # A user was written while loading; serve this search, reload next time
+                    return [shard.view() for shard in loaded.values()]
+                marks = high_water_marks(records)
+                self._shards = OrderedDict(loaded)
+                self._complete = True
+                self._marks = marks
+                shards = [shard.view() for shard in self._shards.values()]
+            threading.Thread(target=self._persist, args=(records, marks), daemon=True).start()
+            return shards
+
+        wanted = list(dict.fromkeys(class_ids))
+        with self._lock:
+            missing = [c for c in wanted if c not in self._shards]
+            generation = self._generation
+        loaded = {}
+        if missing:
+            by_class = self._group(loader(missing))
+            loaded = {name: _Shard(by_class.get(name, [])) for name in missing}
+            logger.log_face_recognition("gallery_load", classes=missing)
+
+        with self._lock:
+            if generation == self._generation:
+                self._shards.update(loaded)
+            shards = []
+            for name in wanted:
+                shard = self._shards.get(name) or loaded.get(name)
+                if shard is not None:
+                    if name in self._shards:
+                        self._shards.move_to_end(name)
+                    shards.append(shard.view())
+            self._evict()
+            return shards
+
+    def _evict(self):
+        # Must be called with the lock held; a complete gallery stays whole for whole-school searches
+        if self._complete:
+            return
+        while len(self._shards) > self.max_shards:
+            self._shards.popitem(last=False)
+            self._complete = False
+            self._marks = None
+
+    @staticmethod
+    def _group(records: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        by_class: Dict[str, List[Dict[str, Any]]] = {}
+        for record in records:
+            by_class.setdefault(record.get("class_name") or UNASSIGNED_CLASS, []).append(record)
+        return by_class
+
+
+# Create global instance
+face_gallery = FaceGallery(max_shards=Config.GALLERY_MAX_SHARDS, snapshot_path=Config.GALLERY_SNAPSHOT_PATH or None)
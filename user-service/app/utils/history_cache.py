@@ -0,0 +1,214 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Tuple
+from ..config.settings import Config
+from .logger import logger
+
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _encode(value: Any):
+    # JSON default hook: keep datetimes round-trippable
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj: Dict[str, Any]):
+    if "__datetime__" in obj and len(obj) == 1:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+class HistoryCache:
+    # Cache for date-keyed query results
+    #
+    # Past dates never change once closed, so they are cached permanently in memory (bounded LRU)
+    # and on disk (size-bounded LRU). Today's date is only cached for a short TTL. Writes that
+    # touch a date call invalidate() so late or backdated writes are never hidden. Each date has
+    # a generation bumped by invalidate(); a load is stored only if its date's generation did
+    # not change while it ran, so a load racing a write never caches the pre-write result.
+
+    def __init__(self, cache_dir: str, max_disk_bytes: int = 100 * 1024 * 1024,
+                 max_memory_entries: int = 256, today_ttl: float = 5.0):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_entries = max_memory_entries
+        self.today_ttl = today_ttl
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._today: Dict[str, Tuple[float, Any]] = {}
+        self._disk_index: "OrderedDict[str, int]" = OrderedDict()  # filename -> size, LRU order
+        self._disk_bytes = 0
+        self._disk_loaded = False
+        self._generations: Dict[str, int] = {}  # date -> invalidate() count
+
+    @staticmethod
+    def _today_str() -> str:
+        return datetime.now().strftime("%Y-%m-%d")
+
+    @staticmethod
+    def _key(namespace: str, date_str: str) -> str:
+        return f"{namespace}|{date_str}"
+
+    @staticmethod
+    def _filename(namespace: str, date_str: str) -> str:
+        safe_namespace = re.sub(r"[^A-Za-z0-9_-]", "_", namespace)
+        return f"{date_str}_{safe_namespace}.json"
+
+    # -------------------- Public API --------------------
+    def get_or_load(self, namespace: str, date_str: str, loader: Callable[[], Any]) -> Any:
+        """Return the cached value for (namespace, date), loading it on a miss."""
+        if not _DATE_RE.match(date_str or ""):
+            # Not a date key; never cache
+            return loader()
+
+        key = self._key(namespace, date_str)
+
+        if date_str >= self._today_str():
+            # Open date: short TTL only
+            with self._lock:
+                cached = self._today.get(key)
+                if cached and time.time() - cached[0] < self.today_ttl:
+                    return cached[1]
+                generation = self._generations.get(date_str, 0)
+            value = loader()
+            with self._lock:
+                if self._generations.get(date_str, 0) == generation:
+                    self._today[key] = (time.time(), value)
+            return value
+
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            generation = self._generations.get(date_str, 0)
+
+        name = self._filename(namespace, date_str)
+        value = self._read_disk(name)
+        if value is None:
+            value = loader()
+            self._write_disk(name, key, value, date_str, generation)
+
+        with self._lock:
+            if self._generations.get(date_str, 0) == generation:
+                self._remember(key, value)
+        return value
+
+    def invalidate(self, date_str: str, namespace_prefix: str = ""):
+        """Drop cached values for a date in every namespace starting with namespace_prefix (default: all)."""
+        with self._lock:
+            self._generations[date_str] = self._generations.get(date_str, 0) + 1
+            for store in (self._memory, self._today):
+                for key in [k for k in store if k.startswith(namespace_prefix) and k.endswith(f"|{date_str}")]:
+                    store.pop(key, None)
+            self._load_disk_index()
+            file_prefix = self._filename(namespace_prefix, date_str)[:-len(".json")]
+            for name in [n for n in self._disk_index if n.startswith(file_prefix)]:
+                self._remove_disk(name)
+
+    # -------------------- Memory --------------------
+    def _remember(self, key: str, value: Any):
+        # Must be called with the lock held
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    # -------------------- Disk --------------------
+    def _load_disk_index(self):
+        # Must be called with the lock held; oldest-accessed first
+        if self._disk_loaded:
+            return
+        self._disk_loaded = True
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._disk_index[name] = size
+            self._disk_bytes += size
+
+    def _read_disk(self, name: str):
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            self._load_disk_index()
+            if name not in self._disk_index:
+                return None
+            self._disk_index.move_to_end(name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f, object_hook=_decode)
+            os.utime(path)  # keep LRU order across restarts
+            return value["value"]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self._disk_bytes -= self._disk_index.pop(name, 0)
+            return None
+
+    def _write_disk(self, name: str, key: str, value: Any, date_str: str, generation: int):
+        # Written only if the date was not invalidated since generation was read
+        path = os.path.join(self.cache_dir, name)
+        try:
+            data = json.dumps({"key": key, "value": value}, default=_encode)
+        except TypeError as e:
+            logger.log_error(f"History cache skip (not serializable): {str(e)}")
+            return
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+        except OSError as e:
+            logger.log_error(f"History cache write failed: {str(e)}")
+            return
+
+        with self._lock:
+            # Rename under the lock so an invalidate() can't slip in between check and rename
+            try:
+                if self._generations.get(date_str, 0) != generation:
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.log_error(f"History cache write failed: {str(e)}")
+                return
+            self._load_disk_index()
+            self._disk_bytes -= self._disk_index.pop(name, 0)
+            self._disk_index[name] = len(data)
+            self._disk_bytes += len(data)
+            # Size-based LRU eviction
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk_index) > 1:
+                old_name, size = self._disk_index.popitem(last=False)
+                self._disk_bytes -= size
+                try:
+                    os.remove(os.path.join(self.cache_dir, old_name))
+                except OSError:
+                    pass
+
+    def _remove_disk(self, name: str):
+        # Must be called with the lock held
+        self._disk_bytes -= self._disk_index.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+
+# Create global instance
+history_cache = HistoryCache(
+    cache_dir=Config.HISTORY_CACHE_DIR,
+    max_disk_bytes=Config.HISTORY_CACHE_MAX_BYTES,
+    max_memory_entries=Config.HISTORY_CACHE_MEMORY_ENTRIES,
+    today_ttl=Config.HISTORY_CACHE_TODAY_TTL / 1000
+)
@@ -0,0 +1,120 @@
+import threading
+import time
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..config.settings import Config
+from .face_gallery import decode_embedding
+
+
+def box_iou(a: Optional[List[float]], b: Optional[List[float]]) -> float:
+    # IoU of two [x1, y1, x2, y2] boxes (0 if either is missing)
+    if not a or not b:
+        return 0.0
+    w = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    h = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+class KioskTrack:
+    # One person in front of one kiosk: the running sum of their normalized frame embeddings
+
+    def __init__(self, track_id: int, embedding: np.ndarray, bbox: Optional[List[float]], now: float):
+        self.track_id = track_id
+        self.bbox = bbox
+        self.started = self.last_seen = now
+        self.total = embedding.copy()
+        self.frames = 1
+        self.match: Optional[Dict[str, Any]] = None  # gallery record with "similarity", once identified
+        self.identified_frames = 0  # frames in the track at its last identification
+
+    def mean(self) -> np.ndarray:
+        norm = np.linalg.norm(self.total)
+        return self.total / norm if norm > 0 else self.total
+
+    def add(self, embedding: np.ndarray, bbox: Optional[List[float]], now: float):
+        self.total += embedding
+        self.frames += 1
+        self.bbox = bbox or self.bbox
+        self.last_seen = now
+
+
+class KioskTracks:
+    """Server-side face tracks of continuous kiosk streams, one current track per kiosk.
+
+    A frame joins the kiosk's track when it arrives within max_gap seconds of the previous
+    one, its box overlaps the track's last box by at least iou_threshold and its embedding
+    is at least min_similarity to the track's mean; otherwise it starts a new track. A track
+    is identified on its averaged embedding from its first frame on, and retried on every new
+    frame (with the larger average) until it matches. A matched track is re-verified every
+    min_frames new frames and loses (or changes) its identity when the average no longer
+    matches it above the threshold, so a bad early match does not stick.
+    Tracks live in this process: kiosks must reach the same worker (sticky routing)."""
+
+    def __init__(self, max_gap: float = 10.0, iou_threshold: float = 0.3,
+                 min_similarity: float = 0.6, min_frames: int = 3):
+        self.max_gap = max_gap
+        self.iou_threshold = iou_threshold
+        self.min_similarity = min_similarity
+        self.min_frames = max(1, min_frames)
+        self._lock = threading.Lock()
+        self._tracks: Dict[str, KioskTrack] = {}
+        self._next_id = 1
+
+    def observe(self, kiosk_id: str, embedding, bbox: Optional[List[float]] = None) -> Tuple[KioskTrack, Optional[np.ndarray]]:
+        """Add one frame to the kiosk's track. Returns (track, embedding to identify or None);
+        pass the identification result back with resolve()."""
+        vector = decode_embedding(embedding)
+        if vector is None:
+            raise ValueError("Invalid embedding")
+        norm = np.linalg.norm(vector)
+        vector = vector / norm if norm > 0 else vector
+        now = time.time()
+
+        with self._lock:
+            self._expire(now)
+            track = self._tracks.get(kiosk_id)
+            if track is not None and self._continues(track, vector, bbox):
+                track.add(vector, bbox, now)
+            else:
+                track = KioskTrack(self._next_id, vector, bbox, now)
+                self._next_id += 1
+                self._tracks[kiosk_id] = track
+            due = track.match is None or track.frames - track.identified_frames >= self.min_frames
+            if due:
+                track.identified_frames = track.frames
+            return track, track.mean() if due else None
+
+    def resolve(self, track: KioskTrack, match: Optional[Dict[str, Any]]):
+        """Record the identification of a track's averaged embedding; None (nothing above the
+        threshold) clears an earlier match"""
+        with self._lock:
+            track.match = match
+
+    def end(self, kiosk_id: str) -> bool:
+        """Drop the kiosk's current track (next person); False if it had none"""
+        with self._lock:
+            return self._tracks.pop(kiosk_id, None) is not None
+
+    def _continues(self, track: KioskTrack, vector: np.ndarray, bbox: Optional[List[float]]) -> bool:
+        if track.total.shape != vector.shape:
+            return False
+        # Without boxes (older faceid-service) only appearance links frames
+        if bbox and track.bbox and box_iou(bbox, track.bbox) < self.iou_threshold:
+            return False
+        return float(track.mean() @ vector) >= self.min_similarity
+
+    def _expire(self, now: float):
+        for kiosk_id in [k for k, t in self._tracks.items() if now - t.last_seen > self.max_gap]:
+            del self._tracks[kiosk_id]
+
+
+# Create global instance
+kiosk_tracks = KioskTracks(
+    Config.KIOSK_TRACK_MAX_GAP / 1000,
+    Config.KIOSK_TRACK_IOU,
+    Config.KIOSK_TRACK_MIN_SIMILARITY,
+    Config.KIOSK_TRACK_MIN_FRAMES
+)
@@ -48,3 +48,23 @@ def validate_image_size(file, max_size: int = 5242880) -> Dict[str, Any]:
         return {"valid": False, "message": f"Image too large. Maximum {max_size // 1024 // 1024}MB"}
     
     return {"valid": True}
+
+def validate_page_request(req, allowed_fields) -> Dict[str, Any]:
+    # Validate fields/limit/cursor query parameters of listing endpoints
+    fields = None
+    fields_arg = req.args.get('fields')
+    if fields_arg:
+        fields = [f.strip() for f in fields_arg.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in allowed_fields]
+        if unknown:
+            return {"valid": False, "message": f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed_fields)}"}
+    
+    limit = req.args.get('limit')
+    if limit:
+        if not limit.isdigit() or int(limit) < 1:
+            return {"valid": False, "message": "limit must be a positive integer"}
+        limit = min(int(limit), 500)
+    else:
+        limit = None
+    
+    return {"valid": True, "fields": fields, "limit": limit, "cursor": req.args.get('cursor') or None}
@@ -0,0 +1,327 @@
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+from ..config.settings import Config
+from .logger import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: one shared journal, run a single process
+    fcntl = None
+
+
+class WriteBehindQueue:
+    # Durable write-behind queue: writes are journaled locally, then flushed by a background thread
+    #
+    # Journal format (append-only JSON lines):
+    #   {"op": "put", "id": ..., "kind": ..., "payload": {...}}
+    #   {"op": "ack", "ids": [...]}
+    # Entries without an ack are replayed on startup. Delivery is at-least-once,
+    # so handlers should be idempotent where possible.
+    #
+    # A failed batch backs off its own kind only; other kinds keep flushing. Its entries are
+    # then retried one at a time, and an entry failing max_attempts times is moved to the
+    # dead-letter journal (dead_letter.jsonl, put records plus "error" and "attempts").
+    #
+    # Each process journals to its own write_behind.<pid>-<suffix>.jsonl and holds an flock on
+    # the matching .lock file while it runs (debug reloader, several workers). On startup a
+    # process adopts the journals whose lock is free, i.e. of processes that have exited:
+    # their pending entries move into its own journal and the old files are removed.
+
+    def __init__(self, journal_dir: str, enabled: bool = True, batch_size: int = 100,
+                 flush_interval: float = 0.2, max_backoff: float = 30.0, max_attempts: int = 10):
+        self.enabled = enabled
+        self.journal_dir = journal_dir
+        self.journal_path = os.path.join(journal_dir, "write_behind.jsonl")  # until claimed
+        self.dead_letter_path = os.path.join(journal_dir, "dead_letter.jsonl")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max(1, max_attempts)
+
+        self._handlers: Dict[str, Callable[[List[Dict[str, Any]]], None]] = {}
+        self._pending: Dict[str, Dict[str, Any]] = {}  # insertion-ordered by id
+        self._attempts: Dict[str, int] = {}  # failed flushes per entry id
+        self._retry_at: Dict[str, float] = {}  # per kind: no flush before this time
+        self._backoff: Dict[str, float] = {}  # per kind: delay after its next failure
+        self._cond = threading.Condition()
+        self._journal_lock = threading.Lock()
+        self._thread = None
+        self._loaded = False
+        self._owner_lock = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    # -------------------- Public API --------------------
+    def register(self, kind: str, handler: Callable[[List[Dict[str, Any]]], None]):
+        """Register the flush handler for a kind. Handler receives a list of {"id", "payload"} entries."""
+        with self._cond:
+            self._handlers[kind] = handler
+            if self.enabled:
+                self._load_journal()
+                self._start()
+                self._cond.notify()
+
+    def enqueue(self, kind: str, payload: Dict[str, Any]) -> str:
+        """Journal a write and return its entry ID. Returns once the entry is durable on disk."""
+        entry = {"id": uuid.uuid4().hex, "kind": kind, "payload": payload}
+
+        if not self.enabled:
+            # Write-through when disabled
+            self._handlers[kind]([{"id": entry["id"], "payload": payload}])
+            return entry["id"]
+
+        with self._cond:
+            if not self._loaded:
+                self._load_journal()
+                self._start()
+            # Journal under the lock so compaction never drops an entry not yet in memory
+            self._append({"op": "put", **entry})
+            self._pending[entry["id"]] = entry
+            self._cond.notify()
+        return entry["id"]
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def pending_entries(self, kind: str) -> List[Dict[str, Any]]:
+        """{"id", "payload"} of the entries of a kind that are journaled but not yet flushed."""
+        with self._cond:
+            if self.enabled:
+                self._load_journal()
+            return [{"id": e["id"], "payload": dict(e["payload"])} for e in self._pending.values() if e["kind"] == kind]
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until all pending entries with a registered handler are flushed."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._cond:
+                if not any(e["kind"] in self._handlers for e in self._pending.values()):
+                    return True
+                self._cond.notify()
+            time.sleep(0.05)
+        return False
+
+    @staticmethod
+    def encode_bytes(data: bytes) -> str:
+        return base64.b64encode(data).decode("utf-8")
+
+    @staticmethod
+    def decode_bytes(data: str) -> bytes:
+        return base64.b64decode(data)
+
+    # -------------------- Journal --------------------
+    def _append(self, record: Dict[str, Any], path: str = None):
+        line = json.dumps(record, default=str) + "\n"
+        path = path or self.journal_path
+        with self._journal_lock:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def _read_journal(path: str) -> Dict[str, Dict[str, Any]]:
+        # Entries of a journal file that were put but never acked
+        pending: Dict[str, Dict[str, Any]] = {}
+        if not os.path.exists(path):
+            return pending
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash; everything before it is intact
+                    continue
+                if record.get("op") == "put":
+                    pending[record["id"]] = {k: record[k] for k in ("id", "kind", "payload")}
+                elif record.get("op") == "ack":
+                    for entry_id in record.get("ids", []):
+                        pending.pop(entry_id, None)
+        return pending
+
+    def _claim_journal(self):
+        # Give this process its own journal, locked for as long as the process lives
+        if fcntl is None:
+            return
+        os.makedirs(self.journal_dir, exist_ok=True)
+        name = f"write_behind.{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._owner_lock = open(os.path.join(self.journal_dir, name + ".lock"), "a")
+        fcntl.flock(self._owner_lock.fileno(), fcntl.LOCK_EX)
+        self.journal_path = os.path.join(self.journal_dir, name + ".jsonl")
+        # Created up front so the next process removes both files even if nothing was journaled
+        open(self.journal_path, "a").close()
+
+    def _load_journal(self):
+        # Must be called with self._cond held
+        if self._loaded:
+            return
+        self._loaded = True
+        self._claim_journal()
+        if fcntl is None:
+            pending = self._read_journal(self.journal_path)
+            if pending:
+                logger.log_request("write_behind", "/journal/replay", pending=len(pending))
+            self._pending.update(pending)
+            self._compact()
+            return
+
+        with ExitStack() as stack:
+            # Journals whose lock can be taken belong to exited processes (or predate per-process
+            # journals); keep them locked until their entries are durable in our journal
+            adopted = []
+            pending: Dict[str, Dict[str, Any]] = {}
+            for name in sorted(os.listdir(self.journal_dir)):
+                path = os.path.join(self.journal_dir, name)
+                if not name.startswith("write_behind") or not name.endswith(".jsonl") or path == self.journal_path:
+                    continue
+                lock_path = path[:-len(".jsonl")] + ".lock"
+                lock = stack.enter_context(open(lock_path, "a"))
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # owner still running
+                pending.update(self._read_journal(path))
+                adopted.append((path, lock_path))
+
+            if pending:
+                logger.log_request("write_behind", "/journal/replay", pending=len(pending), journals=len(adopted))
+            self._pending.update(pending)
+            self._compact()
+            for path, lock_path in adopted:
+                for stale in (path, lock_path):
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+
+    def _after_fork(self):
+        # A forked worker must not share the parent's journal or flusher; it claims its own on first use
+        self._cond = threading.Condition()
+        self._journal_lock = threading.Lock()
+        self._pending = {}
+        self._attempts = {}
+        self._retry_at = {}
+        self._backoff = {}
+        self._thread = None
+        self._loaded = False
+        self._owner_lock = None
+        self.journal_path = os.path.join(self.journal_dir, "write_behind.jsonl")
+
+    def _compact(self):
+        # Rewrite the journal with only pending entries
+        with self._journal_lock:
+            if not self._pending and not os.path.exists(self.journal_path):
+                return
+            os.makedirs(self.journal_dir, exist_ok=True)
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in list(self._pending.values()):
+                    f.write(json.dumps({"op": "put", **entry}, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.journal_path)
+
+    # -------------------- Flusher --------------------
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind-flusher", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self, now: float):
+        # Must be called with self._cond held; returns (kind, entries) for the oldest flushable kind.
+        # Kinds backing off are skipped; an entry that failed before is retried on its own,
+        # so one bad entry cannot hold back the rest of its kind.
+        skipped = set()
+        for entry in self._pending.values():
+            kind = entry["kind"]
+            if kind in skipped or kind not in self._handlers or self._retry_at.get(kind, 0) > now:
+                skipped.add(kind)
+                continue
+            if self._attempts.get(entry["id"]):
+                return kind, [entry]
+            batch = []
+            for e in self._pending.values():
+                if e["kind"] != kind:
+                    continue
+                if self._attempts.get(e["id"]) or len(batch) >= self.batch_size:
+                    break
+                batch.append(e)
+            return kind, batch
+        return None, []
+
+    def _wait_timeout(self, now: float) -> float:
+        # Must be called with self._cond held: sleep until the next kind's backoff ends
+        retry = [t - now for t in self._retry_at.values() if t > now]
+        return max(min(retry), 0.01) if retry else self.flush_interval
+
+    def _failed(self, kind: str, batch: List[Dict[str, Any]], error: Exception):
+        # Back off this kind; dead-letter a lone entry that has used up its attempts
+        now = time.time()
+        backoff = self._backoff.get(kind, self.flush_interval)
+        with self._cond:
+            self._retry_at[kind] = now + backoff
+            self._backoff[kind] = min(backoff * 2, self.max_backoff)
+            for entry in batch:
+                self._attempts[entry["id"]] = self._attempts.get(entry["id"], 0) + 1
+            if len(batch) != 1 or self._attempts[batch[0]["id"]] < self.max_attempts:
+                return
+            entry = batch[0]
+            attempts = self._attempts.pop(entry["id"])
+            # A dead entry is not a reason to keep the rest of the kind waiting
+            self._retry_at.pop(kind, None)
+
+        self._append({"op": "put", **entry, "error": str(error), "attempts": attempts,
+                      "failed_at": datetime.utcnow().isoformat()}, self.dead_letter_path)
+        self._acked([entry["id"]])
+        logger.log_error(f"Write-behind entry moved to dead letter after {attempts} attempts: {str(error)}",
+                         kind=kind, entry_id=entry["id"])
+
+    def _acked(self, ids: List[str]):
+        self._append({"op": "ack", "ids": ids})
+        with self._cond:
+            for entry_id in ids:
+                self._pending.pop(entry_id, None)
+                self._attempts.pop(entry_id, None)
+            if not self._pending:
+                self._compact()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                kind, batch = self._next_batch(now)
+                if not batch:
+                    self._cond.wait(timeout=self._wait_timeout(now))
+                    continue
+                handler = self._handlers[kind]
+
+            try:
+                handler([{"id": e["id"], "payload": e["payload"]} for e in batch])
+            except Exception as e:
+                logger.log_error(f"Write-behind flush failed: {str(e)}", kind=kind, batch=len(batch))
+                self._failed(kind, batch, e)
+                continue
+
+            with self._cond:
+                self._backoff.pop(kind, None)
+                self._retry_at.pop(kind, None)
+            self._acked([e["id"] for e in batch])
+
+
+# Create global instance
+write_behind = WriteBehindQueue(
+    journal_dir=Config.WRITE_BEHIND_JOURNAL_DIR,
+    enabled=Config.WRITE_BEHIND_ENABLED,
+    batch_size=Config.WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=Config.WRITE_BEHIND_FLUSH_INTERVAL / 1000,
+    max_attempts=Config.WRITE_BEHIND_MAX_ATTEMPTS
+)
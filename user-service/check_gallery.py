@@ -0,0 +1,45 @@
+"""
+Consistency check of the running user-service face gallery (and the faceid-service index,
+when FACEID_INDEX_SYNC is on) against Firestore.
+
+    python check_gallery.py [--url http://localhost:5002] [--repair]
+
+Exits with status 1 when differences are found.
+"""
+
+import argparse
+import sys
+
+import requests
+
+from app.config.settings import Config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diff the face gallery against Firestore")
+    parser.add_argument("--url", default=f"http://localhost:{Config.USER_SERVICE_PORT}", help="user-service base URL")
+    parser.add_argument("--repair", action="store_true", help="Reload the gallery and re-sync the faceid index on mismatch")
+    args = parser.parse_args()
+
+    response = requests.get(f"{args.url}/api/gallery/check", params={"repair": int(args.repair)}, timeout=120)
+    result = response.json()
+    if not result.get("success"):
+        print(f"Check failed: {result.get('error')}")
+        return 2
+
+    for name in ("gallery", "faceid_index"):
+        report = result.get(name)
+        if report is None:
+            continue
+        print(f"{name}: {'consistent' if report.get('consistent') else 'INCONSISTENT'}")
+        for key in ("missing", "stale", "extra"):
+            ids = report.get(key) or []
+            if ids:
+                print(f"  {key} ({len(ids)}): {', '.join(ids[:20])}{' ...' if len(ids) > 20 else ''}")
+    if result.get("repaired"):
+        print("Repaired: gallery dropped for reload" + (", faceid index re-synced" if "faceid_sync" in result else ""))
+    return 0 if result.get("consistent") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Batch attendance from a recorded lecture video, through the running user-service.
+
+    python ingest_video.py lecture.mp4 [--class-id C1,C2] [--recorded-at 2024-01-15T08:00] [--fps 2] [--note "..."]
+
+faceid-service samples the video, tracks faces and embeds each track a few times; the tracks
+are identified against the face gallery and attendance is written in bulk.
+Exits with status 1 when the video could not be processed.
+"""
+
+import argparse
+import os
+import sys
+
+import requests
+
+from app.config.settings import Config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mark attendance from a recorded lecture video")
+    parser.add_argument("video", help="Video file (any format OpenCV can read)")
+    parser.add_argument("--url", default=f"http://localhost:{Config.USER_SERVICE_PORT}", help="user-service base URL")
+    parser.add_argument("--class-id", help="Only match students of these classes (comma list)")
+    parser.add_argument("--date", help="Attendance date, YYYY-MM-DD (default: the date of --recorded-at, or today)")
+    parser.add_argument("--recorded-at", help="Start of the recording, ISO date and time (required for a past date; "
+                                              "default: the video ended now)")
+    parser.add_argument("--fps", type=float, help="Frames per second sampled for detection (default: faceid-service VIDEO_SAMPLE_FPS)")
+    parser.add_argument("--note", help="Note stored with every record")
+    args = parser.parse_args()
+
+    form = {key: value for key, value in {
+        "classId": args.class_id,
+        "date": args.date,
+        "recorded_at": args.recorded_at,
+        "sample_fps": args.fps,
+        "note": args.note
+    }.items() if value is not None}
+    with open(args.video, "rb") as f:
+        response = requests.post(
+            f"{args.url}/api/attendance/video",
+            files={"video": (os.path.basename(args.video), f, "application/octet-stream")},
+            data=form,
+            timeout=Config.VIDEO_TIMEOUT + 60
+        )
+    result = response.json()
+    if not result.get("success"):
+        print(f"Ingestion failed: {result.get('error')}")
+        return 1
+
+    for entry in result["results"]:
+        status = "present" if entry.get("matched") else f"NOT WRITTEN ({entry.get('error')})"
+        print(f"{entry['name']:<30} {entry['similarity']:.3f}  {entry['first_seen']:>8.1f}s-{entry['last_seen']:<8.1f}s  {status}")
+    duration, elapsed = result["duration"], result["processing_seconds"]
+    print(f"{len(result['results'])} students from {result['tracks']} face tracks "
+          f"({result['unmatched_tracks']} unmatched) on {result['date']}")
+    print(f"{duration:.0f}s of video in {elapsed:.0f}s ({duration / max(elapsed, 1e-6):.1f}x real time, "
+          f"{result['frames_sampled']} frames sampled)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())